@@ -0,0 +1,35 @@
+import multiprocessing
+import os
+
+# Settings of gunicorn, read from the environment, see "Using Keybase in production" in README.md
+# Requests spend most of their time waiting for Redis. Sync workers serve one request at a time each, gevent workers
+# (GUNICORN_WORKER_CLASS=gevent, pip install .[gevent]) serve up to GUNICORN_WORKER_CONNECTIONS requests at a time,
+# and share a bounded pool of CFG_DB_POOL_SIZE connections to Redis per worker.
+wsgi_app = "wsgi:create_app()"
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+    # Inherited by the workers, read by src/common/config.py
+    os.environ.setdefault('CFG_DB_POOL_SIZE', '100')
+else:
+    workers = int(os.getenv('GUNICORN_WORKERS', 2 * multiprocessing.cpu_count() + 1))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Load the application once in the master, the workers are forked with the modules imported and the templates
+# compiled, and share that memory until they modify it. The master does not connect to Redis: each worker reads the
+# secret key, creates the missing indexes and subscribes to the invalidations before its first request (FirstRequest
+# in src/application.py), and reads the categories when a page first needs them
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+if preload_app and worker_class == 'gevent':
+    # Before the application is imported, as gevent workers would only patch after the fork
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_fork(server, worker):
+    # The workers open their own connections to Redis, those of the master are not shared
+    from src.common.utils import reset_connections
+    reset_connections()
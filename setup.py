@@ -6,6 +6,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
+        'cryptography',
         'flask',
         'Flask-Breadcrumbs',
         'Flask-Cors',
@@ -14,9 +15,14 @@ setup(
         'flask-paginate',
         'gunicorn',
         'numpy',
+        'PyYAML',
         'redis-om',
+        'requests',
         'sentence-transformers',
         'shortuuid',
         'python-dotenv '
     ],
+    extras_require={
+        'gevent': ['gevent'],
+    },
 )
\ No newline at end of file
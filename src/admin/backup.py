@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import json
+import sys
+import time
+import zlib
+
+from src.common.utils import get_db
+
+# A backup is a gzip-compressed NDJSON stream:
+#   {"format": "keybase-backup", "version": 2, "created": <seconds>}           header
+#   {"key": ..., "type": ..., "ttl": <ms or -1>, "dump": <base64 of DUMP>}      one line per key, any type
+#   {"trailer": true, "keys": <count>, "sha256": <hex>}                         checksum of all the lines above
+# DUMP serializes every type, JSON documents and time series included, in the RDB format of the server: the
+# backup can be restored by the same or a newer version of Redis Stack.
+# Keys are read by SCAN in batches of BATCH, and TYPE, PTTL and DUMP of a batch share one round trip, so the memory
+# used does not depend on the size of the database.
+FORMAT = "keybase-backup"
+VERSION = 2
+BATCH = 500
+MATCH = "keybase*"
+
+
+def backup_lines(match=MATCH, batch=BATCH):
+    # The lines of the backup, as bytes
+    digest = hashlib.sha256()
+    count = 0
+
+    line = (json.dumps({'format': FORMAT, 'version': VERSION, 'created': time.time()}) + "\n").encode()
+    digest.update(line)
+    yield line
+
+    db = get_db(decode=False)
+    cursor = 0
+    while True:
+        cursor, keys = db.scan(cursor, match=match, count=batch)
+        if len(keys):
+            pipeline = db.pipeline(transaction=False)
+            for key in keys:
+                pipeline.type(key)
+                pipeline.pttl(key)
+                pipeline.dump(key)
+            results = pipeline.execute()
+            for key, keytype, ttl, dump in zip(keys, results[0::3], results[1::3], results[2::3]):
+                # The key expired or was deleted after the SCAN
+                if dump is None:
+                    continue
+                line = (json.dumps({'key': key.decode('utf-8'),
+                                    'type': keytype.decode('utf-8'),
+                                    'ttl': ttl,
+                                    'dump': base64.b64encode(dump).decode('ascii')}) + "\n").encode()
+                digest.update(line)
+                count += 1
+                yield line
+        if cursor == 0:
+            break
+
+    yield (json.dumps({'trailer': True, 'keys': count, 'sha256': digest.hexdigest()}) + "\n").encode()
+
+
+def generate_backup(match=MATCH, batch=BATCH):
+    # The backup compressed on the fly, in chunks of about 64 KB
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    chunk = []
+    size = 0
+    for line in backup_lines(match, batch):
+        chunk.append(compressor.compress(line))
+        size += len(chunk[-1])
+        if size >= 65536:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(compressor.flush())
+    yield b"".join(chunk)
+
+
+def backup_filename():
+    return "keybase_{}.ndjson.gz".format(time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()))
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.admin.backup [<file>]
+    filename = sys.argv[1] if len(sys.argv) > 1 else backup_filename()
+    with open(filename, 'wb') as f:
+        for data in generate_backup():
+            f.write(data)
+    print("Backup written to {}".format(filename))
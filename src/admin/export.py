@@ -0,0 +1,161 @@
+import io
+import re
+import sys
+import tarfile
+import time
+import zipfile
+
+import yaml
+from redis.exceptions import ResponseError
+
+from src.common.utils import get_db
+
+# Export of the documents, in any state, as Markdown files with a YAML front-matter, in a zip or tar.gz archive.
+# The front-matter has the fields read by src/admin/importer.py, so an export can be imported again, with the
+# history of versions when requested.
+# The keys are read from document_idx by FT.AGGREGATE WITHCURSOR, or by SCAN if the index does not exist, and the
+# documents are fetched with JSON.MGET in batches of BATCH. The archive is written to a buffer that is emptied in
+# chunks of about 64 KB, so the memory used does not depend on the size of the knowledge base.
+BATCH = 500
+CHUNK = 65536
+FORMATS = {'zip': "application/zip", 'tar': "application/gzip"}
+
+
+class Buffer:
+    """Write-only file where the archive is written, and from where it is streamed."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def iter_keys(batch=BATCH):
+    # Lists of keys of documents
+    db = get_db()
+    try:
+        reply = db.execute_command("FT.AGGREGATE", "document_idx", "*", "LOAD", 1, "@__key",
+                                   "WITHCURSOR", "COUNT", batch)
+    except ResponseError:
+        # The index does not exist, as during a restore
+        keys = []
+        for key in db.scan_iter(match="keybase:json:*", count=batch, _type="ReJSON-RL"):
+            keys.append(key)
+            if len(keys) == batch:
+                yield keys
+                keys = []
+        if keys:
+            yield keys
+        return
+
+    while True:
+        results, cursor = reply
+        # [total, [__key, <key>], ...]
+        keys = [row[1] for row in results[1:]]
+        if keys:
+            yield keys
+        if not cursor:
+            break
+        reply = db.execute_command("FT.CURSOR", "READ", "document_idx", cursor, "COUNT", batch)
+
+
+def iter_documents(batch=BATCH):
+    for keys in iter_keys(batch):
+        for document in get_db().json().mget(keys, "$"):
+            # Deleted after it was listed
+            if document:
+                yield document[0]
+
+
+class LiteralDumper(yaml.SafeDumper):
+    pass
+
+
+def represent_str(dumper, data):
+    # Multi-line contents of versions are written as literal blocks
+    if "\n" in data:
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+
+LiteralDumper.add_representer(str, represent_str)
+
+
+def document_markdown(document, versions=False):
+    current = document['currentversion']
+    front = {'pk': document['pk'],
+             'name': current['name'],
+             'tags': [tag for tag in (document.get('tags') or "").split("|") if tag],
+             'category': document.get('category'),
+             'privacy': document.get('privacy'),
+             'state': document.get('state'),
+             'author': document.get('author'),
+             'description': document.get('description') or "",
+             'keyword': document.get('keyword') or "",
+             'creation': document.get('creation'),
+             'updated': document.get('updated')}
+    if versions:
+        front['versions'] = [{'name': version['name'], 'last': version['last'], 'owner': version['owner'],
+                              'content': version['content']} for version in document.get('versions') or []]
+    header = yaml.dump(front, Dumper=LiteralDumper, sort_keys=False, allow_unicode=True)
+    return "---\n{}---\n{}".format(header, current.get('content') or "").encode('utf-8')
+
+
+def document_filename(document):
+    name = re.sub(r'[^a-z0-9]+', '-', document['currentversion']['name'].lower()).strip('-')[:60]
+    return "{}/{}-{}.md".format(document.get('state') or 'draft', name or 'document', document['pk'])
+
+
+def generate_export(fmt='zip', versions=False, batch=BATCH):
+    buffer = Buffer()
+    if fmt == 'tar':
+        archive = tarfile.open(fileobj=buffer, mode='w|gz')
+    else:
+        archive = zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    with archive:
+        for document in iter_documents(batch):
+            data = document_markdown(document, versions)
+            filename = document_filename(document)
+            modified = document.get('updated') or time.time()
+            if fmt == 'tar':
+                info = tarfile.TarInfo(filename)
+                info.size = len(data)
+                info.mtime = modified
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                info = zipfile.ZipInfo(filename, time.gmtime(max(modified, 315532800))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, data)
+            if buffer.size >= CHUNK:
+                yield buffer.take()
+    yield buffer.take()
+
+
+def export_filename(fmt='zip'):
+    return "keybase_{}.{}".format(time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()), 'tar.gz' if fmt == 'tar' else 'zip')
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.admin.export [--versions] [<file.zip|file.tar.gz>]
+    args = [arg for arg in sys.argv[1:] if arg != '--versions']
+    filename = args[0] if args else export_filename()
+    fmt = 'tar' if filename.endswith(('.tar.gz', '.tgz')) else 'zip'
+    with open(filename, 'wb') as f:
+        for data in generate_export(fmt, '--versions' in sys.argv):
+            f.write(data)
+    print("Export written to {}".format(filename))
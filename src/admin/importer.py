@@ -0,0 +1,193 @@
+import base64
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+
+import yaml
+from pydantic import ValidationError
+
+from src.common.utils import get_db
+from src.document.document import Document
+from src.version.version import Version, CurrentVersion
+
+# Bulk import of documents from:
+# - NDJSON, one document per line: {"name": ..., "content": ..., "tags": "a|b" or ["a", "b"], "category": ...,
+#   "privacy": ..., "state": ..., "author": ..., "description": ..., "keyword": ..., "creation": ..., "updated": ...}
+#   Lines of the hash backups of previous versions, {"key": "keybase:kb:<pk>", "value": {...}}, are accepted too.
+# - Markdown files, alone, in a folder, a zip or a tar.gz, with the same fields in a YAML front-matter, and optionally
+#   the history, "versions": [{"name": ..., "content": ..., "last": ..., "owner": ...}], as exported by
+#   src/admin/export.py
+# Records are validated by the Document model one by one, the invalid ones are reported and skipped, the valid ones
+# are saved in pipelines of BATCH documents. All are marked processable, so transformer.py embeds them in batch.
+BATCH = 500
+STATES = ('draft', 'review', 'published')
+PRIVACY = ('internal', 'public')
+FRONT_MATTER = re.compile(r'---[ \t]*\r?\n(.*?)^---[ \t]*(?:\r?\n|$)', re.DOTALL | re.MULTILINE)
+
+
+def legacy_record(data):
+    # Hash of a document of previous versions, fields and values base64-encoded
+    fields = {base64.b64decode(field).decode('utf-8'): base64.b64decode(value).decode('utf-8')
+              for field, value in data['value'].items()}
+    return {'pk': data['key'].split(':')[-1],
+            'name': fields.get('name', ''),
+            'content': fields.get('content', ''),
+            'tags': fields.get('tags', ''),
+            'state': fields.get('state', ''),
+            'author': fields.get('author') or fields.get('owner', ''),
+            'creation': fields.get('creation', 0),
+            'updated': fields.get('update', 0)}
+
+
+def ndjson_records(f, source):
+    for number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield "{}:{}".format(source, number), e
+            continue
+        if 'key' in data and 'value' in data:
+            if not data['key'].startswith("keybase:kb:"):
+                continue
+            data = legacy_record(data)
+        yield "{}:{}".format(source, number), data
+
+
+def markdown_record(text, name):
+    # YAML front-matter between two --- lines, then the content
+    data = {}
+    match = FRONT_MATTER.match(text)
+    if match:
+        data = yaml.safe_load(match.group(1)) or {}
+        if not isinstance(data, dict):
+            raise ValueError("the front-matter is not a mapping")
+        text = text[match.end():]
+    data['content'] = text
+    if not data.get('name'):
+        heading = next((line[2:].strip() for line in text.splitlines() if line.startswith('# ')), None)
+        data['name'] = heading or os.path.splitext(os.path.basename(name))[0]
+    return data
+
+
+def markdown_records(files):
+    # [(name, opener)]
+    for name, opener in files:
+        try:
+            with opener() as f:
+                yield name, markdown_record(f.read().decode('utf-8'), name)
+        except (ValueError, yaml.YAMLError) as e:
+            yield name, e
+
+
+def read_records(path_or_file, filename=None):
+    # Records from a path (ndjson, md, zip, tar.gz or folder) or from an uploaded file
+    filename = filename or (path_or_file if isinstance(path_or_file, str) else 'upload')
+    if isinstance(path_or_file, str) and os.path.isdir(path_or_file):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path_or_file)
+                       for name in names if name.endswith('.md'))
+        return markdown_records((name, lambda name=name: open(name, 'rb')) for name in files)
+    if filename.endswith('.zip'):
+        archive = zipfile.ZipFile(path_or_file)
+        return markdown_records((name, lambda name=name: archive.open(name))
+                                for name in archive.namelist() if name.endswith('.md'))
+    if filename.endswith(('.tar.gz', '.tgz')):
+        # Read as a stream, the members in order
+        archive = tarfile.open(path_or_file, mode='r|gz') if isinstance(path_or_file, str) else \
+            tarfile.open(fileobj=path_or_file, mode='r|gz')
+        return markdown_records((member.name, lambda member=member: archive.extractfile(member))
+                                for member in archive if member.isfile() and member.name.endswith('.md'))
+    if filename.endswith('.md'):
+        f = open(path_or_file, 'rb') if isinstance(path_or_file, str) else path_or_file
+        return markdown_records([(filename, lambda: f)])
+    f = open(path_or_file, 'rb') if isinstance(path_or_file, str) else path_or_file
+    return ndjson_records(io.TextIOWrapper(f, encoding='utf-8'), filename)
+
+
+def build_document(data):
+    if not data.get('name') or not data.get('content'):
+        raise ValueError("name and content are required")
+    state = data.get('state') or 'draft'
+    privacy = data.get('privacy') or 'internal'
+    if state not in STATES:
+        raise ValueError("state must be one of {}".format(", ".join(STATES)))
+    if privacy not in PRIVACY:
+        raise ValueError("privacy must be one of {}".format(", ".join(PRIVACY)))
+    tags = data.get('tags') or ''
+    if isinstance(tags, list):
+        tags = "|".join(str(tag) for tag in tags)
+
+    now = int(time.time())
+    creation = int(data.get('creation') or now)
+    updated = int(data.get('updated') or creation)
+    author = str(data.get('author') or '')
+    name, content = str(data['name']), str(data['content'])
+    document = {'editorversion': Version(name=name, content=content, last=str(updated), owner=author),
+                'currentversion': CurrentVersion(name=name, content=content, last=str(updated), owner=author),
+                'description': str(data.get('description') or ''),
+                'keyword': str(data.get('keyword') or ''),
+                'tags': tags,
+                'category': data.get('category'),
+                'privacy': privacy,
+                'state': state,
+                'creation': creation,
+                'updated': updated,
+                'processable': 1,
+                'author': author,
+                'versions': [Version(name=str(version['name']), content=str(version.get('content') or ''),
+                                     last=str(version.get('last') or ''), owner=str(version.get('owner') or ''))
+                             for version in data.get('versions') or []]}
+    if data.get('pk'):
+        document['pk'] = str(data['pk'])
+    return Document(**document)
+
+
+def import_documents(records, batch=BATCH):
+    # Returns a report: imported, errors (the first 100), seconds and documents per second
+    start = time.perf_counter()
+    imported = 0
+    errors = []
+    failed = 0
+    pipeline = get_db().pipeline(transaction=False)
+    queued = 0
+    for source, data in records:
+        try:
+            if isinstance(data, Exception):
+                raise data
+            build_document(data).save(pipeline)
+            queued += 1
+        except (ValueError, TypeError, KeyError, ValidationError) as e:
+            failed += 1
+            if len(errors) < 100:
+                errors.append("{}: {}".format(source, str(e).replace("\n", " ")))
+            continue
+        if queued == batch:
+            pipeline.execute()
+            imported += queued
+            queued = 0
+    if queued:
+        pipeline.execute()
+        imported += queued
+
+    seconds = time.perf_counter() - start
+    return {'imported': imported,
+            'failed': failed,
+            'errors': errors,
+            'seconds': round(seconds, 3),
+            'rate': round(imported / seconds, 1) if seconds else 0}
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.admin.importer <file.ndjson|file.md|file.zip|folder>
+    report = import_documents(read_records(sys.argv[1]))
+    for error in report['errors']:
+        print(error)
+    print("Imported {} documents in {} seconds ({} per second), {} failed".format(
+        report['imported'], report['seconds'], report['rate'], report['failed']))
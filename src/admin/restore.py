@@ -0,0 +1,214 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.common.config import CFG_RESTORE_WORKERS, CFG_RESTORE_DIR
+from src.common.indexes import create_indexes, drop_indexes
+from src.common.utils import get_db, ShortUuidPk
+
+# Restores the backups written by src/admin/backup.py, and the hash-only backups of previous versions, where each
+# line is {"key": ..., "value": {<base64 field>: <base64 value>}}.
+# The file is parsed line by line and written in pipelined batches of BATCH keys by CFG_RESTORE_WORKERS threads.
+# Progress is kept in the hash keybase:restore:<job>: lines read, keys restored, errors, and the checkpoint, the
+# number of lines whose batches are all written. A job interrupted can be resumed from its checkpoint.
+# A running job updates its hash at least every HEARTBEAT seconds: a job not updated for STALE seconds was stopped
+# with its process, and is reported as interrupted.
+# By default the indexes stay in place, the application keeps searching while the keys are restored, and every key
+# is indexed as it is written. Jobs created with pause_indexes, for a restore into an empty database or during
+# maintenance, drop the indexes (not the documents) and create them again when the job ends, failed or not, so that
+# the keys are indexed once, in the background. Searches return nothing meanwhile.
+BATCH = 500
+JOBS = "keybase:restore:"
+HEARTBEAT = 10
+STALE = 3 * HEARTBEAT
+
+
+def open_backup(path):
+    # Backups are gzip-compressed, previous versions were plain text
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def write_batch(batch):
+    # [(line, entry)], returns the number of keys written and the errors
+    pipeline = get_db(decode=False).pipeline(transaction=False)
+    for _, entry in batch:
+        if 'dump' in entry:
+            ttl = entry['ttl'] if entry['ttl'] > 0 else 0
+            pipeline.restore(entry['key'], ttl, base64.b64decode(entry['dump']), replace=True)
+        else:
+            mapping = {base64.b64decode(field): base64.b64decode(value) for field, value in entry['value'].items()}
+            pipeline.hset(entry['key'], mapping=mapping)
+    errors = []
+    for (line, entry), result in zip(batch, pipeline.execute(raise_on_error=False)):
+        if isinstance(result, Exception):
+            errors.append("line {}, {}: {}".format(line, entry['key'], result))
+    return len(batch) - len(errors), errors
+
+
+class Progress:
+    """Counters of a job, and the checkpoint: batches complete out of order, the checkpoint only moves past the
+    lines of the batches written before them."""
+
+    def __init__(self, job, checkpoint):
+        self.job = job
+        self.lock = threading.Lock()
+        self.checkpoint = checkpoint
+        self.done = {}
+        self.lines = checkpoint
+        self.restored = 0
+        self.errors = 0
+
+    def completed(self, first, last, restored, errors):
+        with self.lock:
+            self.done[first] = last
+            while self.checkpoint in self.done:
+                self.checkpoint = self.done.pop(self.checkpoint)
+            self.restored += restored
+            self.errors += len(errors)
+            update = {'lines': self.lines, 'checkpoint': self.checkpoint, 'updated': time.time()}
+        pipeline = get_db().pipeline(transaction=False)
+        pipeline.hset(JOBS + self.job, mapping=update)
+        pipeline.hincrby(JOBS + self.job, 'restored', restored)
+        pipeline.hincrby(JOBS + self.job, 'errors', len(errors))
+        for error in errors[:10]:
+            pipeline.rpush(JOBS + self.job + ":errors", error)
+        pipeline.ltrim(JOBS + self.job + ":errors", 0, 999)
+        pipeline.execute()
+
+
+def create_job(path, pause_indexes=False):
+    job = ShortUuidPk().create_pk()
+    get_db().hset(JOBS + job, mapping={'path': path, 'status': 'created', 'lines': 0, 'checkpoint': 0,
+                                       'restored': 0, 'errors': 0, 'created': time.time(), 'updated': time.time(),
+                                       'pause_indexes': int(pause_indexes)})
+    return job
+
+
+def get_job(job):
+    status = get_db().hgetall(JOBS + job)
+    if not status:
+        return None
+    status['last_errors'] = get_db().lrange(JOBS + job + ":errors", 0, 9)
+    if status['status'] == 'running' and time.time() - float(status['updated']) > STALE:
+        # The process running it stopped
+        status['status'] = 'interrupted'
+    return status
+
+
+def heartbeat(job, stop):
+    while not stop.wait(HEARTBEAT):
+        get_db().hset(JOBS + job, 'updated', time.time())
+
+
+def run_job(job, workers=CFG_RESTORE_WORKERS):
+    status = get_db().hgetall(JOBS + job)
+    checkpoint = int(status.get('checkpoint', 0))
+    progress = Progress(job, checkpoint)
+    get_db().hset(JOBS + job, mapping={'status': 'running', 'message': '', 'updated': time.time()})
+    paused = status.get('pause_indexes') == '1'
+    if paused:
+        get_db().hset(JOBS + job, 'dropped', ",".join(drop_indexes()))
+
+    digest = hashlib.sha256()
+    header = None
+    trailer = None
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job, stop), name="restore-heartbeat-{}".format(job), daemon=True).start()
+    try:
+        with open_backup(status['path']) as f, ThreadPoolExecutor(max_workers=workers) as executor:
+            # Every batch covers the lines [first, last), so that the checkpoint can move past the lines skipped
+            pending = set()
+            batch = []
+            first = lines = checkpoint
+            for number, line in enumerate(f):
+                lines = number + 1
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'trailer' in entry:
+                    trailer = entry
+                    continue
+                digest.update(line)
+                if 'format' in entry:
+                    header = entry
+                # Already restored, the header, or the progress of a restore
+                if number < checkpoint or 'key' not in entry or entry['key'].startswith(JOBS):
+                    continue
+                batch.append((number, entry))
+                if len(batch) == BATCH:
+                    pending.add(submit(executor, progress, first, lines, batch))
+                    first, batch = lines, []
+                    progress.lines = lines
+                    # Bound the lines held in memory
+                    if len(pending) >= 2 * workers:
+                        completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            future.result()
+            progress.lines = lines
+            if batch:
+                pending.add(submit(executor, progress, first, lines, batch))
+            elif lines > first:
+                progress.completed(first, lines, 0, [])
+            for future in pending:
+                future.result()
+    except Exception as e:
+        get_db().hset(JOBS + job, mapping={'status': 'failed', 'message': str(e), 'updated': time.time()})
+        raise
+    finally:
+        stop.set()
+        if paused:
+            create_indexes()
+
+    message = ""
+    if header is not None and trailer is None:
+        message = "The backup has no trailer, it may be truncated"
+    elif trailer is not None and digest.hexdigest() != trailer['sha256']:
+        message = "Checksum mismatch, the backup is corrupted"
+    get_db().hset(JOBS + job, mapping={'status': 'done', 'lines': progress.lines, 'message': message,
+                                       'updated': time.time()})
+    return get_job(job)
+
+
+def submit(executor, progress, first, last, batch):
+    def task():
+        restored, errors = write_batch(batch)
+        progress.completed(first, last, restored, errors)
+    return executor.submit(task)
+
+
+def start_job(fileobj, pause_indexes=False):
+    # Save the upload, so the job survives the request and can be resumed, and restore it in the background
+    os.makedirs(CFG_RESTORE_DIR, exist_ok=True)
+    path = os.path.join(CFG_RESTORE_DIR, "restore-{}-{}.ndjson".format(time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+                                                                       uuid.uuid4().hex))
+    fileobj.save(path)
+    job = create_job(path, pause_indexes)
+    resume_job(job)
+    return job
+
+
+def resume_job(job):
+    threading.Thread(target=run_job, args=(job,), name="restore-{}".format(job), daemon=True).start()
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.admin.restore [--pause-indexes] <file>
+    # python3 -m src.admin.restore --resume <job>
+    if sys.argv[1] == '--resume':
+        job = sys.argv[2]
+    else:
+        job = create_job(os.path.abspath(sys.argv[-1]), pause_indexes='--pause-indexes' in sys.argv)
+    print("Restore job {}".format(job))
+    result = run_job(job)
+    print("Restored {} keys from {} lines, {} errors {}".format(result['restored'], result['lines'],
+                                                              result['errors'], result['message']))
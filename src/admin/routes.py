@@ -1,11 +1,14 @@
-from flask import Blueprint, render_template, redirect, url_for, request, jsonify
-from flask_login import (login_required)
-import json
-import base64
+from flask import Blueprint, render_template, redirect, url_for, request, jsonify, Response, stream_with_context
+from flask_login import (login_required, current_user)
 
 from src.common.utils import ShortUuidPk
-from src.document.document import Document
-from src.common.utils import requires_access_level, Role, get_db
+from src.common.utils import requires_access_level, Role, get_db, invalidate_categories
+from src.common.cpuprofile import get_profiles, get_profile, export_profile
+from src.admin.backup import generate_backup, backup_filename
+from src.admin.restore import start_job, get_job, resume_job
+from src.admin.importer import import_documents, read_records
+from src.admin.export import generate_export, export_filename, FORMATS
+from src.api.keys import get_keys, create_key, revoke_key
 
 admin_bp = Blueprint('admin_bp', __name__,
                      template_folder='./templates')
@@ -61,6 +64,7 @@ def createcategory():
         pkcreator = ShortUuidPk()
         category = {pkcreator.create_pk(): request.form['category']}
         get_db().hset("keybase:categories", mapping=category)
+        invalidate_categories()
     else:
         return jsonify(message="Metadata is missing", code="success"), 500
 
@@ -81,96 +85,122 @@ def data():
 @login_required
 @requires_access_level(Role.ADMIN)
 def backup():
-    result = []
-    backup = ""
-    cursor = 0
+    # Streamed as it is read from the database, see src/admin/backup.py
+    return Response(stream_with_context(generate_backup()), mimetype="application/gzip",
+                    headers={"Content-Disposition": "attachment; filename={}".format(backup_filename())})
 
-    while True:
-        cursor, keys = get_db(decode=False).scan(cursor, match='keybase*', count=20, _type="HASH")
-        result.extend(keys)
-        for key in keys:
-            hashdata = get_db(decode=False).hgetall(key)
-            data = {}
-            thevalue = {}
-            data['key'] = key.decode("utf-8")
-            for (field, value) in hashdata.items():
-                thevalue[base64.b64encode(field).decode('ascii')] = base64.b64encode(value).decode('ascii')
 
-            data['value'] = thevalue
-            backup += json.dumps(data) + "\n"
-
-        if cursor == 0:
-            break
-
-    return jsonify(message="Backup created", backup=backup)
+@admin_bp.route('/export', methods=['GET'])
+@login_required
+@requires_access_level(Role.ADMIN)
+def export():
+    # Markdown files in a zip or tar.gz, streamed, see src/admin/export.py
+    fmt = request.args.get('format', 'zip')
+    if fmt not in FORMATS:
+        return jsonify(message="The format must be zip or tar"), 400
+    versions = request.args.get('versions', '0') == '1'
+    return Response(stream_with_context(generate_export(fmt, versions)), mimetype=FORMATS[fmt],
+                    headers={"Content-Disposition": "attachment; filename={}".format(export_filename(fmt))})
 
 
 @admin_bp.route('/restore', methods=['POST'])
 @login_required
 @requires_access_level(Role.ADMIN)
 def restore():
-    print("Starting to restore")
-    uploaded_file = request.files['file']
-    print(uploaded_file.filename)
-    for line in uploaded_file:
-        data = json.loads(line)
-        hashdata = {}
-        print(data['key'])
-        for (field, value) in data['value'].items():
-            hashdata[base64.b64decode(field.encode('ascii'))] = base64.b64decode(value.encode('ascii'))
-        get_db(decode=False).hmset(data['key'], hashdata)
+    # The restore runs in the background, poll /restore/<job> for the progress
+    job = start_job(request.files['file'], pause_indexes=request.form.get('pause_indexes') == '1')
+    return jsonify(message="Restore started", job=job), 202
 
-    return jsonify(message="Restore done")
 
+@admin_bp.route('/restore/<job>', methods=['GET'])
+@login_required
+@requires_access_level(Role.ADMIN)
+def restorejob(job):
+    status = get_job(job)
+    if status is None:
+        return jsonify(message="Restore job not found"), 404
+    return jsonify(message="Restore {}".format(status['status']), job=status)
 
+
+@admin_bp.route('/restore/<job>', methods=['POST'])
+@login_required
+@requires_access_level(Role.ADMIN)
+def restoreresume(job):
+    # Resume an interrupted job from its checkpoint
+    status = get_job(job)
+    if status is None:
+        return jsonify(message="Restore job not found"), 404
+    if status['status'] == 'running':
+        return jsonify(message="Restore already running", job=status), 409
+    resume_job(job)
+    return jsonify(message="Restore resumed", job=job), 202
+
+
+@admin_bp.route('/import', methods=['POST'])
 @admin_bp.route('/jimport', methods=['POST'])
 @login_required
 @requires_access_level(Role.ADMIN)
 def jimport():
-    print("Starting to import to Json")
+    # NDJSON documents, Markdown files in a zip, or the hash backups of previous versions, see src/admin/importer.py
     uploaded_file = request.files['file']
-    print(uploaded_file.filename)
-    cnt = 0
-    for line in uploaded_file:
-        data = json.loads(line)
-        if "keybase:kb:" in data['key']:
-            cnt = cnt + 1
-            # print(str(cnt) + ": " + data['key'])
-            name, content, tags, state, owner, author = "", "", "", "", "", ""
-            creation, update = 0, 0
-            for (field, value) in data['value'].items():
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'name':
-                    name = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'content':
-                    content = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'creation':
-                    creation = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'update':
-                    update = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'tags':
-                    tags = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'owner':
-                    owner = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'author':
-                    author = base64.b64decode(value.encode('ascii'))
-                if base64.b64decode(field.encode('ascii')).decode('utf-8') == 'state':
-                    state = base64.b64decode(value.encode('ascii'))
-                # hash[base64.b64decode(field.encode('ascii'))] = base64.b64decode(value.encode('ascii'))
-            # use data['key'] as keyname
-            doc = Document(
-                pk=data['key'].split(':')[-1],
-                name=name,
-                content=content,
-                creation=creation,
-                last=update,
-                processable=1,
-                state=state,
-                owner=owner,
-                tags=tags,
-                author=author,
-                versions=[]
-            )
-            #doc.set_name = "keybase:json:" + data['key'].split(':')[-1]
-            doc.save()
-
-    return jsonify(message="Restore done")
+    report = import_documents(read_records(uploaded_file.stream, uploaded_file.filename))
+    return jsonify(message="Imported {} documents, {} failed".format(report['imported'], report['failed']),
+                   report=report)
+
+
+@admin_bp.route('/profiles')
+@login_required
+@requires_access_level(Role.ADMIN)
+def profiles():
+    title = "Admin functions"
+    desc = "Admin functions"
+    return render_template('profiles.html', title=title, desc=desc, profiles=get_profiles())
+
+
+@admin_bp.route('/profiles/<pk>')
+@login_required
+@requires_access_level(Role.ADMIN)
+def profile(pk):
+    title = "Admin functions"
+    desc = "Admin functions"
+    cpuprofile = get_profile(pk)
+    if cpuprofile is None:
+        return render_template('404.html'), 404
+    return render_template('profile.html', title=title, desc=desc, profile=cpuprofile)
+
+
+@admin_bp.route('/profiles/<pk>/download')
+@login_required
+@requires_access_level(Role.ADMIN)
+def profiledownload(pk):
+    export = export_profile(pk)
+    if export is None:
+        return render_template('404.html'), 404
+    filename, content = export
+    return Response(content, mimetype="application/octet-stream",
+                    headers={"Content-Disposition": "attachment; filename={}".format(filename)})
+
+
+@admin_bp.route('/apikeys', methods=['GET', 'POST'])
+@login_required
+@requires_access_level(Role.ADMIN)
+def apikeys():
+    title = "Admin functions"
+    desc = "Admin functions"
+    created = None
+    if request.method == 'POST':
+        if not len(request.form.get('name', '').strip()):
+            return render_template('apikeys.html', title=title, desc=desc, keys=get_keys(),
+                                   message="The name of the key is required"), 422
+        # The secret is shown once, only its hash is stored
+        created = create_key(request.form['name'].strip(), current_user.id)
+    return render_template('apikeys.html', title=title, desc=desc, keys=get_keys(), created=created)
+
+
+@admin_bp.route('/apikeys/<key_id>/revoke', methods=['POST'])
+@login_required
+@requires_access_level(Role.ADMIN)
+def revokeapikey(key_id):
+    if not revoke_key(key_id):
+        return render_template('404.html'), 404
+    return redirect(url_for('admin_bp.apikeys'))
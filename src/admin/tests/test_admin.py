@@ -1,4 +1,15 @@
+import gzip
+import hashlib
+import io
 import json
+import threading
+import time
+
+import src.admin.restore
+from src.admin.importer import read_records
+from src.admin.restore import create_job, run_job
+from src.common.cpuprofile import Sampler
+from src.common.utils import get_db
 
 
 def test_admin_editor_tags_forbidden(test_client, user_auth):
@@ -38,3 +49,130 @@ def test_admin_admin_category_allowed(test_client, user_auth, captured_templates
     user_auth.set_group("admin")
     response = test_client.post("/createcategory", data={'category': 'Redis Stack'})
     assert response.status_code == 302
+
+
+def test_admin_backup_all_types(test_client, user_auth, create_document):
+    # the document is a JSON key, not in the backups of previous versions
+    pk = create_document
+    response = test_client.get("/backup")
+    assert response.status_code == 403
+
+    user_auth.set_group("admin")
+    response = test_client.get("/backup")
+    assert response.status_code == 200
+    lines = gzip.decompress(response.data).splitlines(keepends=True)
+    assert json.loads(lines[0])['format'] == "keybase-backup"
+    trailer = json.loads(lines[-1])
+    assert trailer['keys'] == len(lines) - 2
+    assert trailer['sha256'] == hashlib.sha256(b"".join(lines[:-1])).hexdigest()
+    entries = {json.loads(line)['key']: json.loads(line) for line in lines[1:-1]}
+    assert entries["keybase:json:{}".format(pk)]['type'] == "ReJSON-RL"
+
+
+def test_admin_restore_backup(test_client, user_auth, create_document):
+    pk = create_document
+    user_auth.set_group("admin")
+    backup = test_client.get("/backup").data
+    get_db().delete("keybase:json:{}".format(pk))
+
+    response = test_client.post("/restore", data={'file': (io.BytesIO(backup), "backup.ndjson.gz")},
+                                content_type='multipart/form-data')
+    assert response.status_code == 202
+    job = json.loads(response.data)['job']
+    for _ in range(50):
+        status = json.loads(test_client.get("/restore/{}".format(job)).data)['job']
+        if status['status'] not in ('created', 'running'):
+            break
+        time.sleep(0.1)
+    assert status['status'] == "done"
+    assert status['message'] == ""
+    assert int(status['errors']) == 0
+    assert get_db().json().get("keybase:json:{}".format(pk), "$.pk") == [pk]
+
+
+def test_admin_import_ndjson(test_client, user_auth):
+    user_auth.set_group("admin")
+    lines = [json.dumps({'pk': "importtest1", 'name': "Imported", 'content': "Imported content",
+                         'tags': ["redis", "import"], 'state': "published"}),
+             json.dumps({'name': "No content"}),
+             "not json"]
+    response = test_client.post("/import", data={'file': (io.BytesIO("\n".join(lines).encode()), "docs.ndjson")},
+                                content_type='multipart/form-data')
+    assert response.status_code == 200
+    report = json.loads(response.data)['report']
+    assert report['imported'] == 1
+    assert report['failed'] == 2
+    document = get_db().json().get("keybase:json:importtest1")
+    assert document['currentversion']['name'] == "Imported"
+    assert document['tags'] == "redis|import"
+    assert document['processable'] == 1
+    get_db().delete("keybase:json:importtest1")
+
+
+def test_admin_export_markdown(test_client, user_auth, create_document):
+    pk = create_document
+    user_auth.set_group("admin")
+    response = test_client.get("/export?format=zip&versions=1")
+    assert response.status_code == 200
+    assert response.mimetype == "application/zip"
+    records = dict((data['pk'], data) for _, data in read_records(io.BytesIO(response.data), "export.zip"))
+    document = get_db().json().get("keybase:json:{}".format(pk))
+    assert records[pk]['name'] == document['currentversion']['name']
+    assert records[pk]['content'] == document['currentversion']['content']
+    assert records[pk]['state'] == document['state']
+
+
+def test_admin_restore_pause_indexes(test_client, user_auth, create_document, tmp_path, monkeypatch):
+    pk = create_document
+    user_auth.set_group("admin")
+    path = tmp_path / "backup.ndjson.gz"
+    path.write_bytes(test_client.get("/backup").data)
+    get_db().delete("keybase:json:{}".format(pk))
+
+    # The indexes are dropped before the keys are written, and created again at the end
+    written = []
+    write_batch = src.admin.restore.write_batch
+    monkeypatch.setattr(src.admin.restore, "write_batch", lambda batch: written.append(
+        "document_idx" in get_db().execute_command("FT._LIST")) or write_batch(batch))
+    job = create_job(str(path), pause_indexes=True)
+    status = run_job(job)
+    assert status['status'] == "done"
+    assert written and not any(written)
+    assert "document_idx" in status['dropped'].split(",")
+    assert "document_idx" in get_db().execute_command("FT._LIST")
+    for _ in range(50):
+        if int(get_db().ft("document_idx").info()['num_docs']) >= 1:
+            break
+        time.sleep(0.1)
+    assert int(get_db().ft("document_idx").info()['num_docs']) >= 1
+
+    # Without the flag, they stay in place
+    written.clear()
+    run_job(create_job(str(path)))
+    assert written and all(written)
+
+
+def test_admin_restore_interrupted_resumable(test_client, user_auth):
+    # A job left running by a process that stopped
+    user_auth.set_group("admin")
+    get_db().hset("keybase:restore:stalejob", mapping={'path': "missing.ndjson", 'status': 'running', 'lines': 0,
+                                                        'checkpoint': 0, 'restored': 0, 'errors': 0,
+                                                        'created': time.time() - 600, 'updated': time.time() - 600})
+    status = json.loads(test_client.get("/restore/stalejob").data)['job']
+    assert status['status'] == "interrupted"
+    response = test_client.post("/restore/stalejob")
+    assert response.status_code == 202
+
+
+def test_admin_cpu_sampler_stop_final():
+    # The samples returned by stop() are not written by the sampler afterwards
+    sampler = Sampler(0.001)
+    sampler.start(threading.get_ident())
+    deadline = time.monotonic() + 0.05
+    while time.monotonic() < deadline:
+        sum(range(1000))
+    samples = sampler.stop(threading.get_ident())
+    assert samples
+    before = dict(samples)
+    time.sleep(0.02)
+    assert samples == before
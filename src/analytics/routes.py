@@ -1,8 +1,9 @@
 from flask import Blueprint, render_template
 from flask_login import (login_required)
 
-from src.common.utils import requires_access_level, Role
-from src.common.utils import get_analytics
+from src.common.utils import requires_access_level, Role, get_db, pretty_title, get_categories
+from src.common.users import get_user_names
+from src.analytics.timeseries import get_analytics, get_view_rankings
 
 analytics_bp = Blueprint('analytics_bp', __name__,
                          template_folder='./templates')
@@ -18,4 +19,24 @@ def analytics():
     # then, different charts may be plotted together with a common x axis
     visits_json = get_analytics("keybase:visits".format(id), 86400000, 2592000000)
     authentications_json = get_analytics("keybase:authentications".format(id), 86400000, 2592000000)
-    return render_template('analytics.html', visits_json=visits_json, authentications_json=authentications_json)
+
+    # Most viewed documents, and views by category and by author, over the last 30 days
+    rankings = get_view_rankings(2592000000)
+
+    documents = []
+    if len(rankings['pk']):
+        names = get_db().json().mget(["keybase:json:{}".format(pk) for pk, _ in rankings['pk']], '$.currentversion.name')
+        for (pk, views), name in zip(rankings['pk'], names):
+            # Documents deleted after being viewed have no name
+            if name:
+                documents.append({'pk': pk, 'name': name[0], 'pretty': pretty_title(name[0]), 'views': views})
+
+    categories = get_categories()
+    category_views = [{'name': categories.get(category, 'Uncategorized'), 'views': views}
+                      for category, views in rankings['category']]
+
+    authors = get_user_names([author for author, _ in rankings['author']])
+    author_views = [{'name': authors[author] or author, 'views': views} for author, views in rankings['author']]
+
+    return render_template('analytics.html', visits_json=visits_json, authentications_json=authentications_json,
+                           documents=documents, category_views=category_views, author_views=author_views)
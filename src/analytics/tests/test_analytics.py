@@ -0,0 +1,194 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from flask import session
+
+from src.analytics.timeseries import count_event, get_analytics, get_view_rankings, backfill_rankings, \
+    document_labels, views_key, _analytics, _created
+from src.analytics.trending import trending_args, trending_key, trending_script, get_trending, WINDOWS, _trending
+from src.analytics.views import record_view
+from src.analytics.visitors import visitor_id, unique_key, get_unique_visitors, delete_visitors, _visitors
+from src.common.utils import get_db
+
+
+def test_analytics_visitor_id_anonymous(create_flask_app):
+    get_db().flushall()
+    ids = []
+    for agent in ("agent-a", "agent-a", "agent-b"):
+        with create_flask_app.test_request_context(headers={'User-Agent': agent},
+                                                   environ_base={'REMOTE_ADDR': "10.0.0.1"}):
+            ids.append(visitor_id())
+            # Nothing is stored for anonymous viewers
+            assert not session.modified
+    assert ids[0] == ids[1] != ids[2]
+    assert len(list(get_db().scan_iter("keybase:session:*"))) == 0
+
+
+def test_analytics_unique_visitors_and_rollups(create_flask_app):
+    get_db().flushall()
+    pk = "uniqtestpk"
+    today = datetime.utcnow().date()
+    last_monday = today - timedelta(days=today.weekday() + 7)
+    last_first = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+    visits = {today: ["a", "b"],
+              last_monday: ["x", "y"],
+              last_monday + timedelta(days=3): ["y", "z"],
+              last_first: ["p"],
+              last_first + timedelta(days=9): ["q", "p"]}
+    for day, visitors in visits.items():
+        get_db().pfadd(unique_key(pk, day.strftime('%Y%m%d')), *visitors)
+
+    def members(start, end):
+        return len({visitor for day, visitors in visits.items() if start <= day < end for visitor in visitors})
+
+    _visitors.pop(pk)
+    counts = get_unique_visitors(pk)
+    assert counts['today'] == 2
+    assert counts['last_week'] == 3
+    assert counts['last_month'] == members(last_first, today.replace(day=1))
+
+    # The closed periods are merged once and kept with a TTL
+    week = unique_key(pk, 'w' + last_monday.strftime('%Y%m%d'))
+    month = unique_key(pk, 'm' + last_first.strftime('%Y%m'))
+    assert get_db().ttl(week) > 0 and get_db().ttl(month) > 0
+    get_db().delete(unique_key(pk, last_monday.strftime('%Y%m%d')))
+    _visitors.pop(pk)
+    assert get_unique_visitors(pk)['last_week'] == 3
+
+    delete_visitors(pk)
+    assert list(get_db().scan_iter(unique_key(pk, '*'))) == []
+
+
+def test_analytics_read_from_compactions(create_flask_app):
+    get_db().flushall()
+    key = "keybase:visits"
+    _created.pop(key)
+    count_event(key, type='visits')
+    # Older than the raw retention, only in the daily compaction
+    now = round(time.time() * 1000)
+    get_db().ts().add(key + ":daily", now - 5 * 86400000, 7)
+    _analytics.clear()
+    points = json.loads(get_analytics(key, 86400000, 2592000000))
+    assert 7 in points['value']
+    assert sum(points['value']) == 8
+
+
+def test_analytics_series_of_previous_version_backfilled(create_flask_app):
+    get_db().flushall()
+    key = "keybase:authentications"
+    now = round(time.time() * 1000)
+    # No retention, no rules, events of the last days
+    get_db().ts().create(key, duplicate_policy='sum')
+    for days in (3, 3, 4):
+        get_db().ts().add(key, now - days * 86400000, 1, duplicate_policy='sum')
+    _created.pop(key)
+    count_event(key, type='authentications')
+    assert len(get_db().ts().info(key).rules) == 2
+    _analytics.clear()
+    points = json.loads(get_analytics(key, 86400000, 2592000000))
+    assert sum(points['value']) == 4
+    assert 2 in points['value']
+
+
+def test_analytics_view_rankings(create_flask_app):
+    get_db().flushall()
+    views = {"rankpk1": ("cat1", "alice", 3), "rankpk2": ("cat2", "bob", 1), "rankpk3": ("cat1", "bob", 2)}
+    for pk, (category, author, count) in views.items():
+        for _ in range(count):
+            record_view(pk, document_labels(pk, category, 'internal', author))
+    # A view of the previous day counts in the period
+    yesterday = (datetime.utcnow().date() - timedelta(days=1)).strftime('%Y%m%d')
+    get_db().zincrby(views_key('pk', yesterday), 5, "rankpk2")
+
+    _analytics.clear()
+    rankings = get_view_rankings(2592000000, count=2)
+    assert rankings['pk'] == [("rankpk2", 6), ("rankpk1", 3)]
+    assert rankings['category'] == [("cat1", 5), ("cat2", 1)]
+    assert sorted(rankings['author']) == [("alice", 3), ("bob", 3)]
+    # Only the ranking of today
+    _analytics.clear()
+    assert get_view_rankings(86400000)['pk'][0] == ("rankpk1", 3)
+    assert not list(get_db().scan_iter(views_key('*', 'union')))
+
+
+def test_analytics_backfill_rankings(create_flask_app):
+    get_db().flushall()
+    now = round(time.time() * 1000)
+    day = now - now % 86400000 - 2 * 86400000
+    for pk, category, views in (("fillpk1", "cat1", 4), ("fillpk2", "cat1", 2)):
+        key = "keybase:docview:{}:daily".format(pk)
+        get_db().ts().create(key, labels=dict(document_labels(pk, category, 'internal', 'alice'),
+                                              granularity='daily'))
+        get_db().ts().add(key, day, views)
+
+    assert backfill_rankings() == 4
+    assert backfill_rankings() == 4
+    name = datetime.utcfromtimestamp(day // 1000).strftime('%Y%m%d')
+    assert get_db().zscore(views_key('pk', name), "fillpk1") == 4
+    assert get_db().zscore(views_key('category', name), "cat1") == 6
+    assert get_db().ttl(views_key('author', name)) > 0
+
+
+def view_at(pk, audience, now, keep=100):
+    keys, args = trending_args(pk, audience)
+    args[1], args[2] = now, keep
+    trending_script(keys=keys, args=args)
+
+
+def test_analytics_trending_decay(create_flask_app):
+    get_db().flushall()
+    now = time.time()
+    for _ in range(3):
+        view_at("olderpk", "internal", now)
+    for _ in range(2):
+        view_at("newerpk", "internal", now + 86400)
+
+    def ranking(window):
+        return get_db().zrevrange(trending_key("internal", window), 0, -1)
+
+    # A day later, two views weigh more than three in the short windows, not over a week
+    assert ranking('1h') == ranking('24h') == ["newerpk", "olderpk"]
+    assert ranking('7d') == ["olderpk", "newerpk"]
+    assert not get_db().exists(trending_key("public", "24h"))
+
+    # Far from the epoch, the set is rescaled and the epoch moved, the order is the same
+    view_at("olderpk", "internal", now + 40 * 3600)
+    epoch = float(get_db().hget("keybase:trending:epochs", trending_key("internal", "1h")))
+    assert abs(epoch - (now + 40 * 3600)) < 1
+    assert ranking('1h') == ["olderpk", "newerpk"]
+    assert get_db().zscore(trending_key("internal", "1h"), "olderpk") < 10
+
+
+def test_analytics_trending_trimmed(create_flask_app):
+    get_db().flushall()
+    now = time.time()
+    for n in range(5):
+        for _ in range(n + 1):
+            view_at("trimpk{}".format(n), "public", now, keep=2)
+    for window in WINDOWS:
+        members = get_db().zrevrange(trending_key("public", window), 0, -1)
+        assert len(members) <= 4
+        assert members[:2] == ["trimpk4", "trimpk3"]
+
+
+def test_analytics_trending_documents(create_flask_app):
+    get_db().flushall()
+    documents = {"trendpub": ("Public%20doc", "published", "public"),
+                 "trendint": ("Internal doc", "published", "internal"),
+                 "trenddraft": ("Draft doc", "draft", "public")}
+    for pk, (name, state, privacy) in documents.items():
+        get_db().json().set("keybase:json:{}".format(pk), "$", {'currentversion': {'name': name}, 'state': state,
+                                                                 'privacy': privacy})
+        for audience in ("public", "internal"):
+            record_view(pk, document_labels(pk, None, privacy, None), audience=audience)
+
+    _trending.clear()
+    assert get_trending('public') == [{'pk': "trendpub", 'name': "Public doc", 'pretty': "public-doc"}]
+    assert [document['pk'] for document in get_trending('internal', count=5)] in (["trendpub", "trendint"],
+                                                                                 ["trendint", "trendpub"])
+    # Cached for the templates, the document made public shows once the entry expires
+    get_db().json().set("keybase:json:trendint", "$.privacy", "public")
+    assert len(get_trending('public')) == 1
+    _trending.clear()
+    assert len(get_trending('public')) == 2
@@ -0,0 +1,247 @@
+import json
+import math
+import time
+from datetime import datetime, timedelta
+
+from redis.exceptions import ResponseError
+
+from src.common.cache import TTLCache
+from src.common.config import CFG_TS_RAW_RETENTION, CFG_TS_HOURLY_RETENTION, CFG_TS_DAILY_RETENTION, \
+    CFG_ANALYTICS_CACHE_TTL
+from src.common.utils import get_db
+
+# Every counter (keybase:visits, keybase:authentications, keybase:docview:<pk>) is a raw series with a short
+# retention, compacted by Redis into the series <key>:hourly and <key>:daily, which keep one sum per bucket.
+# Analytics read the compactions, so the cost of a chart depends on the number of buckets, not of events.
+COMPACTIONS = (('hourly', 3600000, CFG_TS_HOURLY_RETENTION),
+               ('daily', 86400000, CFG_TS_DAILY_RETENTION))
+
+# Views are also counted per day by document, category and author in the sorted sets keybase:views:<label>:<yyyymmdd>,
+# so the rankings of a period are the union of a few days, whatever the number of documents.
+# They are kept RANKING_DAYS days, the longest period that can be ranked.
+RANKINGS = ('pk', 'category', 'author')
+RANKING_DAYS = 31
+
+# Series already created by this process, so the creation is not attempted on every event
+_created = TTLCache(maxsize=100000, ttl=86400)
+_analytics = TTLCache(maxsize=4096, ttl=CFG_ANALYTICS_CACHE_TTL)
+
+
+def document_labels(pk, category, privacy, author):
+    # Label values cannot be empty
+    return {'type': 'docview',
+            'pk': pk,
+            'category': category or 'none',
+            'privacy': privacy or 'internal',
+            'author': author or 'none'}
+
+
+def series_labels(key):
+    # keybase:<type> or keybase:docview:<pk>
+    parts = key.split(':')
+    if parts[1] != 'docview':
+        return {'type': parts[1]}
+
+    document = get_db().json().get("keybase:json:{}".format(parts[2]), '$.category', '$.privacy', '$.author')
+    if document is None:
+        return document_labels(parts[2], None, None, None)
+    return document_labels(parts[2], document['$.category'][0], document['$.privacy'][0], document['$.author'][0])
+
+
+def create_series(key, labels):
+    try:
+        get_db().ts().create(key, retention_msecs=CFG_TS_RAW_RETENTION, labels=dict(labels, granularity='raw'),
+                             duplicate_policy='sum')
+    except ResponseError:
+        # The series exists. Created by a previous version, it has no rules: it is migrated, so that the compactions
+        # are backfilled from its events before the charts read them, by one worker
+        if not get_db().ts().info(key).rules and get_db().set("keybase:tsmigrate:" + key, 1, nx=True, ex=300):
+            migrate_series(key)
+        return
+
+    # Creating a series or a rule that already exists fails harmlessly, so the errors are ignored
+    pipeline = get_db().ts().pipeline(transaction=False)
+    for granularity, bucket, retention in COMPACTIONS:
+        dest = "{}:{}".format(key, granularity)
+        pipeline.create(dest, retention_msecs=retention, labels=dict(labels, granularity=granularity))
+        pipeline.createrule(key, dest, 'sum', bucket)
+    pipeline.execute(raise_on_error=False)
+
+
+def add_event(pipeline, key, labels):
+    # Queue one event in the pipeline of the caller, creating the series the first time this process sees it
+    if key not in _created:
+        create_series(key, labels)
+        _created.set(key, True)
+    pipeline.add(key, "*", 1, duplicate_policy='sum')
+
+
+def count_event(key, **labels):
+    pipeline = get_db().ts().pipeline(transaction=False)
+    add_event(pipeline, key, labels)
+    pipeline.execute()
+
+
+def relabel_series(key, labels):
+    # TS.ALTER replaces all the labels, of the raw series and of the compactions
+    pipeline = get_db().ts().pipeline(transaction=False)
+    pipeline.alter(key, labels=dict(labels, granularity='raw'))
+    for granularity, bucket, retention in COMPACTIONS:
+        pipeline.alter("{}:{}".format(key, granularity), labels=dict(labels, granularity=granularity))
+    # The series may not exist yet, if the document was never viewed
+    pipeline.execute(raise_on_error=False)
+
+
+def delete_series(key):
+    get_db().delete(key, *["{}:{}".format(key, granularity) for granularity, _, _ in COMPACTIONS])
+    _created.pop(key)
+
+
+def get_analytics(timeseries, bucket, duration):
+    points = _analytics.get((timeseries, bucket, duration))
+    if points is not None:
+        return points
+
+    ts = round(time.time() * 1000)
+    ts0 = ts - duration
+
+    # Read the coarsest compaction the bucket is a multiple of; LATEST includes the bucket still open
+    source = timeseries
+    for granularity, size, retention in reversed(COMPACTIONS):
+        if bucket % size == 0:
+            source = "{}:{}".format(timeseries, granularity)
+            break
+
+    try:
+        data_ts = get_db().ts().range(source, from_time=ts0, to_time=ts, aggregation_type='sum',
+                                      bucket_size_msec=bucket, latest=True)
+    except ResponseError:
+        # Series not migrated yet, or no event recorded so far
+        try:
+            data_ts = get_db().ts().range(timeseries, from_time=ts0, to_time=ts, aggregation_type='sum',
+                                          bucket_size_msec=bucket)
+        except ResponseError:
+            data_ts = []
+
+    data_labels = [datetime.utcfromtimestamp(int(x[0] / 1000)).strftime('%b %d') for x in data_ts]
+    data = [x[1] for x in data_ts]
+    data_graph = {'labels': data_labels, 'value': data}
+    points = json.dumps(data_graph)
+    _analytics.set((timeseries, bucket, duration), points)
+    return points
+
+
+def views_key(label, day):
+    return "keybase:views:{}:{}".format(label, day)
+
+
+def add_ranked_view(pipeline, labels):
+    # Queue the view of a document, with the labels of document_labels, in the pipeline of the caller
+    day = datetime.utcnow().strftime('%Y%m%d')
+    for label in RANKINGS:
+        pipeline.zincrby(views_key(label, day), 1, labels[label])
+        pipeline.expire(views_key(label, day), (RANKING_DAYS + 1) * 86400)
+
+
+def get_view_rankings(duration, count=10):
+    # Views per document, category and author over the last days of duration milliseconds, today included.
+    # Each ranking is the union of the days, stored and read in the same transaction, so only the top is returned;
+    # the three rankings share one round trip.
+    rankings = _analytics.get(('rankings', duration, count))
+    if rankings is not None:
+        return rankings
+
+    today = datetime.utcnow().date()
+    days = [(today - timedelta(days=i)).strftime('%Y%m%d')
+            for i in range(min(math.ceil(duration / 86400000), RANKING_DAYS))]
+    pipeline = get_db().pipeline(transaction=True)
+    for label in RANKINGS:
+        union = views_key(label, 'union')
+        pipeline.zunionstore(union, [views_key(label, day) for day in days])
+        pipeline.zrevrange(union, 0, count - 1, withscores=True)
+        pipeline.delete(union)
+    results = pipeline.execute()
+
+    rankings = {label: [(member, int(score)) for member, score in results[3 * i + 1]]
+                for i, label in enumerate(RANKINGS)}
+    _analytics.set(('rankings', duration, count), rankings)
+    return rankings
+
+
+def backfill_rankings():
+    # Views of the days before the rankings were kept, from the daily compactions of the documents.
+    # The totals of the closed days replace the counts, so running it again changes nothing.
+    now = round(time.time() * 1000)
+    today = now - now % 86400000
+    series = get_db().ts().mrange(today - RANKING_DAYS * 86400000, today - 1, ['type=docview', 'granularity=daily'],
+                                  with_labels=True)
+    totals = {}
+    for item in series:
+        for labels, samples in item.values():
+            for timestamp, value in samples:
+                day = datetime.utcfromtimestamp(timestamp // 1000).strftime('%Y%m%d')
+                for label in RANKINGS:
+                    member = (views_key(label, day), labels[label])
+                    totals[member] = totals.get(member, 0) + int(value)
+
+    pipeline = get_db().pipeline(transaction=False)
+    for (key, member), views in totals.items():
+        pipeline.zadd(key, {member: views})
+        pipeline.expire(key, (RANKING_DAYS + 1) * 86400)
+    pipeline.execute()
+    return len(totals)
+
+
+def migrate_series(key):
+    labels = series_labels(key)
+    rules = [rule[0] for rule in get_db().ts().info(key).rules]
+    now = round(time.time() * 1000)
+
+    for granularity, bucket, retention in COMPACTIONS:
+        dest = "{}:{}".format(key, granularity)
+        try:
+            get_db().ts().create(dest, retention_msecs=retention, labels=dict(labels, granularity=granularity))
+        except ResponseError:
+            get_db().ts().alter(dest, retention_msecs=retention, labels=dict(labels, granularity=granularity))
+
+        if dest not in rules:
+            try:
+                get_db().ts().createrule(key, dest, 'sum', bucket)
+            except ResponseError:
+                # Created meanwhile by another worker
+                pass
+
+        # Rules only compact new samples: backfill the buckets closed before the compaction started.
+        # Samples of the bucket open when the rule was created, but added before it, are not compacted.
+        first = get_db().ts().info(dest).first_timestamp
+        end = first if first else now - now % bucket
+        history = get_db().ts().range(key, 0, end - 1, aggregation_type='sum', bucket_size_msec=bucket)
+        for start in range(0, len(history), 1000):
+            get_db().ts().madd([(dest, t, v) for t, v in history[start:start + 1000]])
+
+    # Only now the history is compacted, the raw series can be trimmed
+    get_db().ts().alter(key, retention_msecs=CFG_TS_RAW_RETENTION, labels=dict(labels, granularity='raw'),
+                        duplicate_policy='sum')
+
+
+def migrate():
+    # Add retention, labels and compactions to the series created by previous versions
+    cursor = 0
+    migrated = 0
+    while True:
+        cursor, keys = get_db().scan(cursor, match="keybase:*", count=500, _type="TSDB-TYPE")
+        for key in keys:
+            if key.split(':')[1] in ('visits', 'authentications', 'docview') and \
+                    key.rsplit(':', 1)[-1] not in [granularity for granularity, _, _ in COMPACTIONS]:
+                migrate_series(key)
+                migrated += 1
+        if cursor == 0:
+            break
+    return migrated
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.analytics.timeseries
+    print("Migrated {} time series".format(migrate()))
+    print("Backfilled {} daily rankings".format(backfill_rankings()))
@@ -0,0 +1,86 @@
+import time
+import urllib.parse
+
+from src.common.cache import TTLCache
+from src.common.config import CFG_TRENDING_SIZE, CFG_TRENDING_CACHE_TTL
+from src.common.utils import get_db, pretty_title
+
+# Trending documents are kept in time-decayed sorted sets, one per audience and window.
+# A view adds exp((now - epoch) / window) to the score of the document (forward decay), so that older views weigh
+# exponentially less than recent ones without ever rewriting the other members. When the increments grow too
+# large, the whole set is rescaled and the epoch moved forward. Only the top CFG_TRENDING_SIZE members are kept,
+# so the memory does not depend on the number of documents.
+WINDOWS = {'1h': 3600, '24h': 86400, '7d': 604800}
+AUDIENCES = ('internal', 'public')
+
+# KEYS[1] is the hash of the epochs, KEYS[2..] the sorted sets
+# ARGV[1] is the document, ARGV[2] the current time, ARGV[3] the number of members to keep, ARGV[4..] the windows
+TRENDING_LUA = """
+local now = tonumber(ARGV[2])
+local keep = tonumber(ARGV[3])
+for i = 2, #KEYS do
+    local window = tonumber(ARGV[i + 2])
+    local epoch = tonumber(redis.call('HGET', KEYS[1], KEYS[i]))
+    if epoch == nil then
+        epoch = now
+        redis.call('HSET', KEYS[1], KEYS[i], epoch)
+    elseif (now - epoch) / window > 30 then
+        redis.call('ZUNIONSTORE', KEYS[i], 1, KEYS[i], 'WEIGHTS', tostring(math.exp((epoch - now) / window)))
+        epoch = now
+        redis.call('HSET', KEYS[1], KEYS[i], epoch)
+    end
+    redis.call('ZINCRBY', KEYS[i], tostring(math.exp((now - epoch) / window)), ARGV[1])
+    if redis.call('ZCARD', KEYS[i]) > 2 * keep then
+        redis.call('ZREMRANGEBYRANK', KEYS[i], 0, -keep - 1)
+    end
+end
+return 1
+"""
+trending_script = get_db().register_script(TRENDING_LUA)
+
+_trending = TTLCache(maxsize=64, ttl=CFG_TRENDING_CACHE_TTL)
+
+
+def trending_key(audience, window):
+    return "keybase:trending:{}:{}".format(audience, window)
+
+
+def trending_args(pk, audience):
+    keys = ["keybase:trending:epochs"] + [trending_key(audience, window) for window in WINDOWS]
+    args = [pk, time.time(), CFG_TRENDING_SIZE] + list(WINDOWS.values())
+    return keys, args
+
+
+def add_view(pipeline, pk, audience):
+    # Queue the view in the pipeline of the caller, which loads the script if the server does not have it
+    keys, args = trending_args(pk, audience)
+    trending_script(keys=keys, args=args, client=pipeline)
+
+
+def get_trending(audience='public', window='24h', count=5):
+    # Read API for the templates: [{'pk': ..., 'name': ..., 'pretty': ...}], cached for a few seconds
+    documents = _trending.get((audience, window, count))
+    if documents is not None:
+        return documents
+
+    # Read more than needed, documents may have been unpublished or made internal since they were viewed
+    pks = get_db().zrevrange(trending_key(audience, window), 0, 2 * count - 1)
+    documents = []
+    if len(pks):
+        keys = ["keybase:json:{}".format(pk) for pk in pks]
+        pipeline = get_db().json().pipeline(transaction=False)
+        pipeline.mget(keys, '$.currentversion.name')
+        pipeline.mget(keys, '$.state')
+        pipeline.mget(keys, '$.privacy')
+        for pk, name, state, privacy in zip(pks, *pipeline.execute()):
+            if not name or state[0] not in ('published', 'review'):
+                continue
+            if audience == 'public' and privacy[0] != 'public':
+                continue
+            name = urllib.parse.unquote(name[0])
+            documents.append({'pk': pk, 'name': name, 'pretty': pretty_title(name)})
+            if len(documents) == count:
+                break
+
+    _trending.set((audience, window, count), documents)
+    return documents
@@ -0,0 +1,19 @@
+from src.analytics.timeseries import add_event, add_ranked_view
+from src.analytics.trending import add_view
+from src.analytics.visitors import add_visitor
+from src.common.utils import get_db
+
+
+def record_view(pk, labels, audience=None, visitor=None):
+    # All the writes caused by a document view share one round trip.
+    # The audience (internal or public) is given for the views that count for trending documents,
+    # the visitor (see visitor_id) for the distinct viewers.
+    pipeline = get_db().ts().pipeline(transaction=False)
+    add_event(pipeline, "keybase:docview:{}".format(pk), labels)
+    add_ranked_view(pipeline, labels)
+    if visitor is not None:
+        add_visitor(pipeline, pk, visitor)
+    if audience is not None:
+        add_view(pipeline, pk, audience)
+
+    pipeline.execute()
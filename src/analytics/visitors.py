@@ -0,0 +1,131 @@
+import hashlib
+import hmac
+from datetime import datetime, timedelta
+
+from flask import current_app, request
+from flask_login import current_user
+
+from src.common.cache import TTLCache
+from src.common.config import CFG_UNIQUE_RETENTION, CFG_ANALYTICS_CACHE_TTL
+from src.common.session import app_secret_key
+from src.common.utils import get_db
+
+# Distinct viewers of a document are counted in one HyperLogLog per document and day, keybase:uniq:<pk>:<yyyymmdd>.
+# A HyperLogLog takes at most 12 KB whatever the number of viewers (less while it is sparse), with a 0.81% error.
+# Weeks and months are the union of the days, merged with PFMERGE; closed periods never change, so they are
+# merged once into keybase:uniq:<pk>:w<yyyymmdd> (the monday) and keybase:uniq:<pk>:m<yyyymm> and kept as well.
+RETENTION = CFG_UNIQUE_RETENTION * 86400
+
+# KEYS[1] is the HyperLogLog of the period, KEYS[2..] those of its days, ARGV[1] the retention in seconds
+# Merged the first time only, the count of the period is returned
+ROLLUP_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('PFMERGE', unpack(KEYS))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return redis.call('PFCOUNT', KEYS[1])
+"""
+rollup_script = get_db().register_script(ROLLUP_LUA)
+
+_visitors = TTLCache(maxsize=4096, ttl=CFG_ANALYTICS_CACHE_TTL)
+
+
+def visitor_id():
+    # The user, or for anonymous viewers of the portal a keyed hash of their address and browser: no cookie and no
+    # session are created for them, crawlers included
+    if current_user.is_authenticated:
+        return current_user.id
+    client = "{}|{}".format(request.remote_addr, request.headers.get('User-Agent', ''))
+    return hmac.new(str(app_secret_key(current_app)).encode(), client.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def unique_key(pk, period):
+    return "keybase:uniq:{}:{}".format(pk, period)
+
+
+def add_visitor(pipeline, pk, visitor):
+    # Queue the visitor in the pipeline of the caller
+    key = unique_key(pk, datetime.utcnow().strftime('%Y%m%d'))
+    pipeline.pfadd(key, visitor)
+    pipeline.expire(key, RETENTION)
+
+
+def rollup(pipeline, pk, period, days):
+    # Queue the count of a closed period, its days merged once into its own HyperLogLog
+    keys = [unique_key(pk, period)] + [unique_key(pk, day.strftime('%Y%m%d')) for day in days]
+    rollup_script(keys=keys, args=[RETENTION], client=pipeline)
+
+
+def get_unique_visitors(pk):
+    # Distinct viewers of the document for the current day, week and month, and for the last complete ones
+    visitors = _visitors.get(pk)
+    if visitors is not None:
+        return visitors
+
+    today = datetime.utcnow().date()
+    monday = today - timedelta(days=today.weekday())
+    first = today.replace(day=1)
+    last_monday = monday - timedelta(days=7)
+    last_first = (first - timedelta(days=1)).replace(day=1)
+
+    def days(start, end):
+        return [start + timedelta(days=n) for n in range((end - start).days)]
+
+    def keys(start, end):
+        return [unique_key(pk, day.strftime('%Y%m%d')) for day in days(start, end)]
+
+    # PFCOUNT of several keys counts their union without storing it, enough for the periods still open
+    pipeline = get_db().pipeline(transaction=False)
+    pipeline.pfcount(*keys(today, today + timedelta(days=1)))
+    pipeline.pfcount(*keys(monday, today + timedelta(days=1)))
+    pipeline.pfcount(*keys(first, today + timedelta(days=1)))
+    rollup(pipeline, pk, 'w' + last_monday.strftime('%Y%m%d'), days(last_monday, monday))
+    rollup(pipeline, pk, 'm' + last_first.strftime('%Y%m'), days(last_first, first))
+    visitors = dict(zip(('today', 'week', 'month', 'last_week', 'last_month'), pipeline.execute()))
+
+    _visitors.set(pk, visitors)
+    return visitors
+
+
+def retained_periods(today=None):
+    # Days, weeks and months whose HyperLogLogs may still exist
+    today = today or datetime.utcnow().date()
+    days = [today - timedelta(days=n) for n in range(CFG_UNIQUE_RETENTION + 1)]
+    weeks = {day - timedelta(days=day.weekday()) for day in days}
+    months = {day.replace(day=1) for day in days}
+    return [day.strftime('%Y%m%d') for day in days] + \
+        ['w' + monday.strftime('%Y%m%d') for monday in sorted(weeks)] + \
+        ['m' + first.strftime('%Y%m') for first in sorted(months)]
+
+
+def delete_visitors(pk):
+    # The keys are known, no need to scan the keyspace
+    get_db().delete(*[unique_key(pk, period) for period in retained_periods()])
+    _visitors.pop(pk)
+
+
+def sweep():
+    # The HyperLogLogs expire on their own; remove those left without a TTL or belonging to deleted documents
+    cursor = 0
+    swept = 0
+    while True:
+        cursor, keys = get_db().scan(cursor, match=unique_key('*', '*'), count=1000, _type='string')
+        if len(keys):
+            pipeline = get_db().pipeline(transaction=False)
+            for key in keys:
+                pipeline.ttl(key)
+                pipeline.exists("keybase:json:{}".format(key.split(':')[2]))
+            results = pipeline.execute()
+            expired = [key for key, ttl, exists in zip(keys, results[0::2], results[1::2]) if ttl == -1 or not exists]
+            if len(expired):
+                get_db().delete(*expired)
+                swept += len(expired)
+        if cursor == 0:
+            break
+    return swept
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.analytics.visitors
+    print("Swept {} unique viewers counters".format(sweep()))
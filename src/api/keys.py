@@ -0,0 +1,129 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+from src.common.config import CFG_API_USAGE_FLUSH
+from src.common.users import get_user, cache_user, invalidate_user
+from src.common.utils import get_db
+
+# API keys: the client sends the id of the key in X-Api-Key and its secret in X-Api-Secret-Key.
+# Keys are stored in keybase:apikey:<id> with a salted SHA-256 of the secret, never the secret, and listed in the set
+# keybase:apikeys. Secrets created here are 256 random bits, so a fast hash is enough: no dictionary attack applies.
+# Verified keys are cached by every worker like the users (see src/common/users.py), and a revocation is published
+# so that all the workers forget the key at once. Requests per key are counted in memory and added to the hash of the
+# key every CFG_API_USAGE_FLUSH seconds.
+# Keys of previous versions, in plain text in the hash keybase:api:token, are moved to the new format when first used.
+# Their secrets were chosen by hand and keep whatever entropy they had, so a fast hash does not protect them: they are
+# flagged legacy, and listed as to be rotated.
+PREFIX = "keybase:apikey:"
+KEYS = "keybase:apikeys"
+LEGACY = "keybase:api:token"
+
+
+def hash_secret(salt, secret):
+    return hashlib.sha256((salt + secret).encode('utf-8')).hexdigest()
+
+
+def key_fields(name, owner, secret, legacy=False):
+    salt = secrets.token_hex(16)
+    return {'name': name, 'owner': owner, 'salt': salt, 'hash': hash_secret(salt, secret), 'revoked': 0,
+            'created': time.time(), 'requests': 0, 'last_used': 0, 'legacy': int(legacy)}
+
+
+def create_key(name, owner):
+    # (id, secret), the secret is only known now
+    key_id = secrets.token_hex(8)
+    secret = secrets.token_urlsafe(32)
+    pipeline = get_db().pipeline(transaction=True)
+    pipeline.hset(PREFIX + key_id, mapping=key_fields(name, owner, secret))
+    pipeline.sadd(KEYS, key_id)
+    pipeline.execute()
+    return key_id, secret
+
+
+def migrate_legacy(key_id, secret):
+    fields = key_fields("Migrated key", "", secret, legacy=True)
+    pipeline = get_db().pipeline(transaction=True)
+    pipeline.hset(PREFIX + key_id, mapping=fields)
+    pipeline.sadd(KEYS, key_id)
+    pipeline.hdel(LEGACY, key_id)
+    pipeline.execute()
+    return cache_user(PREFIX + key_id, {k: str(v) for k, v in fields.items()})
+
+
+def revoke_key(key_id):
+    if not get_db().exists(PREFIX + key_id):
+        return False
+    get_db().hset(PREFIX + key_id, mapping={'revoked': 1, 'revoked_at': time.time()})
+    invalidate_user(PREFIX + key_id)
+    return True
+
+
+def verify_key(key_id, secret):
+    # True if the secret is the one of the key, and the key is not revoked
+    key = get_user(PREFIX + key_id, dict)
+    if key is None:
+        legacy = get_db().hget(LEGACY, key_id)
+        # Headers may carry any character, compare_digest only takes ASCII strings
+        if legacy is None or not hmac.compare_digest(legacy.encode('utf-8'), secret.encode('utf-8')):
+            return False
+        key = migrate_legacy(key_id, secret)
+    if key.get('revoked') == '1':
+        return False
+    if not hmac.compare_digest(hash_secret(key['salt'], secret).encode('utf-8'), key['hash'].encode('utf-8')):
+        return False
+    usage.add(key_id)
+    return True
+
+
+def get_keys():
+    key_ids = sorted(get_db().smembers(KEYS))
+    pipeline = get_db().pipeline(transaction=False)
+    for key_id in key_ids:
+        pipeline.hmget(PREFIX + key_id, 'name', 'owner', 'created', 'revoked', 'requests', 'last_used', 'legacy')
+    keys = []
+    for key_id, (name, owner, created, revoked, requests, last_used, legacy) in zip(key_ids, pipeline.execute()):
+        if name is not None:
+            keys.append({'id': key_id, 'name': name, 'owner': owner, 'created': float(created),
+                         'revoked': revoked == '1', 'requests': int(requests or 0),
+                         'last_used': float(last_used or 0), 'legacy': legacy == '1'})
+    return sorted(keys, key=lambda key: key['created'], reverse=True)
+
+
+class Usage:
+    """Requests per key since the last flush."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.flushed = time.monotonic()
+
+    def add(self, key_id):
+        with self.lock:
+            self.counts[key_id] = self.counts.get(key_id, 0) + 1
+            due = time.monotonic() - self.flushed > self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            self.flushed = time.monotonic()
+        if not counts:
+            return
+        now = time.time()
+        pipeline = get_db().pipeline(transaction=False)
+        for key_id, count in counts.items():
+            pipeline.hincrby(PREFIX + key_id, 'requests', count)
+            pipeline.hset(PREFIX + key_id, 'last_used', now)
+        try:
+            pipeline.execute()
+        except Exception:
+            # Usage must never fail a request, the counts of this interval are lost
+            pass
+
+
+usage = Usage(CFG_API_USAGE_FLUSH)
@@ -1,7 +1,15 @@
-from flask import Blueprint, Response, request, jsonify
+import itertools
+import json
+import time
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from functools import wraps
 
 from src.common.utils import get_db
+from src.common.archive import iter_range
+from src.api.keys import verify_key
+from src.common.ratelimit import admit_client, client_id
+from src.common.config import CFG_API_PAGE_SIZE, CFG_API_MAX_PAGE_SIZE, CFG_API_BLOCK_MS, CFG_API_STREAM_MS
 
 api_bp = Blueprint('api_bp', __name__)
 
@@ -12,20 +20,99 @@ def token_required(req):
         def decorated_function(*args, **kwargs):
             if "X-Api-Key" not in req.headers or "X-Api-Secret-Key" not in req.headers:
                 return Response(response="Missing tokens", status=401)
-            secret_token = get_db().hget("keybase:api:token", str(req.headers.get("X-Api-Key")))
-            if req.headers.get("X-Api-Secret-Key") != secret_token:
-                return Response(response="Unauthorized", status=403)
+            # Verified keys are cached, see src/api/keys.py
+            key_id = str(req.headers.get("X-Api-Key"))
+            if not verify_key(key_id, str(req.headers.get("X-Api-Secret-Key"))):
+                # Failed attempts are limited by address, whatever the key sent
+                return admit_client(client_id()) or Response(response="Unauthorized", status=403)
+            # Budget of the key, see src/common/ratelimit.py
+            limited = admit_client("key:" + key_id)
+            if limited is not None:
+                return limited
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
 
+def bounded_arg(name, default, highest):
+    # Integer argument within 1..highest: XREAD BLOCK 0 would wait forever, and a page needs at least one event
+    return max(1, min(request.args.get(name, default, type=int), highest))
+
+
+def last_event_id():
+    # Tail from the id given by the client, or from the last event in the stream
+    last = request.headers.get("Last-Event-ID") or request.args.get("last")
+    if last:
+        return last
+    entries = get_db().xrevrange("keybase:requests", count=1)
+    return entries[0][0] if len(entries) else "0-0"
+
+
 @api_bp.route('/api/events/', methods=['GET'])
 @token_required(request)
 def api_events():
     if not request.args.get("min") or not request.args.get("max"):
         return jsonify(response="Incomplete request"), 422
-    if request.args.get("min") and request.args.get("max"):
-        events = get_db().xrange("keybase:requests", request.args.get("min"), request.args.get("max"))
-        return jsonify(response="Range request completed", events=events), 200
 
+    # Old events are read from the archive, see src/services/archiver.py
+    if request.args.get("format") == "ndjson":
+        # The whole range, written as it is read
+        def generate():
+            for entry in iter_range("keybase:requests", request.args.get("min"), request.args.get("max")):
+                yield json.dumps(entry) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    # One page, the next one starts after the continuation id: min=<next>
+    count = bounded_arg("count", CFG_API_PAGE_SIZE, CFG_API_MAX_PAGE_SIZE)
+    events = list(itertools.islice(iter_range("keybase:requests", request.args.get("min"), request.args.get("max"),
+                                              batch=count + 1), count + 1))
+    following = None
+    if len(events) > count:
+        events = events[:count]
+        following = "({}".format(events[-1][0])
+    return jsonify(response="Range request completed", events=events, next=following), 200
+
+
+@api_bp.route('/api/events/tail', methods=['GET'])
+@token_required(request)
+def api_events_tail():
+    # Long polling: wait up to block milliseconds for events after last, then call again with last=<last>
+    last = last_event_id()
+    block = bounded_arg("block", CFG_API_BLOCK_MS, CFG_API_BLOCK_MS)
+    count = bounded_arg("count", CFG_API_PAGE_SIZE, CFG_API_MAX_PAGE_SIZE)
+    events = []
+    streams = get_db().xread({"keybase:requests": last}, count=count, block=block)
+    if streams:
+        events = [list(entry) for entry in streams[0][1]]
+        last = events[-1][0]
+    return jsonify(response="Tail request completed", events=events, last=last), 200
+
+
+@api_bp.route('/api/events/stream', methods=['GET'])
+@token_required(request)
+def api_events_stream():
+    # Server-sent events for at most CFG_API_STREAM_MS, so that a stream does not hold a sync worker until the worker
+    # timeout kills it; clients reconnect with the Last-Event-ID header and resume where they stopped
+    last = last_event_id()
+
+    def generate(last):
+        db = get_db()
+        end = time.monotonic() + CFG_API_STREAM_MS / 1000
+        # Reconnection delay of the client, in milliseconds
+        yield "retry: 1000\n\n"
+        while True:
+            remaining = round((end - time.monotonic()) * 1000)
+            if remaining <= 0:
+                return
+            streams = db.xread({"keybase:requests": last}, count=CFG_API_PAGE_SIZE,
+                               block=min(CFG_API_BLOCK_MS, remaining))
+            if not streams:
+                # Keep the connection alive through proxies
+                yield ": keepalive\n\n"
+                continue
+            for entry_id, fields in streams[0][1]:
+                yield "id: {}\ndata: {}\n\n".format(entry_id, json.dumps(fields))
+                last = entry_id
+
+    return Response(stream_with_context(generate(last)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
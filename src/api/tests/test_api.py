@@ -1,4 +1,9 @@
 import json
+import time
+import src.api.routes
+from src.api.keys import create_key, get_keys
+from src.common.utils import get_db
+from src.common.ratelimit import LIMITS
 
 
 def test_api_api_key_not_sent(test_client, create_token):
@@ -42,3 +47,148 @@ def test_api_all_events_all_data(test_client, user_auth, prepare_db, create_toke
     assert response.status_code == 200
     assert json.loads(response.data)['events'][0][1]['full_path'] == "/save?"
     assert json.loads(response.data)['events'][0][1]['user'] == "00000000000000000000"
+
+
+def test_api_events_paginated(test_client, create_token):
+    tokens = create_token
+    for n in range(3):
+        get_db().xadd("keybase:requests", {'full_path': "/doc/{}?".format(n), 'user': "00000000000000000000"})
+    response = test_client.get("/api/events/", headers=tokens, query_string={"min": "-", "max": "+", "count": 2})
+    assert response.status_code == 200
+    page = json.loads(response.data)
+    assert [event[1]['full_path'] for event in page['events']] == ["/doc/0?", "/doc/1?"]
+    assert page['next'].startswith("(")
+    response = test_client.get("/api/events/", headers=tokens, query_string={"min": page['next'], "max": "+", "count": 2})
+    page = json.loads(response.data)
+    assert [event[1]['full_path'] for event in page['events']] == ["/doc/2?"]
+    assert page['next'] is None
+
+
+def test_api_events_ndjson(test_client, create_token):
+    tokens = create_token
+    for n in range(3):
+        get_db().xadd("keybase:requests", {'full_path': "/doc/{}?".format(n), 'user': "00000000000000000000"})
+    response = test_client.get("/api/events/", headers=tokens, query_string={"min": "-", "max": "+", "format": "ndjson"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [event[1]['full_path'] for event in events] == ["/doc/0?", "/doc/1?", "/doc/2?"]
+
+
+def test_api_events_tail(test_client, create_token):
+    tokens = create_token
+    get_db().xadd("keybase:requests", {'full_path': "/doc/0?", 'user': "00000000000000000000"})
+    response = test_client.get("/api/events/tail", headers=tokens, query_string={"last": "0-0", "block": 10})
+    assert response.status_code == 200
+    tail = json.loads(response.data)
+    assert tail['events'][0][1]['full_path'] == "/doc/0?"
+    response = test_client.get("/api/events/tail", headers=tokens, query_string={"last": tail['last'], "block": 10})
+    assert json.loads(response.data)['events'] == []
+
+
+def test_api_events_count_bounds(test_client, create_token):
+    tokens = create_token
+    for n in range(3):
+        get_db().xadd("keybase:requests", {'full_path': "/doc/{}?".format(n), 'user': "00000000000000000000"})
+    for count in (0, -5):
+        response = test_client.get("/api/events/", headers=tokens, query_string={"min": "-", "max": "+", "count": count})
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert [event[1]['full_path'] for event in page['events']] == ["/doc/0?"]
+        assert page['next'].startswith("(")
+
+
+def test_api_events_tail_block_bounds(test_client, create_token):
+    # BLOCK 0 would wait forever, the shortest wait is 1 ms
+    tokens = create_token
+    for block in (0, -5):
+        start = time.monotonic()
+        response = test_client.get("/api/events/tail", headers=tokens,
+                                   query_string={"last": "$", "block": block, "count": 0})
+        assert response.status_code == 200
+        assert json.loads(response.data)['events'] == []
+        assert time.monotonic() - start < 1
+
+
+def test_api_events_stream_ends_and_resumes(test_client, create_token, monkeypatch):
+    tokens = create_token
+    monkeypatch.setattr(src.api.routes, "CFG_API_BLOCK_MS", 100)
+    monkeypatch.setattr(src.api.routes, "CFG_API_STREAM_MS", 300)
+    ids = [get_db().xadd("keybase:requests", {'full_path': "/doc/{}?".format(n), 'user': "00000000000000000000"})
+           for n in range(3)]
+
+    def events(response):
+        return [line[len("id: "):] for line in response.get_data(as_text=True).splitlines() if line.startswith("id: ")]
+
+    # The stream ends on its own, after the events and a few keepalives
+    start = time.monotonic()
+    response = test_client.get("/api/events/stream", headers=dict(tokens, **{'Last-Event-ID': "0-0"}))
+    assert response.status_code == 200
+    assert events(response) == ids
+    assert 0.3 <= time.monotonic() - start < 2
+
+    # The client reconnects with the last id it received
+    added = get_db().xadd("keybase:requests", {'full_path': "/doc/3?", 'user': "00000000000000000000"})
+    response = test_client.get("/api/events/stream", headers=dict(tokens, **{'Last-Event-ID': ids[1]}))
+    assert events(response) == [ids[2], added]
+
+
+def test_api_legacy_token_migrated(test_client, create_token):
+    tokens = create_token
+    response = test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+    assert response.status_code == 200
+    assert get_db().hget("keybase:api:token", tokens['X-Api-Key']) is None
+    assert get_db().hget("keybase:apikey:{}".format(tokens['X-Api-Key']), 'hash') is not None
+    assert tokens['X-Api-Secret-Key'] not in get_db().hvals("keybase:apikey:{}".format(tokens['X-Api-Key']))
+    response = test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+    assert response.status_code == 200
+
+
+def test_api_legacy_key_to_rotate(test_client, user_auth):
+    tokens = {'X-Api-Key': "43f34fwwf4wf4wfw", 'X-Api-Secret-Key': "4827fgyho83w4uyf2o834yfbwo"}
+    get_db().hset("keybase:api:token", mapping={tokens['X-Api-Key']: tokens['X-Api-Secret-Key']})
+    test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+    created, _ = create_key("New key", "test_username")
+    legacy = {key['id']: key['legacy'] for key in get_keys()}
+    assert legacy == {tokens['X-Api-Key']: True, created: False}
+
+    user_auth.set_group("admin")
+    page = test_client.get("/apikeys").get_data(as_text=True)
+    assert page.count(">Rotate</span>") == 1
+
+
+def test_api_non_ascii_secret_refused(test_client, create_token):
+    tokens = create_token
+    for key_id in (tokens['X-Api-Key'], "unknown"):
+        response = test_client.get("/api/events", headers={'X-Api-Key': key_id, 'X-Api-Secret-Key': "sécret"})
+        assert response.status_code == 403
+    # The legacy token is migrated, the secret is compared to the hash
+    response = test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+    assert response.status_code == 200
+    response = test_client.get("/api/events", headers={'X-Api-Key': tokens['X-Api-Key'], 'X-Api-Secret-Key': "sécret"})
+    assert response.status_code == 403
+
+
+def test_api_rate_limited(test_client, create_token, monkeypatch):
+    tokens = create_token
+    monkeypatch.setitem(LIMITS, 'api_bp.api_events', (0.1, 2))
+    for _ in range(2):
+        response = test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+        assert response.status_code == 200
+    response = test_client.get("/api/events", headers=tokens, query_string={"min": "-", "max": "+"})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_api_rate_limited_rotating_keys(test_client, create_token, monkeypatch):
+    # Unknown keys are limited by address, a new key on every request does not get a new budget
+    create_token
+    monkeypatch.setitem(LIMITS, 'api_bp.api_events', (0.1, 2))
+    statuses = []
+    for i in range(3):
+        response = test_client.get("/api/events", query_string={"min": "-", "max": "+"},
+                                   headers={'X-Api-Key': "random{}".format(i), 'X-Api-Secret-Key': "secret",
+                                            'X-Forwarded-For': "10.0.0.{}".format(i)})
+        statuses.append(response.status_code)
+    assert statuses == [403, 403, 429]
+    assert len(list(get_db().scan_iter("keybase:ratelimit:*"))) == 1
@@ -1,33 +1,122 @@
-import secrets
+import threading
+import time
 
-from flask import Flask, render_template
+from flask import Flask, render_template, request
 from flask_cors import CORS
 from datetime import datetime
 from flask_breadcrumbs import Breadcrumbs
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.exceptions import HTTPException
+from jinja2 import TemplateError
 import logging
 import redis
 
-from src.common.config import CFG_AUTHENTICATOR
-from src.common.utils import track_errors, get_db
+from src.common.config import CFG_AUTHENTICATOR, CFG_PROFILER, CFG_CPU_PROFILE_SAMPLE, CFG_CPU_PROFILE_THRESHOLD, \
+    CFG_SESSION_TTL, CFG_PROXY_COUNT
+from src.common.utils import track_errors
+from src.common.users import start_listener
+from src.analytics.trending import get_trending
+from src.common.metrics import MetricsMiddleware
+from src.common.indexes import create_indexes
+from src.common.session import RedisSessionInterface
+from src.common.ratelimit import admit, release
 
-from redis_om import (Migrator)
-from redis.commands.search.field import TextField, TagField, VectorField
-from redis.commands.search.indexDefinition import IndexDefinition
 
-# These 2 imports are needed for OM; if removed, OM won't create indexes
-from src.document.document import Document, Version, CurrentVersion
-from src.feedback.feedback import Feedback
+class Timer:
+    """Time spent by each phase of the startup."""
+
+    def __init__(self):
+        self.phases = []
+        self.start = self.last = time.perf_counter()
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        return "Started in {:.0f} ms: {}".format((self.last - self.start) * 1000, ", ".join(
+            "{} {:.0f} ms".format(name, duration * 1000) for name, duration in self.phases))
+
+
+class FirstRequest:
+    """Runs the function once in each process, before its first request."""
+
+    def __init__(self, function):
+        self.function = function
+        self.done = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        if self.done:
+            return None
+        with self.lock:
+            if not self.done:
+                # Run again by the next request if it fails
+                self.function()
+                self.done = True
+        return None
+
+
+def warmup(app):
+    # Compile the templates before the first request. With gunicorn --preload this runs once in the master, and the
+    # workers share the result
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateError as e:
+            app.logger.warning("Template {} not compiled: {}".format(name, e))
+
+
+def prepare(app):
+    # The work of the startup that needs Redis, by every worker before its first request: creating the application,
+    # and forking the workers from a preloaded master, do not depend on the database
+    create_indexes(app.logger)
+    # Cached users and categories are dropped when they change
+    start_listener()
 
 
 def create_app():
+    # Neither the imports nor the creation connect to the database, see prepare()
+    timer = Timer()
     app = Flask(__name__, template_folder="templates")
     Breadcrumbs(app=app)
-    app.config["SESSION_TYPE"] = "filesystem"
-    app.config.update({'SECRET_KEY': secrets.token_hex(64)})
+    # Sessions in Redis, valid in every worker, see src/common/session.py. The secret key is read on first use
+    app.config.update({'PERMANENT_SESSION_LIFETIME': CFG_SESSION_TTL})
+    app.session_interface = RedisSessionInterface()
     app.url_map.strict_slashes = False
     CORS(app)
 
+    # Latency, status and size of every request, see /metrics
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+    # Client address and scheme set by the trusted proxies only
+    if CFG_PROXY_COUNT:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=CFG_PROXY_COUNT, x_proto=CFG_PROXY_COUNT)
+
+    app.before_request(FirstRequest(lambda: prepare(app)))
+
+    @app.before_request
+    def label_request():
+        request.environ['keybase.endpoint'] = request.endpoint or 'none'
+
+    # Budgets per client of the expensive endpoints, and concurrency cap, see src/common/ratelimit.py
+    app.before_request(admit)
+    app.teardown_request(release)
+
+    # Redis commands of every request, see src/common/profiler.py
+    if CFG_PROFILER:
+        from src.common.profiler import start_profile, finish_profile
+        app.before_request(start_profile)
+        app.after_request(lambda response: finish_profile(response, app.logger))
+
+    # CPU profiles of a sample of the requests and of the slow ones, see src/common/cpuprofile.py
+    if CFG_CPU_PROFILE_SAMPLE or CFG_CPU_PROFILE_THRESHOLD:
+        from src.common.cpuprofile import start_cpu_profile, finish_cpu_profile
+        app.before_request(start_cpu_profile)
+        app.teardown_request(finish_cpu_profile)
+
+    timer.phase("setup")
+
     from .main import main_bp
     app.register_blueprint(main_bp)
 
@@ -65,35 +154,15 @@ def create_app():
         from .okta.routes import auth_bp
         app.register_blueprint(auth_bp)
 
+    timer.phase("blueprints")
+
     # Setup gunicorn logging
     gunicorn_error_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers.extend(gunicorn_error_logger.handlers)
     app.logger.setLevel(logging.INFO)
 
-    # Reading the list of indexes for eventual creation
-    indexes = get_db().execute_command("FT._LIST")
-
-    if "document_idx" not in indexes:
-        app.logger.info("The index document_idx does not exist, creating it")
-        Migrator().run()
-
-    if "feedback_idx" not in indexes:
-        app.logger.info("The index feedback_idx does not exist, creating it")
-        Migrator().run()
-
-    if "user_idx" not in indexes:
-        app.logger.info("The index user_idx does not exist, creating it")
-        index_def = IndexDefinition(prefix=["keybase:okta"])
-        schema = (TextField("name"), TagField("group"))
-        get_db().ft('user_idx').create_index(schema, definition=index_def)
-
-    if "vss_idx" not in indexes:
-        app.logger.info("The index vss_idx does not exist, creating it")
-        index_def = IndexDefinition(prefix=["keybase:vss"])
-        schema = (TagField("state"),
-                  TagField("privacy"),
-                  VectorField("content_embedding", "HNSW", {"TYPE": "FLOAT32", "DIM": 768, "DISTANCE_METRIC": "L2"}))
-        get_db().ft('vss_idx').create_index(schema, definition=index_def)
+    # Trending documents, for the templates
+    app.add_template_global(get_trending, 'trending')
 
     @app.template_filter('ctime')
     def timectime(s):
@@ -114,6 +183,10 @@ def create_app():
         track_errors(e)
         return render_template('500.html'), 500
 
+    warmup(app)
+    timer.phase("warmup")
+
+    app.logger.info(timer.report())
     app.logger.info('Redis Knowledge Base started!')
 
     return app
@@ -1,9 +1,6 @@
 from flask_login import UserMixin
-import time
 from src.common.utils import Role, get_db
-
-# Simulate user database
-USERS_DB = {}
+from src.common.users import get_user, invalidate_user
 
 
 class AuthUser(UserMixin):
@@ -17,20 +14,14 @@ class AuthUser(UserMixin):
         return {'name': self.name,
                 'email': self.email}.items()
 
-    @staticmethod
-    def get(user_id):
-        return USERS_DB.get(user_id)
-
     @staticmethod
     def exists(user_id):
         return get_db().exists("keybase:auth:{}".format(user_id))
 
     @staticmethod
     def get(username):
-        user = get_db().hgetall("keybase:auth:{}".format(username))
-        access_level = Role.group2role(user['group'])
-        USERS_DB[username] = AuthUser(username, user['name'], access_level)
-        return USERS_DB[username]
+        return get_user("keybase:auth:{}".format(username),
+                        lambda user: AuthUser(username, user.get('name'), Role.group2role(user.get('group'))))
 
     def set_role(self, access_level):
         self.access_level = access_level
@@ -38,6 +29,7 @@ class AuthUser(UserMixin):
     def set_group(self, group):
         self.access_level = Role.group2role(group)
         get_db().hset("keybase:auth:{}".format(self.id), mapping={"group": group})
+        invalidate_user("keybase:auth:{}".format(self.id))
 
     def get_role(self):
         return self.access_level
@@ -11,7 +11,10 @@ from redis.commands.search.indexDefinition import IndexDefinition
 from redis.commands.search.query import Query
 
 from src.auth.authuser import AuthUser
+from src.common.users import invalidate_user
+from src.common.session import rotate_session
 from src.common.utils import get_db, requires_access_level, Role, parse_query_string
+from src.analytics.timeseries import count_event
 
 auth_bp = Blueprint('auth_bp', __name__,
                     template_folder='./templates')
@@ -126,14 +129,15 @@ def authenticate():
     # if the above check passes, authenticate the user
     user = AuthUser.get(username)
 
-    # Now create the session
+    # Now create the session, under a new id
+    rotate_session()
     flask_login.login_user(user)
 
     # Log the event
     current_app.logger.info('User logged in successfully: {}'.format(current_user.id))
 
     # Store authentications in a time series
-    get_db().ts().add("keybase:authentications", "*", 1, duplicate_policy='first')
+    count_event("keybase:authentications", type='authentications')
 
     return redirect(url_for('document_bp.browse'))
 
@@ -207,6 +211,7 @@ def authgroup():
     # TODO Check the user exists and the role is valid
     print("Setting role of " + request.form['id'] + " to " + request.form['group'])
     get_db().hmset("keybase:auth:{}".format(request.form['id']), {"group": request.form['group']})
+    invalidate_user("keybase:auth:{}".format(request.form['id']))
     return jsonify(message="Role updated")
 
 
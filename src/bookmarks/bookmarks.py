@@ -0,0 +1,81 @@
+import time
+
+from src.common.utils import get_db
+
+# Bookmarks of a user are the sorted set keybase:bookmarks:<user>, the documents scored by the time they were
+# bookmarked, so they are listed newest first and a page is one ZREVRANGE.
+# Bookmarks of previous versions, in the hash keybase:bookmark:<user>, are moved to the sorted set by the scripts the
+# first time they are used. Documents deleted since they were bookmarked are removed when a page shows them.
+PREFIX = "keybase:bookmarks:"
+LEGACY = "keybase:bookmark:"
+
+# KEYS[1] is the sorted set, KEYS[2] the legacy hash
+MIGRATE_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    for _, pk in ipairs(redis.call('HKEYS', KEYS[2])) do
+        redis.call('ZADD', KEYS[1], 'NX', ARGV[1], pk)
+    end
+    redis.call('DEL', KEYS[2])
+end
+"""
+
+# KEYS[3] is the document, ARGV[1] the current time, ARGV[2] the document id
+# Returns 1 if bookmarked, 0 if the bookmark was removed, -1 if the document does not exist
+TOGGLE_LUA = MIGRATE_LUA + """
+if redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[2])
+    return 0
+end
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return -1
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# ARGV[2] is the offset, ARGV[3] the number of bookmarks
+# Returns the number of bookmarks, then the ids and scores of the page
+PAGE_LUA = MIGRATE_LUA + """
+local page = redis.call('ZREVRANGE', KEYS[1], ARGV[2], tonumber(ARGV[2]) + tonumber(ARGV[3]) - 1, 'WITHSCORES')
+table.insert(page, 1, redis.call('ZCARD', KEYS[1]))
+return page
+"""
+
+toggle_script = get_db().register_script(TOGGLE_LUA)
+page_script = get_db().register_script(PAGE_LUA)
+
+
+def toggle_bookmark(user, pk):
+    # 1 if bookmarked, 0 if removed, -1 if the document does not exist
+    return toggle_script(keys=[PREFIX + user, LEGACY + user, "keybase:json:{}".format(pk)], args=[time.time(), pk])
+
+
+def is_bookmarked(user, pk):
+    pipeline = get_db().pipeline(transaction=False)
+    pipeline.zscore(PREFIX + user, pk)
+    pipeline.hexists(LEGACY + user, pk)
+    score, legacy = pipeline.execute()
+    return score is not None or bool(legacy)
+
+
+def get_bookmarks(user, offset, count):
+    # (total, [{'pk', 'name', 'creation', 'bookmarked'}]) for the page, newest first
+    result = page_script(keys=[PREFIX + user, LEGACY + user], args=[time.time(), offset, count])
+    total, page = result[0], list(zip(result[1::2], result[2::2]))
+    if not page:
+        return total, []
+
+    keys = ["keybase:json:{}".format(pk) for pk, _ in page]
+    pipeline = get_db().json().pipeline(transaction=False)
+    pipeline.mget(keys, '$.editorversion.name')
+    pipeline.mget(keys, '$.creation')
+    bookmarks = []
+    deleted = []
+    for (pk, score), name, creation in zip(page, *pipeline.execute()):
+        if not name:
+            deleted.append(pk)
+            continue
+        bookmarks.append({'pk': pk, 'name': name[0], 'creation': int(creation[0]), 'bookmarked': float(score)})
+    if deleted:
+        get_db().zrem(PREFIX + user, *deleted)
+    return total - len(deleted), bookmarks
@@ -1,11 +1,10 @@
 from flask import Blueprint, render_template, request, jsonify
 from flask_login import (current_user, login_required)
+from flask_paginate import Pagination, get_page_args
 from datetime import datetime
-from redis_om import NotFoundError
 
-from src.common.utils import get_db
 from src.common.utils import pretty_title, track_request
-from src.document.document import Document
+from src.bookmarks.bookmarks import toggle_bookmark, get_bookmarks
 
 bookmarks_bp = Blueprint('bookmarks_bp', __name__,
                          template_folder='./templates')
@@ -20,41 +19,27 @@ def before_request():
 @bookmarks_bp.route('/bookmark', methods=['POST'])
 @login_required
 def bookmark():
-    try:
-        Document.get(request.form['docid'])
-    except NotFoundError:
+    # Checked, created or removed in one call, see src/bookmarks/bookmarks.py
+    bookmarked = toggle_bookmark(current_user.id, request.form['docid'])
+    if bookmarked < 0:
         return jsonify(message="Document does not exist", hasbookmark=0), 404
-
-    bookmarked = get_db().hexists("keybase:bookmark:{}".format(current_user.id), request.form['docid'])
-    if not bookmarked:
-        get_db().hset("keybase:bookmark:{}".format(current_user.id), mapping={request.form['docid']: ""})
+    if bookmarked:
         return jsonify(message="Bookmark created", hasbookmark=1)
-    else:
-        get_db().hdel("keybase:bookmark:{}".format(current_user.id), request.form['docid'])
-        return jsonify(message="Bookmark removed", hasbookmark=0)
+    return jsonify(message="Bookmark removed", hasbookmark=0)
 
 
 @bookmarks_bp.route('/bookmarks')
 @login_required
 def bookmarks():
-    docs = []
-    names = []
-    creations = []
-    pretty = []
+    page, per_page, offset = get_page_args(page_parameter='page', per_page_parameter='per_page')
+    total, documents = get_bookmarks(current_user.id, offset, per_page)
+
     bookmarks = None
-    cursor = 0
-
-    while True:
-        cursor, keys = get_db().hscan("keybase:bookmark:{}".format(current_user.id), cursor, count=20)
-        for key in keys:
-            doc = Document.get(key)
-            docs.append(key)
-            names.append(doc.editorversion.name)
-            pretty.append(pretty_title(doc.editorversion.name))
-            creations.append(datetime.utcfromtimestamp(int(doc.creation)).strftime('%Y-%m-%d %H:%M:%S'))
-        if cursor == 0:
-            break
-
-    if len(docs):
-        bookmarks = zip(docs, names, pretty, creations)
-    return render_template("bookmark.html", bookmarks=bookmarks)
+    pagination = None
+    if len(documents):
+        bookmarks = [(document['pk'], document['name'], pretty_title(document['name']),
+                      datetime.utcfromtimestamp(document['creation']).strftime('%Y-%m-%d %H:%M:%S'))
+                     for document in documents]
+        pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bulma',
+                                bulma_style='small', prev_label='Previous', next_label='Next page')
+    return render_template("bookmark.html", bookmarks=bookmarks, pagination=pagination)
@@ -1,4 +1,5 @@
 import json
+from src.common.utils import get_db
 
 
 def test_bookmark_document_user_not_logged(test_client):
@@ -30,3 +31,14 @@ def test_bookmark_read_mine(test_client, create_document, captured_templates):
     template, context = captured_templates[0]
     assert template.name == "bookmark.html"
     assert "bookmarks" in context
+
+
+def test_bookmark_legacy_migrated_and_deleted_removed(test_client, create_document, user_auth, captured_templates):
+    # Bookmarks of previous versions, one of them of a deleted document
+    get_db().hset("keybase:bookmark:{}".format(user_auth.id), mapping={create_document: "", "1xmkzwa8w5": ""})
+    response = test_client.get("/bookmarks")
+    assert response.status_code == 200
+    template, context = captured_templates[0]
+    assert [bookmark[0] for bookmark in context['bookmarks']] == [create_document]
+    assert not get_db().exists("keybase:bookmark:{}".format(user_auth.id))
+    assert get_db().zrange("keybase:bookmarks:{}".format(user_auth.id), 0, -1) == [create_document]
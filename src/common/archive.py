@@ -0,0 +1,135 @@
+import gzip
+import json
+import os
+import time
+
+from src.common.config import CFG_ARCHIVE_DIR, CFG_ARCHIVE_AFTER, CFG_ARCHIVE_FILE_ENTRIES
+from src.common.utils import get_db
+
+# Old entries of a stream are moved to gzip-compressed NDJSON files, one [id, fields] entry per line:
+#   <CFG_ARCHIVE_DIR>/<stream>/<first id>_<last id>.ndjson.gz
+# Every file is written under a temporary name and renamed when complete, then the checkpoint (the last id
+# archived) is saved, then the stream is trimmed to the checkpoint. An interrupted run is resumed from the newest
+# of the checkpoint and of the files.
+BATCH = 10000
+
+
+def parse_id(entry_id, upper=False):
+    # Stream ids as comparable tuples; '-', '+', ids without sequence number and exclusive lower bounds '(<id>'
+    # are accepted as in XRANGE
+    if entry_id == '-':
+        return 0, 0
+    if entry_id == '+':
+        return float('inf'), float('inf')
+    if entry_id.startswith('('):
+        ms, seq = parse_id(entry_id[1:], upper=True)
+        return (ms + 1, 0) if seq == float('inf') else (ms, seq + 1)
+    if '-' not in entry_id:
+        return int(entry_id), float('inf') if upper else 0
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+def stream_dir(stream, directory=CFG_ARCHIVE_DIR):
+    return os.path.join(directory, stream.split(':')[-1])
+
+
+def archive_files(stream, directory=CFG_ARCHIVE_DIR):
+    # [(first id, last id, path)] in order
+    path = stream_dir(stream, directory)
+    if not os.path.isdir(path):
+        return []
+    files = []
+    for name in os.listdir(path):
+        if name.endswith('.ndjson.gz'):
+            first, last = name[:-len('.ndjson.gz')].split('_')
+            files.append((first, last, os.path.join(path, name)))
+    return sorted(files, key=lambda f: parse_id(f[0]))
+
+
+def get_checkpoint(stream, directory=CFG_ARCHIVE_DIR):
+    checkpoint = None
+    path = os.path.join(stream_dir(stream, directory), 'checkpoint')
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = f.read().strip() or None
+    files = archive_files(stream, directory)
+    if files and (checkpoint is None or parse_id(files[-1][1]) > parse_id(checkpoint)):
+        checkpoint = files[-1][1]
+    return checkpoint
+
+
+def save_checkpoint(stream, entry_id, directory=CFG_ARCHIVE_DIR):
+    path = os.path.join(stream_dir(stream, directory), 'checkpoint')
+    with open(path + '.tmp', 'w') as f:
+        f.write(entry_id)
+    os.replace(path + '.tmp', path)
+
+
+def write_file(stream, entries, directory=CFG_ARCHIVE_DIR):
+    path = os.path.join(stream_dir(stream, directory), "{}_{}.ndjson.gz".format(entries[0][0], entries[-1][0]))
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def archive_stream(stream, directory=CFG_ARCHIVE_DIR, after=CFG_ARCHIVE_AFTER, entries_per_file=CFG_ARCHIVE_FILE_ENTRIES):
+    # Archive the entries older than after milliseconds, then trim them from the stream
+    os.makedirs(stream_dir(stream, directory), exist_ok=True)
+    checkpoint = get_checkpoint(stream, directory)
+    start = "({}".format(checkpoint) if checkpoint else '-'
+    end = str(round(time.time() * 1000) - after)
+    archived = 0
+
+    entries = []
+    while True:
+        batch = get_db().xrange(stream, start, end, count=BATCH)
+        entries.extend(batch)
+        if len(entries) >= entries_per_file or (len(batch) < BATCH and len(entries)):
+            # A partial file is only written with the last entries of the run
+            write_file(stream, entries[:entries_per_file], directory)
+            checkpoint = entries[:entries_per_file][-1][0]
+            save_checkpoint(stream, checkpoint, directory)
+            archived += len(entries[:entries_per_file])
+            entries = entries[entries_per_file:]
+        if len(batch) < BATCH and not len(entries):
+            break
+        if len(batch):
+            start = "({}".format(batch[-1][0])
+
+    if checkpoint:
+        # Entries up to the checkpoint are on disk; approximate trimming removes whole nodes only, the rest is
+        # skipped by the readers
+        get_db().xtrim(stream, minid=checkpoint, approximate=True)
+    return archived
+
+
+def read_archive(stream, min_id, max_id, directory=CFG_ARCHIVE_DIR):
+    low, high = parse_id(min_id), parse_id(max_id, upper=True)
+    for first, last, path in archive_files(stream, directory):
+        if parse_id(last) < low or parse_id(first) > high:
+            continue
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if low <= parse_id(entry[0]) <= high:
+                    yield entry
+
+
+def iter_range(stream, min_id='-', max_id='+', batch=BATCH, directory=CFG_ARCHIVE_DIR):
+    # XRANGE across the archive and the live stream, entries are read lazily and returned once
+    checkpoint = get_checkpoint(stream, directory)
+    if checkpoint and parse_id(checkpoint) >= parse_id(min_id):
+        yield from read_archive(stream, min_id, max_id, directory)
+        if parse_id(checkpoint) >= parse_id(max_id, upper=True):
+            return
+        min_id = "({}".format(checkpoint)
+
+    while True:
+        entries = get_db().xrange(stream, min_id, max_id, count=batch)
+        for entry in entries:
+            yield list(entry)
+        if len(entries) < batch:
+            return
+        min_id = "({}".format(entries[-1][0])
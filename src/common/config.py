@@ -18,6 +18,84 @@ REDIS_CFG = {"host": os.getenv('DB_SERVICE', '127.0.0.1'),
              "ssl_certfile": os.getenv('DB_SSL_CERTFILE', ''),
              "ssl_cert_reqs": os.getenv('DB_CERT_REQS', ''),
              "ssl_ca_certs": os.getenv('DB_CA_CERTS', '')}
+# Connections per pool and decoding mode, and seconds to wait for a free one. 0 opens as many as needed, set a size
+# with cooperative workers, where hundreds of requests run concurrently in one process
+CFG_DB_POOL_SIZE = int(os.getenv('CFG_DB_POOL_SIZE', 0))
+CFG_DB_POOL_TIMEOUT = float(os.getenv('CFG_DB_POOL_TIMEOUT', 5))
+# Analytics, retention in milliseconds
+CFG_TS_RAW_RETENTION = int(os.getenv('CFG_TS_RAW_RETENTION', 172800000))
+CFG_TS_HOURLY_RETENTION = int(os.getenv('CFG_TS_HOURLY_RETENTION', 2592000000))
+CFG_TS_DAILY_RETENTION = int(os.getenv('CFG_TS_DAILY_RETENTION', 63072000000))
+CFG_ANALYTICS_CACHE_TTL = int(os.getenv('CFG_ANALYTICS_CACHE_TTL', 60))
+CFG_TRENDING_SIZE = int(os.getenv('CFG_TRENDING_SIZE', 100))
+CFG_TRENDING_CACHE_TTL = int(os.getenv('CFG_TRENDING_CACHE_TTL', 30))
+# Seconds the categories are cached by every worker
+CFG_CATEGORIES_CACHE_TTL = int(os.getenv('CFG_CATEGORIES_CACHE_TTL', 30))
+# Unique viewers, retention of the daily HyperLogLogs in days
+CFG_UNIQUE_RETENTION = int(os.getenv('CFG_UNIQUE_RETENTION', 90))
+
+# Streams of requests and errors: approximate length cap, and archival of the entries older than CFG_ARCHIVE_AFTER ms
+CFG_REQUESTS_MAXLEN = int(os.getenv('CFG_REQUESTS_MAXLEN', 1000000))
+CFG_ERRORS_MAXLEN = int(os.getenv('CFG_ERRORS_MAXLEN', 100000))
+CFG_ARCHIVE_DIR = os.getenv('CFG_ARCHIVE_DIR', 'archive')
+CFG_ARCHIVE_AFTER = int(os.getenv('CFG_ARCHIVE_AFTER', 86400000))
+CFG_ARCHIVE_FILE_ENTRIES = int(os.getenv('CFG_ARCHIVE_FILE_ENTRIES', 100000))
+
+# Events API: page size, and longest wait of the tail and stream endpoints in milliseconds
+CFG_API_PAGE_SIZE = int(os.getenv('CFG_API_PAGE_SIZE', 1000))
+CFG_API_MAX_PAGE_SIZE = int(os.getenv('CFG_API_MAX_PAGE_SIZE', 10000))
+CFG_API_BLOCK_MS = int(os.getenv('CFG_API_BLOCK_MS', 15000))
+# Longest duration of a stream of server-sent events in milliseconds, below the worker timeout; clients reconnect
+CFG_API_STREAM_MS = int(os.getenv('CFG_API_STREAM_MS', 45000))
+# Seconds between two writes of the requests counted per API key
+CFG_API_USAGE_FLUSH = int(os.getenv('CFG_API_USAGE_FLUSH', 10))
+
+# Rate limits of the expensive endpoints, "<endpoint>=<requests per second>:<burst>,..." per client, and requests of
+# these endpoints served at once by a worker (0 for no limit)
+CFG_RATE_LIMITS = os.getenv('CFG_RATE_LIMITS', 'public_bp.search=5:20,document_bp.autocomplete=10:40,'
+                                               'api_bp.api_events=2:10,api_bp.api_events_tail=2:10,'
+                                               'api_bp.api_events_stream=1:5')
+CFG_RATE_LIMIT_CONCURRENCY = int(os.getenv('CFG_RATE_LIMIT_CONCURRENCY', 8))
+# Reverse proxies in front of the application: the address of the client is taken from that many X-Forwarded-For
+# entries set by them. 0 trusts none, and the address is the one of the connection
+CFG_PROXY_COUNT = int(os.getenv('CFG_PROXY_COUNT', 0))
+
+# Metrics: seconds between two flushes of the counts of a worker to Redis, and optional token for /metrics
+CFG_METRICS_FLUSH = int(os.getenv('CFG_METRICS_FLUSH', 10))
+CFG_METRICS_TOKEN = os.getenv('CFG_METRICS_TOKEN', '')
+
+# Redis command profiler: enabled with 1, fraction of the requests sampled to the stream keybase:profiler
+CFG_PROFILER = int(os.getenv('CFG_PROFILER', 0))
+CFG_PROFILER_SAMPLE = float(os.getenv('CFG_PROFILER_SAMPLE', 0.01))
+CFG_PROFILER_MAXLEN = int(os.getenv('CFG_PROFILER_MAXLEN', 10000))
+
+# CPU profiles: fraction of the requests profiled with cProfile, requests slower than the threshold in seconds
+# profiled by stack sampling (0 disables it), sampling interval in seconds, retention in seconds
+CFG_CPU_PROFILE_SAMPLE = float(os.getenv('CFG_CPU_PROFILE_SAMPLE', 0))
+CFG_CPU_PROFILE_THRESHOLD = float(os.getenv('CFG_CPU_PROFILE_THRESHOLD', 0))
+CFG_CPU_PROFILE_INTERVAL = float(os.getenv('CFG_CPU_PROFILE_INTERVAL', 0.01))
+CFG_CPU_PROFILE_RETENTION = int(os.getenv('CFG_CPU_PROFILE_RETENTION', 604800))
+
+# Restore: threads writing the batches, and folder of the uploaded backups
+CFG_RESTORE_WORKERS = int(os.getenv('CFG_RESTORE_WORKERS', 4))
+CFG_RESTORE_DIR = os.getenv('CFG_RESTORE_DIR', 'restore')
+
+# Sessions: key signing the cookies, random and shared through the database if not set, and idle lifetime in seconds
+CFG_SECRET_KEY = os.getenv('SECRET_KEY', '')
+CFG_SESSION_TTL = int(os.getenv('CFG_SESSION_TTL', 604800))
+
+# Users loaded per worker, and seconds before they are read again from the database
+CFG_USER_CACHE_SIZE = int(os.getenv('CFG_USER_CACHE_SIZE', 10000))
+CFG_USER_CACHE_TTL = int(os.getenv('CFG_USER_CACHE_TTL', 300))
+
+# Embeddings
+CFG_EMBEDDER_MODEL = os.getenv('CFG_EMBEDDER_MODEL', 'sentence-transformers/all-distilroberta-v1')
+CFG_EMBEDDER_ADDRESS = os.getenv('CFG_EMBEDDER_ADDRESS', '')
+CFG_EMBEDDER_MAX_BATCH = int(os.getenv('CFG_EMBEDDER_MAX_BATCH', 32))
+CFG_EMBEDDER_MAX_WAIT_MS = int(os.getenv('CFG_EMBEDDER_MAX_WAIT_MS', 10))
+CFG_EMBEDDER_TIMEOUT = float(os.getenv('CFG_EMBEDDER_TIMEOUT', 30))
+CFG_VSS_PROJECTION = os.getenv('CFG_VSS_PROJECTION', '')
+CFG_VSS_PROJECTION_DIR = os.getenv('CFG_VSS_PROJECTION_DIR', 'projections')
 
 
 # Okta
@@ -26,15 +104,25 @@ OKTA_CALLBACK_URL = os.getenv('OKTA_CALLBACK_URL')
 OKTA_CLIENT_ID = os.getenv('OKTA_CLIENT_ID')
 OKTA_CLIENT_SECRET = os.getenv('OKTA_CLIENT_SECRET')
 OKTA_API_TOKEN = os.getenv('OKTA_API_TOKEN')
+# https, or http for the mock IdP of src/services/mockidp.py
+OKTA_SCHEME = os.getenv('OKTA_SCHEME', 'https')
+# Seconds: connect and read timeouts of the calls to Okta, and refresh period of the signing keys
+CFG_OKTA_CONNECT_TIMEOUT = float(os.getenv('CFG_OKTA_CONNECT_TIMEOUT', 3))
+CFG_OKTA_READ_TIMEOUT = float(os.getenv('CFG_OKTA_READ_TIMEOUT', 10))
+CFG_OKTA_JWKS_REFRESH = int(os.getenv('CFG_OKTA_JWKS_REFRESH', 3600))
+# Roles given by Okta groups, as "<group name>=<admin|editor|viewer>,...", synchronized every CFG_OKTA_SYNC_INTERVAL s
+CFG_OKTA_GROUP_ROLES = os.getenv('CFG_OKTA_GROUP_ROLES', '')
+CFG_OKTA_SYNC_INTERVAL = int(os.getenv('CFG_OKTA_SYNC_INTERVAL', 900))
 
 okta = {
     "client_id": OKTA_CLIENT_ID,
     "client_secret": OKTA_CLIENT_SECRET,
     "api_token": OKTA_API_TOKEN,
-    "auth_uri": "https://{}/oauth2/v1/authorize".format(OKTA_BASE),
-    "token_uri": "https://{}/oauth2/v1/token".format(OKTA_BASE),
-    "issuer": "https://{}".format(OKTA_BASE),
-    "userinfo_uri": "https://{}/oauth2/v1/userinfo".format(OKTA_BASE),
+    "auth_uri": "{}://{}/oauth2/v1/authorize".format(OKTA_SCHEME, OKTA_BASE),
+    "token_uri": "{}://{}/oauth2/v1/token".format(OKTA_SCHEME, OKTA_BASE),
+    "issuer": "{}://{}".format(OKTA_SCHEME, OKTA_BASE),
+    "userinfo_uri": "{}://{}/oauth2/v1/userinfo".format(OKTA_SCHEME, OKTA_BASE),
+    "jwks_uri": "{}://{}/oauth2/v1/keys".format(OKTA_SCHEME, OKTA_BASE),
     "redirect_uri": OKTA_CALLBACK_URL,
-    "groups_uri": "https://{}/api/v1/users/".format(OKTA_BASE)
+    "api_uri": "{}://{}/api/v1".format(OKTA_SCHEME, OKTA_BASE)
 }
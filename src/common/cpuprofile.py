@@ -0,0 +1,199 @@
+import cProfile
+import gzip
+import json
+import marshal
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+from src.common.config import CFG_CPU_PROFILE_SAMPLE, CFG_CPU_PROFILE_THRESHOLD, CFG_CPU_PROFILE_INTERVAL, \
+    CFG_CPU_PROFILE_RETENTION
+from src.common.utils import get_db, ShortUuidPk
+
+# CPU profiles of requests, two kinds:
+# - cprofile: a random fraction CFG_CPU_PROFILE_SAMPLE of the requests is profiled with cProfile (downloaded as pstats)
+# - samples: the stacks of the other requests are sampled every CFG_CPU_PROFILE_INTERVAL seconds by a single
+#   thread, and kept if the request took more than CFG_CPU_PROFILE_THRESHOLD seconds (downloaded for speedscope)
+# Profiles are stored compressed in keybase:cpuprofile:<id>, expiring after CFG_CPU_PROFILE_RETENTION seconds, and
+# listed by time in the sorted set keybase:cpuprofiles.
+TOP = 30
+
+
+class Sampler:
+    """Samples the stacks of the threads serving a request."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, ident):
+        with self.lock:
+            self.active[ident] = {}
+            # Started on first use, and again in a worker forked after the first request
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="cpuprofile-sampler", daemon=True)
+                self.thread.start()
+
+    def stop(self, ident):
+        with self.lock:
+            return self.active.pop(ident, {})
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            # Under the lock: once stop() returned the samples of a request, they are no longer written
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        stack.append((frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name))
+                        frame = frame.f_back
+                    if stack:
+                        stack = tuple(reversed(stack))
+                        samples[stack] = samples.get(stack, 0) + 1
+
+
+sampler = Sampler(CFG_CPU_PROFILE_INTERVAL)
+
+
+def function_name(function):
+    filename, line, name = function
+    return "{} ({}:{})".format(name, filename, line)
+
+
+def start_cpu_profile():
+    g.cpu_start = time.perf_counter()
+    g.cpu_profile = None
+    if random.random() < CFG_CPU_PROFILE_SAMPLE:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            g.cpu_profile = profile
+            return
+        except ValueError:
+            # Another profiler is active in this thread
+            pass
+    if CFG_CPU_PROFILE_THRESHOLD:
+        sampler.start(threading.get_ident())
+
+
+def finish_cpu_profile(exception=None):
+    if 'cpu_start' not in g:
+        return
+    duration = time.perf_counter() - g.cpu_start
+    if g.cpu_profile is not None:
+        g.cpu_profile.disable()
+        g.cpu_profile.create_stats()
+        save_profile('cprofile', duration, marshal.dumps(g.cpu_profile.stats), cprofile_top(g.cpu_profile.stats))
+    elif CFG_CPU_PROFILE_THRESHOLD:
+        samples = sampler.stop(threading.get_ident())
+        if duration > CFG_CPU_PROFILE_THRESHOLD and samples:
+            collapsed = {";".join(function_name(function) for function in stack): count
+                         for stack, count in samples.items()}
+            save_profile('samples', duration, json.dumps(collapsed).encode(), samples_top(samples))
+
+
+def cprofile_top(stats):
+    # [(function, calls, own seconds, cumulative seconds)] by cumulative time
+    top = [(function_name(function), calls, round(own, 6), round(cumulative, 6))
+           for function, (_, calls, own, cumulative, _) in stats.items()]
+    return sorted(top, key=lambda x: x[3], reverse=True)[:TOP]
+
+
+def samples_top(samples):
+    # Same for sampled stacks, a function is counted once per sample even if recursive
+    own = {}
+    cumulative = {}
+    for stack, count in samples.items():
+        own[stack[-1]] = own.get(stack[-1], 0) + count
+        for function in set(stack):
+            cumulative[function] = cumulative.get(function, 0) + count
+    top = [(function_name(function), count, round(own.get(function, 0) * CFG_CPU_PROFILE_INTERVAL, 6),
+            round(count * CFG_CPU_PROFILE_INTERVAL, 6)) for function, count in cumulative.items()]
+    return sorted(top, key=lambda x: x[3], reverse=True)[:TOP]
+
+
+def save_profile(kind, duration, data, top):
+    pk = ShortUuidPk().create_pk()
+    now = time.time()
+    profile = {'kind': kind,
+               'method': request.method,
+               'path': request.full_path,
+               'endpoint': request.endpoint or 'none',
+               'args': json.dumps(request.view_args or {}),
+               'duration': round(duration, 6),
+               'created': now,
+               'top': json.dumps(top),
+               'data': gzip.compress(data)}
+    pipeline = get_db().pipeline(transaction=False)
+    pipeline.hset("keybase:cpuprofile:{}".format(pk), mapping=profile)
+    pipeline.expire("keybase:cpuprofile:{}".format(pk), CFG_CPU_PROFILE_RETENTION)
+    pipeline.zadd("keybase:cpuprofiles", {pk: now})
+    pipeline.zremrangebyscore("keybase:cpuprofiles", '-inf', now - CFG_CPU_PROFILE_RETENTION)
+    pipeline.execute()
+
+
+def get_profiles(count=100):
+    pks = get_db().zrevrange("keybase:cpuprofiles", 0, count - 1)
+    pipeline = get_db().pipeline(transaction=False)
+    for pk in pks:
+        pipeline.hmget("keybase:cpuprofile:{}".format(pk), 'kind', 'method', 'path', 'duration', 'created')
+    profiles = []
+    for pk, (kind, method, path, duration, created) in zip(pks, pipeline.execute()):
+        if kind is not None:
+            profiles.append({'pk': pk, 'kind': kind, 'method': method, 'path': path, 'duration': float(duration),
+                             'created': float(created)})
+    return profiles
+
+
+def get_profile(pk):
+    profile = get_db().hmget("keybase:cpuprofile:{}".format(pk), 'kind', 'method', 'path', 'endpoint', 'args',
+                             'duration', 'created', 'top')
+    if profile[0] is None:
+        return None
+    profile = dict(zip(('kind', 'method', 'path', 'endpoint', 'args', 'duration', 'created', 'top'), profile))
+    profile.update(pk=pk, duration=float(profile['duration']), created=float(profile['created']),
+                   top=json.loads(profile['top']))
+    return profile
+
+
+def export_profile(pk):
+    # (filename, content): pstats for cProfile, speedscope JSON for sampled stacks
+    profile = get_db(decode=False).hmget("keybase:cpuprofile:{}".format(pk), 'kind', 'path', 'data')
+    if profile[0] is None:
+        return None
+    kind, path, data = profile[0].decode(), profile[1].decode(), gzip.decompress(profile[2])
+    if kind == 'cprofile':
+        # The format written by pstats.Stats.dump_stats, readable with pstats.Stats(filename)
+        return "profile-{}.pstats".format(pk), data
+
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in json.loads(data).items():
+        sample = []
+        for name in stack.split(';'):
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({'name': name})
+            sample.append(index[name])
+        samples.append(sample)
+        weights.append(count * CFG_CPU_PROFILE_INTERVAL)
+    speedscope = {'$schema': "https://www.speedscope.app/file-format-schema.json",
+                  'shared': {'frames': frames},
+                  'profiles': [{'type': 'sampled', 'name': path, 'unit': 'seconds', 'startValue': 0,
+                                'endValue': sum(weights), 'samples': samples, 'weights': weights}],
+                  'name': path,
+                  'exporter': 'keybase'}
+    return "profile-{}.speedscope.json".format(pk), json.dumps(speedscope).encode()
+
@@ -0,0 +1,112 @@
+import json
+import socket
+import struct
+import threading
+
+import numpy as np
+
+from src.common.config import CFG_EMBEDDER_ADDRESS, CFG_EMBEDDER_TIMEOUT
+
+# Every message on the embedding socket is a frame: a 4-byte big-endian length followed by the payload.
+# Requests are JSON, e.g. {"op": "encode", "texts": [...]} or {"op": "stats"}.
+# An encode response is a JSON header {"count": n, "dim": d} followed by a frame of n*d float32 values.
+FRAME_HEADER = struct.Struct("!I")
+
+
+class EmbeddingError(Exception):
+    pass
+
+
+def parse_address(address):
+    # "unix:/path/to/socket" or a filesystem path selects a Unix socket, "host:port" a TCP socket
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def send_frame(sock, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed by the embedding server")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    (size,) = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    return recv_exactly(sock, size)
+
+
+class EmbeddingClient:
+    """Client for the embedding server in src/services/embedder.py.
+
+    Mimics SentenceTransformer.encode, so batch jobs and web workers can swap a local model for
+    the shared server. A single connection is kept open and reused; it is reopened once on failure.
+    """
+
+    def __init__(self, address=CFG_EMBEDDER_ADDRESS, timeout=CFG_EMBEDDER_TIMEOUT):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, message, binary=False):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = self.connect()
+                    send_frame(self.sock, json.dumps(message).encode())
+                    header = json.loads(recv_frame(self.sock))
+                    if "error" in header:
+                        raise EmbeddingError(header["error"])
+                    body = recv_frame(self.sock) if binary else None
+                    return header, body
+                except (ConnectionError, socket.timeout, OSError):
+                    self.close()
+                    if attempt:
+                        raise
+
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+
+        header, body = self.request({"op": "encode", "texts": list(texts)}, binary=True)
+        vectors = np.frombuffer(body, dtype=np.float32).reshape(header["count"], header["dim"])
+        return vectors[0] if single else vectors
+
+    def stats(self):
+        header, _ = self.request({"op": "stats"})
+        return header
+
+
+_client = None
+
+
+def get_embedder():
+    # One shared client per process, created on first use
+    global _client
+    if _client is None:
+        _client = EmbeddingClient()
+    return _client
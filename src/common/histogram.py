@@ -0,0 +1,34 @@
+import bisect
+import threading
+
+
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to be updated on every request."""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        # Cumulative counts, as in the Prometheus exposition format; the last bucket is +Inf
+        cumulative = []
+        running = 0
+        for bound, value in zip(self.buckets + ["+Inf"], counts):
+            running += value
+            cumulative.append((bound, running))
+
+        return {'buckets': cumulative, 'sum': total, 'count': count}
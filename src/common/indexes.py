@@ -0,0 +1,60 @@
+from redis_om import Migrator
+from redis.commands.search.field import TextField, TagField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition
+
+from src.common.config import CFG_VSS_PROJECTION
+from src.common.utils import get_db
+
+# Indexes owned by the application; vss_idx_v<N> is added when a projection is active
+INDEXES = ("document_idx", "feedback_idx", "user_idx", "vss_idx")
+
+
+def get_indexes():
+    indexes = list(INDEXES)
+    if CFG_VSS_PROJECTION:
+        indexes.append("vss_idx_v{}".format(CFG_VSS_PROJECTION))
+    return indexes
+
+
+def create_indexes(logger=None):
+    # Create the indexes that do not exist, the others are left untouched
+    indexes = get_db().execute_command("FT._LIST")
+
+    # The models must be imported for OM to create their indexes
+    from src.document.document import Document  # noqa: F401
+    from src.feedback.feedback import Feedback  # noqa: F401
+
+    if "document_idx" not in indexes or "feedback_idx" not in indexes:
+        if logger:
+            logger.info("The index document_idx or feedback_idx does not exist, creating it")
+        Migrator().run()
+
+    if "user_idx" not in indexes:
+        if logger:
+            logger.info("The index user_idx does not exist, creating it")
+        index_def = IndexDefinition(prefix=["keybase:okta"])
+        schema = (TextField("name"), TagField("group"))
+        get_db().ft('user_idx').create_index(schema, definition=index_def)
+
+    if "vss_idx" not in indexes:
+        if logger:
+            logger.info("The index vss_idx does not exist, creating it")
+        index_def = IndexDefinition(prefix=["keybase:vss"])
+        schema = (TagField("state"),
+                  TagField("privacy"),
+                  VectorField("content_embedding", "HNSW", {"TYPE": "FLOAT32", "DIM": 768, "DISTANCE_METRIC": "L2"}))
+        get_db().ft('vss_idx').create_index(schema, definition=index_def)
+
+    if CFG_VSS_PROJECTION and "vss_idx_v{}".format(CFG_VSS_PROJECTION) not in indexes:
+        from src.services.projection import create_index, load_projection
+        create_index(load_projection(CFG_VSS_PROJECTION))
+
+
+def drop_indexes():
+    # Drop the indexes, not the documents, before a bulk load: the keys are indexed once when create_indexes()
+    # creates them again, rather than one by one while loaded
+    existing = get_db().execute_command("FT._LIST")
+    dropped = [index for index in get_indexes() if index in existing]
+    for index in dropped:
+        get_db().ft(index).dropindex(delete_documents=False)
+    return dropped
@@ -0,0 +1,242 @@
+import os
+import socket
+import threading
+import time
+import redis
+
+from src.common.config import CFG_METRICS_FLUSH
+from src.common.histogram import Histogram
+from src.common.utils import get_db, _pools
+
+# Requests are measured in-process by the WSGI middleware, at the cost of a few dictionary updates.
+# Every CFG_METRICS_FLUSH seconds, at the end of a request, the worker adds its counts to the hash keybase:metrics,
+# shared by all the workers, and publishes its gauges (in-flight requests, connection pools) in
+# keybase:metrics:worker:<id>, which expires if the worker stops flushing. /metrics reads both.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576]
+
+HOST = socket.gethostname()
+WORKERS = "keybase:metrics:workers"
+
+
+class Registry:
+    """Counts of one worker since the last flush."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.size = {}
+        self.status = {}
+        self.limited = {}
+        self.in_flight = 0
+        self.flushed = time.monotonic()
+
+    def histogram(self, histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def observe(self, endpoint, method, status, duration, size):
+        key = (endpoint, method)
+        self.histogram(self.latency, key, LATENCY_BUCKETS).observe(duration)
+        self.histogram(self.size, key, SIZE_BUCKETS).observe(size)
+        with self.lock:
+            self.status[key + (status,)] = self.status.get(key + (status,), 0) + 1
+            self.in_flight -= 1
+
+    def limit(self, endpoint, reason):
+        # Refused by src/common/ratelimit.py
+        with self.lock:
+            self.limited[(endpoint, reason)] = self.limited.get((endpoint, reason), 0) + 1
+
+    def swap(self):
+        # Take the counts accumulated so far and start again from zero
+        with self.lock:
+            latency, size, status, limited = self.latency, self.size, self.status, self.limited
+            self.latency, self.size, self.status, self.limited = {}, {}, {}, {}
+            self.flushed = time.monotonic()
+        return latency, size, status, limited
+
+    def flush(self):
+        latency, size, status, limited = self.swap()
+        pipeline = get_db().pipeline(transaction=False)
+        for name, histograms in (('latency', latency), ('size', size)):
+            for (endpoint, method), histogram in histograms.items():
+                snapshot = histogram.snapshot()
+                for bound, count in snapshot['buckets']:
+                    pipeline.hincrby("keybase:metrics", "{}|{}|{}|bucket|{}".format(name, endpoint, method, bound), count)
+                pipeline.hincrbyfloat("keybase:metrics", "{}|{}|{}|sum".format(name, endpoint, method), snapshot['sum'])
+                pipeline.hincrby("keybase:metrics", "{}|{}|{}|count".format(name, endpoint, method), snapshot['count'])
+        for (endpoint, method, code), count in status.items():
+            pipeline.hincrby("keybase:metrics", "status|{}|{}|{}".format(endpoint, method, code), count)
+        for (endpoint, reason), count in limited.items():
+            pipeline.hincrby("keybase:metrics", "limited|{}|{}".format(endpoint, reason), count)
+
+        # Not known at import time when the workers are forked from a preloaded master
+        worker = "{}:{}".format(HOST, os.getpid())
+        key = "keybase:metrics:worker:{}".format(worker)
+        pipeline.hset(key, mapping=dict(pool_stats(), in_flight=self.in_flight))
+        pipeline.expire(key, 3 * CFG_METRICS_FLUSH)
+        pipeline.sadd(WORKERS, worker)
+        pipeline.execute()
+
+
+registry = Registry()
+
+
+def pool_stats():
+    # Connections of the pools of this worker, see get_db()
+    stats = {'pool_created': 0, 'pool_available': 0, 'pool_in_use': 0}
+    for pool in _pools.values():
+        if isinstance(pool, redis.BlockingConnectionPool):
+            # The queue holds the free connections, and None for those not created yet
+            created = len(pool._connections)
+            available = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+            stats['pool_created'] += created
+            stats['pool_available'] += available
+            stats['pool_in_use'] += created - available
+        else:
+            stats['pool_created'] += getattr(pool, '_created_connections', 0)
+            stats['pool_available'] += len(getattr(pool, '_available_connections', []))
+            stats['pool_in_use'] += len(getattr(pool, '_in_use_connections', []))
+    return stats
+
+
+class ResponseIterable:
+    """Wraps the response, the request ends when the server closes it, after the last byte is sent."""
+
+    def __init__(self, iterable, environ, start, state):
+        self.iterable = iterable
+        self.environ = environ
+        self.start = start
+        self.state = state
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            finish(self.environ, self.start, self.state.get('status', '500'), self.size)
+
+
+def finish(environ, start, status, size):
+    registry.observe(environ.get('keybase.endpoint', 'none'), environ.get('REQUEST_METHOD', ''), status,
+                     time.perf_counter() - start, size)
+    if time.monotonic() - registry.flushed > CFG_METRICS_FLUSH:
+        try:
+            registry.flush()
+        except Exception:
+            # Metrics must never fail a request, the counts of this interval are lost
+            pass
+
+
+class MetricsMiddleware:
+    """WSGI middleware measuring every request, whatever the blueprint."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        state = {}
+
+        def measured_start_response(status, headers, exc_info=None):
+            state['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        registry.enter()
+        try:
+            iterable = self.app(environ, measured_start_response)
+        except Exception:
+            finish(environ, start, '500', 0)
+            raise
+        return ResponseIterable(iterable, environ, start, state)
+
+
+def labels(**values):
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in values.items()) + "}"
+
+
+def field_order(field):
+    # The series of an endpoint together, the buckets in the order of their bound up to +Inf, then sum and count
+    parts = field.split('|')
+    if len(parts) > 4 and parts[3] == 'bucket':
+        return parts[:3], 0, float(parts[4])
+    return parts[:3], 1, parts[3:]
+
+
+def exposition():
+    # All the workers, in the Prometheus text format
+    metrics = get_db().hgetall("keybase:metrics")
+    workers = list(get_db().smembers(WORKERS))
+    pipeline = get_db().pipeline(transaction=False)
+    for worker in workers:
+        pipeline.hgetall("keybase:metrics:worker:{}".format(worker))
+    gauges = {}
+    active = 0
+    for worker, values in zip(workers, pipeline.execute()):
+        if not values:
+            # The worker stopped
+            get_db().srem(WORKERS, worker)
+            continue
+        active += 1
+        for name, value in values.items():
+            gauges[name] = gauges.get(name, 0) + int(value)
+
+    names = {'latency': ('keybase_http_request_duration_seconds', 'Request latency'),
+             'size': ('keybase_http_response_size_bytes', 'Response size')}
+    lines = []
+    for name, (metric, description) in names.items():
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} histogram".format(metric))
+        for field in sorted(metrics, key=field_order):
+            parts = field.split('|')
+            if parts[0] != name:
+                continue
+            if parts[3] == 'bucket':
+                lines.append("{}_bucket{} {}".format(metric, labels(endpoint=parts[1], method=parts[2], le=parts[4]),
+                                                     metrics[field]))
+            else:
+                lines.append("{}_{}{} {}".format(metric, parts[3], labels(endpoint=parts[1], method=parts[2]),
+                                                 metrics[field]))
+
+    lines.append("# HELP keybase_http_requests_total Requests by status code")
+    lines.append("# TYPE keybase_http_requests_total counter")
+    for field in sorted(metrics):
+        parts = field.split('|')
+        if parts[0] == 'status':
+            lines.append("keybase_http_requests_total{} {}".format(
+                labels(endpoint=parts[1], method=parts[2], status=parts[3]), metrics[field]))
+
+    lines.append("# HELP keybase_http_requests_limited_total Requests refused by the rate limiter")
+    lines.append("# TYPE keybase_http_requests_limited_total counter")
+    for field in sorted(metrics):
+        parts = field.split('|')
+        if parts[0] == 'limited':
+            lines.append("keybase_http_requests_limited_total{} {}".format(
+                labels(endpoint=parts[1], reason=parts[2]), metrics[field]))
+
+    lines.append("# HELP keybase_http_requests_in_flight Requests being served")
+    lines.append("# TYPE keybase_http_requests_in_flight gauge")
+    lines.append("keybase_http_requests_in_flight {}".format(gauges.get('in_flight', 0)))
+    lines.append("# HELP keybase_redis_pool_connections Redis connections of the workers")
+    lines.append("# TYPE keybase_redis_pool_connections gauge")
+    for state in ('created', 'available', 'in_use'):
+        lines.append("keybase_redis_pool_connections{} {}".format(labels(state=state),
+                                                                   gauges.get('pool_' + state, 0)))
+    lines.append("# HELP keybase_workers Workers reporting metrics")
+    lines.append("# TYPE keybase_workers gauge")
+    lines.append("keybase_workers {}".format(active))
+    return "\n".join(lines) + "\n"
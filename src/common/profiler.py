@@ -0,0 +1,164 @@
+import contextvars
+import json
+import random
+import re
+import time
+
+import redis
+from flask import request
+
+from src.common.config import CFG_PROFILER_SAMPLE, CFG_PROFILER_MAXLEN
+from src.common.utils import get_db
+
+# Opt-in profiler of the Redis commands issued while serving a request (CFG_PROFILER=1).
+# The connections of the pools of get_db() are replaced by profiled ones, so commands sent by pipelines and by
+# redis-om are seen as well. A command is recorded when queued for sending, with its approximate size, its round
+# trip starts when it is sent, and its duration is the time until its reply is read: the commands of a pipeline
+# share one round trip.
+_collector = contextvars.ContextVar('redis_profiler', default=None)
+
+# Ids in key names, as in keybase:json:01GZ8K3NDN6X1QWB5VJY3T9RZ2 or keybase:uniq:<pk>:20231101
+ID_PATTERN = re.compile(r'(?<=:)(?=[^:]*\d)[A-Za-z0-9_\-]{6,}')
+
+
+def text(arg):
+    return arg.decode('utf-8', 'replace') if isinstance(arg, bytes) else str(arg)
+
+
+def key_pattern(args):
+    return ID_PATTERN.sub('*', text(args[1])) if len(args) > 1 else ''
+
+
+def reply_size(reply):
+    if isinstance(reply, (bytes, str)):
+        return len(reply)
+    if isinstance(reply, (list, tuple)):
+        return sum(reply_size(item) for item in reply)
+    return 8
+
+
+class Collector:
+    """Commands of one request."""
+
+    def __init__(self):
+        self.commands = []
+        self.pending = []
+        self.unanswered = []
+        self.round_trips = 0
+
+    def packed(self, args, size):
+        command = {'name': text(args[0]).upper(), 'key': key_pattern(args), 'size': size, 'reply': 0, 'duration': 0}
+        self.commands.append(command)
+        self.pending.append(command)
+
+    def sent(self):
+        if not self.pending:
+            return
+        self.round_trips += 1
+        start = time.perf_counter()
+        for command in self.pending:
+            command['trip'] = self.round_trips
+            command['start'] = start
+        self.unanswered.extend(self.pending)
+        self.pending = []
+
+    def read(self, reply):
+        if self.unanswered:
+            command = self.unanswered.pop(0)
+            command['duration'] = time.perf_counter() - command.pop('start')
+            command['reply'] = reply_size(reply)
+
+    def duration(self):
+        # Time spent waiting for Redis: the last reply of every round trip
+        trips = {}
+        for command in self.commands:
+            trips[command.get('trip')] = max(trips.get(command.get('trip'), 0), command['duration'])
+        return sum(trips.values())
+
+    def summary(self):
+        counts = {}
+        for command in self.commands:
+            counts[command['name']] = counts.get(command['name'], 0) + 1
+        return counts
+
+
+class ProfiledConnectionMixin:
+    def send_command(self, *args, **kwargs):
+        collector = _collector.get()
+        if collector is not None:
+            collector.packed(args, sum(len(text(arg)) for arg in args))
+        super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        # Pipelines
+        collector = _collector.get()
+        if collector is not None:
+            for args in commands:
+                collector.packed(args, sum(len(text(arg)) for arg in args))
+        return super().pack_commands(commands)
+
+    def send_packed_command(self, command, check_health=True):
+        super().send_packed_command(command, check_health)
+        collector = _collector.get()
+        if collector is not None:
+            collector.sent()
+
+    def read_response(self, *args, **kwargs):
+        reply = super().read_response(*args, **kwargs)
+        collector = _collector.get()
+        if collector is not None:
+            collector.read(reply)
+        return reply
+
+
+class ProfiledConnection(ProfiledConnectionMixin, redis.Connection):
+    pass
+
+
+class ProfiledSSLConnection(ProfiledConnectionMixin, redis.SSLConnection):
+    pass
+
+
+def profile_pool(pool):
+    # Called by get_pool() before the pool opens any connection
+    if issubclass(pool.connection_class, redis.SSLConnection):
+        pool.connection_class = ProfiledSSLConnection
+    else:
+        pool.connection_class = ProfiledConnection
+    return pool
+
+
+def start_profile():
+    _collector.set(Collector())
+
+
+def finish_profile(response, logger):
+    collector = _collector.get()
+    if collector is None:
+        return response
+    # Stop collecting first, the sample below must not be profiled
+    _collector.set(None)
+
+    duration = collector.duration() * 1000
+    counts = ",".join("{}={}".format(name, count) for name, count in sorted(collector.summary().items()))
+    response.headers['X-Redis-Commands'] = "{}; round-trips={}; {}".format(len(collector.commands),
+                                                                          collector.round_trips, counts)
+    response.headers.add('Server-Timing', 'redis;dur={:.2f};desc="{} commands, {} round trips"'.format(
+        duration, len(collector.commands), collector.round_trips))
+    logger.debug("redis %s %s: %d commands in %d round trips, %.2f ms [%s]", request.method, request.path,
+                 len(collector.commands), collector.round_trips, duration,
+                 " ".join("{} {}".format(command['name'], command['key']) for command in collector.commands))
+
+    if random.random() < CFG_PROFILER_SAMPLE:
+        for command in collector.commands:
+            command.pop('start', None)
+            command['duration'] = round(command['duration'] * 1000, 3)
+        get_db().xadd("keybase:profiler", {'path': request.full_path,
+                                           'endpoint': request.endpoint or 'none',
+                                           'status': response.status_code,
+                                           'commands': len(collector.commands),
+                                           'round_trips': collector.round_trips,
+                                           'duration': round(duration, 3),
+                                           'detail': json.dumps(collector.commands)},
+                      maxlen=CFG_PROFILER_MAXLEN, approximate=True)
+    return response
@@ -0,0 +1,111 @@
+import math
+import threading
+
+from flask import Response, g, request
+from flask_login import current_user
+from redis import RedisError
+
+from src.common.config import CFG_RATE_LIMITS, CFG_RATE_LIMIT_CONCURRENCY
+from src.common.metrics import registry
+from src.common.utils import get_db
+
+# Admission control of the expensive endpoints, in two steps run before the request:
+# - Budget per client and endpoint, a token bucket in keybase:ratelimit:<endpoint>:<client> updated atomically by
+#   a script, so all the workers and hosts share it. The client is the API key once verified by token_required, else
+#   the user, else the IP address: headers sent by the client are not trusted, see CFG_PROXY_COUNT for proxies.
+#   Budgets are CFG_RATE_LIMITS, "<endpoint>=<requests per second>:<burst>,...".
+# - At most CFG_RATE_LIMIT_CONCURRENCY of these requests at once in a worker, the next ones are refused at once
+#   instead of waiting behind the others.
+# Refused requests get 429 with Retry-After, and are counted in the metrics by endpoint and reason.
+PREFIX = "keybase:ratelimit:"
+# Waiting for new events, not working: they would hold a slot for up to CFG_API_BLOCK_MS, or while open
+WAITING = {'api_bp.api_events_tail', 'api_bp.api_events_stream'}
+
+# KEYS[1] is the bucket, ARGV[1] the requests per second, ARGV[2] the burst
+# Returns 1 and 0 if the request is allowed, else 0 and the milliseconds to wait for a token
+BUCKET_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate / 1000)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {allowed, wait}
+"""
+bucket_script = get_db().register_script(BUCKET_LUA)
+
+
+def parse_limits(value=CFG_RATE_LIMITS):
+    # {endpoint: (requests per second, burst)}
+    limits = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        endpoint, _, budget = item.partition('=')
+        rate, _, burst = budget.partition(':')
+        limits[endpoint.strip()] = (float(rate), int(burst or math.ceil(float(rate))))
+    return limits
+
+
+LIMITS = parse_limits()
+_slots = threading.BoundedSemaphore(CFG_RATE_LIMIT_CONCURRENCY) if CFG_RATE_LIMIT_CONCURRENCY else None
+
+
+def client_id():
+    if current_user.is_authenticated:
+        return "user:" + str(current_user.get_id())
+    # The address of the proxy, or of the client set by ProxyFix from X-Forwarded-For
+    return "ip:" + str(request.remote_addr)
+
+
+def take_token(endpoint, client, rate, burst):
+    # 0 if allowed, else the milliseconds to wait
+    allowed, wait = bucket_script(keys=[PREFIX + "{}:{}".format(endpoint, client)], args=[rate, burst])
+    return 0 if allowed else int(wait)
+
+
+def too_many_requests(endpoint, reason, wait):
+    registry.limit(endpoint, reason)
+    response = Response(response="Too many requests", status=429, mimetype="text/plain")
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait / 1000)))
+    return response
+
+
+def admit():
+    # before_request: None to serve the request, or the 429 response. The API is admitted by token_required
+    if request.blueprint == 'api_bp':
+        return None
+    return admit_client(client_id())
+
+
+def admit_client(client):
+    endpoint = request.endpoint
+    if endpoint not in LIMITS:
+        return None
+    try:
+        wait = take_token(endpoint, client, *LIMITS[endpoint])
+    except RedisError:
+        # Requests are not refused because the limiter is unavailable
+        wait = 0
+    if wait:
+        return too_many_requests(endpoint, 'rate', wait)
+    if _slots is not None and endpoint not in WAITING:
+        if not _slots.acquire(blocking=False):
+            return too_many_requests(endpoint, 'concurrency', 1000)
+        g.rate_limit_slot = True
+    return None
+
+
+def release(exc=None):
+    # teardown_request, after the last byte of streamed responses
+    if g.pop('rate_limit_slot', False):
+        _slots.release()
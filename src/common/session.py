@@ -0,0 +1,112 @@
+import secrets
+
+from flask import session as current_session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SecureCookieSession
+from itsdangerous import Signer, BadSignature
+
+from src.common.config import CFG_SECRET_KEY, CFG_SESSION_TTL
+from src.common.utils import get_db
+
+# Server-side sessions, shared by all the workers and containers: the cookie holds the signed id of the session, the
+# data is in keybase:session:<id>, serialized as tagged JSON like Flask's cookie sessions.
+# The key expires CFG_SESSION_TTL seconds after the last request, but the expiry is only renewed once half of it has
+# passed, and the data is only written when it changed, so most requests read the session and write nothing.
+# The id changes on login, see rotate_session().
+PREFIX = "keybase:session:"
+SECRET = "keybase:secret"
+
+
+def app_secret_key(app):
+    # Read on the first request of the process, not when the application is created
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = get_secret_key()
+    return app.config['SECRET_KEY']
+
+
+def get_secret_key():
+    # SECRET_KEY from the environment, or a random key created once and shared through the database
+    if CFG_SECRET_KEY:
+        return CFG_SECRET_KEY
+    get_db().set(SECRET, secrets.token_hex(64), nx=True)
+    return get_db().get(SECRET)
+
+
+class RedisSession(SecureCookieSession):
+    """Tracks accesses and changes like the cookie session of Flask."""
+
+    def __init__(self, initial=None, sid=None, data=None, ttl=-2):
+        super().__init__(initial)
+        self.sid = sid
+        # Serialized as read, to tell if it changed, and seconds left before it expires
+        self.data = data
+        self.ttl = ttl
+
+
+def rotate_session():
+    # Before login_user: the id known before the login, possibly planted by someone else, is no longer valid, and
+    # the data is written under a new id
+    session = current_session._get_current_object()
+    if not isinstance(session, RedisSession):
+        return
+    if session.data is not None:
+        get_db().delete(PREFIX + session.sid)
+    session.sid = secrets.token_urlsafe(32)
+    session.data = None
+    session.modified = True
+
+
+class RedisSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+    session_class = RedisSession
+
+    def get_signer(self, app):
+        return Signer(app_secret_key(app), salt="keybase-session", key_derivation="hmac")
+
+    def open_session(self, app, request):
+        # Before anything else of the request can use the secret key
+        app_secret_key(app)
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.get_signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                pipeline = get_db().pipeline(transaction=False)
+                pipeline.get(PREFIX + sid)
+                pipeline.ttl(PREFIX + sid)
+                data, ttl = pipeline.execute()
+                if data is not None:
+                    return self.session_class(self.serializer.loads(data), sid=sid, data=data, ttl=ttl)
+        return self.session_class(sid=secrets.token_urlsafe(32))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            # Emptied, as on logout
+            if session.data is not None:
+                get_db().delete(PREFIX + session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        data = self.serializer.dumps(dict(session)) if session.accessed or session.modified else session.data
+        if data != session.data:
+            get_db().set(PREFIX + session.sid, data, ex=CFG_SESSION_TTL)
+        elif session.ttl < CFG_SESSION_TTL // 2:
+            get_db().expire(PREFIX + session.sid, CFG_SESSION_TTL)
+        else:
+            return
+
+        # Created, changed or renewed: the cookie is sent again, with its new expiry if permanent
+        response.set_cookie(name, self.get_signer(app).sign(session.sid).decode(),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
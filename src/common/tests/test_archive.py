@@ -0,0 +1,91 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from src.common.archive import parse_id, archive_stream, archive_files, get_checkpoint, iter_range
+from src.common.config import CFG_ARCHIVE_DIR
+from src.common.utils import get_db
+
+STREAM = "keybase:requests"
+
+
+def add_entries(ids):
+    for entry_id in ids:
+        get_db().xadd(STREAM, {'full_path': "/doc/{}?".format(entry_id), 'user': "00000000000000000000"}, id=entry_id)
+
+
+def test_archive_parse_id():
+    assert parse_id('-') < parse_id('5-0') < parse_id('5-1') < parse_id('(5-1') == parse_id('5-2') < parse_id('+')
+    # Without a sequence number, the first of the millisecond as a lower bound, the last as an upper bound
+    assert parse_id('5') == (5, 0)
+    assert parse_id('5', upper=True) > parse_id('5-99')
+    assert parse_id('(5') == (6, 0)
+
+
+def test_archive_files_rotated(tmp_path):
+    get_db().flushall()
+    old = ["{}-0".format(1000 + n) for n in range(25)]
+    add_entries(old)
+    add_entries(["*"])
+
+    assert archive_stream(STREAM, str(tmp_path), entries_per_file=10) == 25
+    files = archive_files(STREAM, str(tmp_path))
+    assert [(first, last) for first, last, _ in files] == [(old[0], old[9]), (old[10], old[19]), (old[20], old[24])]
+    with gzip.open(files[0][2], 'rt') as f:
+        assert [json.loads(line)[0] for line in f] == old[:10]
+    assert get_checkpoint(STREAM, str(tmp_path)) == old[-1]
+    # The recent entry is left in the stream
+    assert len(get_db().xrange(STREAM, "({}".format(old[-1]), '+')) == 1
+
+
+def test_archive_resumed_from_checkpoint(tmp_path):
+    get_db().flushall()
+    add_entries(["{}-0".format(1000 + n) for n in range(5)])
+    assert archive_stream(STREAM, str(tmp_path), entries_per_file=10) == 5
+    # Interrupted after writing a file, before saving the checkpoint: the newest file is the checkpoint
+    os.remove(os.path.join(tmp_path, "requests", "checkpoint"))
+    assert get_checkpoint(STREAM, str(tmp_path)) == "1004-0"
+
+    add_entries(["{}-0".format(2000 + n) for n in range(3)])
+    assert archive_stream(STREAM, str(tmp_path), entries_per_file=10) == 3
+    assert archive_stream(STREAM, str(tmp_path), entries_per_file=10) == 0
+    archived = [entry[0] for entry in iter_range(STREAM, '-', '+', directory=str(tmp_path))]
+    assert archived == ["100{}-0".format(n) for n in range(5)] + ["200{}-0".format(n) for n in range(3)]
+
+
+def test_archive_range_across_archive_and_stream(tmp_path):
+    get_db().flushall()
+    old = ["{}-0".format(1000 + n) for n in range(12)]
+    add_entries(old)
+    archive_stream(STREAM, str(tmp_path), entries_per_file=5)
+    live = ["{}-0".format(5000 + n) for n in range(4)]
+    add_entries(live)
+    # Approximate trimming left the archived entries in the stream, every entry is still read once
+    assert len(get_db().xrange(STREAM)) == len(old) + len(live)
+
+    def ids(min_id, max_id, batch=2):
+        return [entry[0] for entry in iter_range(STREAM, min_id, max_id, batch=batch, directory=str(tmp_path))]
+
+    assert ids('-', '+') == old + live
+    assert ids('1003', '5001-0') == old[3:] + live[:2]
+    assert ids('(1003-0', '1006') == old[4:7]
+    assert ids('5002', '+') == live[2:]
+    assert ids('(5003-0', '+') == []
+
+
+def test_archive_events_api_reads_archive(test_client, create_token, tmp_path, monkeypatch):
+    if os.path.isabs(CFG_ARCHIVE_DIR):
+        pytest.skip("The archive directory is not relative")
+    monkeypatch.chdir(tmp_path)
+    old = ["{}-0".format(1000 + n) for n in range(6)]
+    add_entries(old)
+    archive_stream(STREAM, entries_per_file=4)
+    add_entries(["*"])
+
+    response = test_client.get("/api/events", headers=create_token, query_string={"min": "-", "max": "+"})
+    events = json.loads(response.data)['events']
+    assert [event[0] for event in events][:6] == old
+    assert len(events) == 7
+    assert events[0][1]['full_path'] == "/doc/1000-0?"
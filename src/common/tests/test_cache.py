@@ -0,0 +1,98 @@
+import time
+
+import redis
+from src.application import create_app
+from src.common.config import CFG_AUTHENTICATOR
+from src.common.users import forget, get_user, get_user_names, invalidate_user, start_listener, CHANNEL
+from src.common.utils import get_db, get_categories, invalidate_categories, CATEGORIES
+
+
+def eventually(condition, timeout=5):
+    # The other workers apply the messages in their listener thread
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def listening():
+    # The listener of this process is subscribed, and has dropped what it cached before
+    start_listener()
+    assert eventually(lambda: get_db().pubsub_numsub(CHANNEL)[0][1] >= 1)
+    time.sleep(0.1)
+
+
+def test_cache_app_created_without_database(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise AssertionError("Connected to Redis while creating the application")
+
+    monkeypatch.setattr(redis.connection.Connection, "connect", unavailable)
+    app = create_app()
+    assert not app.config.get('SECRET_KEY')
+    monkeypatch.undo()
+
+    # The first request reads the secret key and creates the indexes
+    get_db().flushall()
+    with app.test_client() as client:
+        client.get("/error-page")
+    assert app.config['SECRET_KEY'] == get_db().get("keybase:secret")
+    assert get_db().execute_command("FT._LIST")
+
+
+def test_cache_categories_invalidated_in_every_worker(create_flask_app):
+    get_db().flushall()
+    listening()
+    get_db().hset(CATEGORIES, "cat1", "One")
+    invalidate_categories()
+    assert get_categories() == {"cat1": "One"}
+
+    # Another worker changes them and publishes it
+    pubsub = get_db().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL)
+    get_db().hset(CATEGORIES, "cat1", "Uno")
+    assert get_categories() == {"cat1": "One"}
+    get_db().publish(CHANNEL, CATEGORIES)
+    assert eventually(lambda: get_categories() == {"cat1": "Uno"})
+
+    # The changes made here are published too
+    invalidate_categories()
+    assert eventually(lambda: pubsub.get_message(timeout=0.1) is not None)
+    pubsub.close()
+
+
+def test_cache_user_invalidated_in_every_worker(create_flask_app):
+    get_db().flushall()
+    listening()
+    key = "keybase:{}:cacheuser".format(CFG_AUTHENTICATOR)
+    get_db().hset(key, mapping={'name': "Before", 'group': "viewer"})
+    assert get_user(key, dict)['name'] == "Before"
+    assert get_user_names(["cacheuser"]) == {"cacheuser": "Before"}
+
+    # Changed by another worker, which publishes the key
+    get_db().hset(key, mapping={'name': "After", 'group': "admin"})
+    assert get_user(key, dict)['group'] == "viewer"
+    get_db().publish(CHANNEL, key)
+    assert eventually(lambda: get_user(key, dict)['group'] == "admin")
+    assert get_user_names(["cacheuser"]) == {"cacheuser": "After"}
+
+    # Changed here, dropped at once
+    get_db().hset(key, 'group', "editor")
+    invalidate_user(key)
+    assert get_user(key, dict)['group'] == "editor"
+
+
+def test_cache_user_invalidated_during_read(create_flask_app):
+    get_db().flushall()
+    key = "keybase:{}:raceuser".format(CFG_AUTHENTICATOR)
+    get_db().hset(key, mapping={'name': "Race", 'group': "admin"})
+
+    def demoted_meanwhile(fields):
+        # The message of another worker arrives after HGETALL, before the user is cached
+        get_db().hset(key, 'group', "viewer")
+        forget(key)
+        return dict(fields)
+
+    assert get_user(key, demoted_meanwhile)['group'] == "admin"
+    assert get_user(key, dict)['group'] == "viewer"
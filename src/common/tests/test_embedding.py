@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from src.common.embedding import EmbeddingClient, EmbeddingError
+from src.common.histogram import Histogram
+from src.services.embedder import MicroBatcher, EncodeJob, serve
+
+
+class StubModel:
+    """Encodes a text as [its length, its position in the batch], and records the batches."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.batches = []
+
+    def encode(self, texts, batch_size=None):
+        self.batches.append(list(texts))
+        time.sleep(self.delay)
+        if "fail" in texts:
+            raise RuntimeError("encoding failed")
+        return np.array([[len(text), i] for i, text in enumerate(texts)], dtype=np.float64)
+
+
+def start_batcher(model, max_batch=8, max_wait_ms=50):
+    batcher = MicroBatcher(model, max_batch, max_wait_ms)
+    threading.Thread(target=batcher.run, daemon=True).start()
+    return batcher
+
+
+def test_embedding_histogram_buckets():
+    histogram = Histogram([10, 1, 5])
+    for value in (0.5, 1, 3, 5, 7, 100):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    # Cumulative, in the order of the bounds, a value equal to a bound counted in its bucket
+    assert snapshot['buckets'] == [(1, 2), (5, 4), (10, 5), ("+Inf", 6)]
+    assert snapshot['count'] == 6
+    assert snapshot['sum'] == pytest.approx(116.5)
+
+
+def test_embedding_batch_bounded_by_size():
+    batcher = MicroBatcher(StubModel(), max_batch=4, max_wait_ms=1000)
+    jobs = [EncodeJob(["a", "b"]), EncodeJob(["c", "d", "e"]), EncodeJob(["f"])]
+    for job in jobs:
+        batcher.jobs.put(job)
+    start = time.monotonic()
+    # Full once it holds 4 texts or more, without waiting for the deadline
+    assert batcher.next_batch() == jobs[:2]
+    assert time.monotonic() - start < 0.5
+    assert batcher.next_batch() == jobs[2:]
+
+
+def test_embedding_batch_bounded_by_wait():
+    batcher = MicroBatcher(StubModel(), max_batch=100, max_wait_ms=50)
+    batcher.jobs.put(EncodeJob(["a"]))
+    start = time.monotonic()
+    assert len(batcher.next_batch()) == 1
+    assert 0.04 <= time.monotonic() - start < 0.5
+
+
+def test_embedding_concurrent_requests_coalesced():
+    model = StubModel(delay=0.05)
+    batcher = start_batcher(model, max_batch=64, max_wait_ms=20)
+    texts = [["x" * (n + 1)] * (n % 3 + 1) for n in range(12)]
+    results = [None] * len(texts)
+
+    def submit(n):
+        results[n] = batcher.submit(texts[n])
+
+    threads = [threading.Thread(target=submit, args=(n,)) for n in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every client gets the vectors of its own texts, in fewer encodes than requests
+    for n, result in enumerate(results):
+        assert result.dtype == np.float32
+        assert result[:, 0].tolist() == [len(text) for text in texts[n]]
+    assert len(model.batches) < len(texts)
+    assert sum(len(batch) for batch in model.batches) == sum(len(t) for t in texts)
+    assert max(len(batch) for batch in model.batches) <= 64
+    stats = batcher.stats()
+    assert stats['batch_size']['count'] == len(model.batches)
+    assert stats['latency_ms']['count'] == len(texts)
+
+
+def test_embedding_error_sent_to_every_job_of_the_batch():
+    batcher = start_batcher(StubModel(), max_batch=8, max_wait_ms=20)
+    with pytest.raises(RuntimeError):
+        batcher.submit(["fail"])
+    # The batcher keeps serving
+    assert batcher.submit(["ok"])[0, 0] == 2
+    assert batcher.submit([]).shape == (0, 0)
+
+
+def test_embedding_client_round_trip(tmp_path):
+    address = str(tmp_path / "embedder.sock")
+    threading.Thread(target=serve, args=(address, StubModel()), kwargs={'max_batch': 8, 'max_wait_ms': 5},
+                     daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.01)
+
+    client = EmbeddingClient(address, timeout=5)
+    vectors = client.encode(["a", "bcd"])
+    assert vectors.shape == (2, 2)
+    assert vectors[:, 0].tolist() == [1, 3]
+    # A single text gives a single vector, as with SentenceTransformer
+    assert client.encode("abcde").tolist() == [5, 0]
+    assert client.stats()['batch_size']['count'] == 2
+
+    # Errors of the server are raised by the client, which can still be used
+    with pytest.raises(EmbeddingError):
+        client.encode(["fail"])
+    with pytest.raises(EmbeddingError):
+        client.request({"op": "unknown"})
+
+    # A connection closed is opened again
+    client.sock.close()
+    assert client.encode(["ab"])[0, 0] == 2
+    client.close()
@@ -0,0 +1,27 @@
+from src.common.config import CFG_METRICS_TOKEN
+from src.common.metrics import exposition, registry
+from src.common.utils import get_db
+
+
+def test_metrics_buckets_numeric_order():
+    get_db().flushall()
+    for duration in (0.003, 0.07, 0.7, 7, 70):
+        registry.enter()
+        registry.observe('main_bp.about', 'GET', '200', duration, 100)
+    registry.flush()
+
+    lines = [line for line in exposition().splitlines()
+             if line.startswith('keybase_http_request_duration_seconds_bucket{endpoint="main_bp.about"')]
+    bounds = [line.split('le="')[1].split('"')[0] for line in lines]
+    assert bounds[-1] == "+Inf"
+    assert [float(bound) for bound in bounds] == sorted(float(bound) for bound in bounds)
+    assert lines[-1].endswith(" 5")
+
+
+def test_metrics_local_only_without_token(test_client):
+    if CFG_METRICS_TOKEN:
+        return
+    get_db().flushall()
+    assert test_client.get("/metrics").status_code == 200
+    assert test_client.get("/metrics", environ_base={'REMOTE_ADDR': "10.0.0.1"}).status_code == 403
+    assert test_client.get("/metrics", headers={'X-Forwarded-For': "10.0.0.1"}).status_code == 403
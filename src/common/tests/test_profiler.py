@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import src.application
+import src.common.profiler
+from src.application import create_app
+from src.common.profiler import Collector, profile_pool, _collector
+from src.common.utils import get_db, get_pool
+
+
+@pytest.fixture
+def profiled_pool(monkeypatch):
+    # New connections of the pool are profiled, as when CFG_PROFILER is set at startup
+    pool = get_pool()
+    monkeypatch.setattr(pool, "connection_class", pool.connection_class)
+    profile_pool(pool)
+    pool.reset()
+    yield pool
+    pool.reset()
+
+
+def test_profiler_records_commands_and_round_trips(profiled_pool):
+    get_db().flushall()
+    collector = Collector()
+    token = _collector.set(collector)
+    try:
+        get_db().set("keybase:profiled:01GZ8K3NDN6X1QWB5VJY3T9RZ2", "value")
+        pipeline = get_db().pipeline(transaction=False)
+        pipeline.get("keybase:profiled:01GZ8K3NDN6X1QWB5VJY3T9RZ2")
+        pipeline.hgetall("keybase:categories")
+        pipeline.execute()
+    finally:
+        _collector.reset(token)
+
+    assert [command['name'] for command in collector.commands] == ["SET", "GET", "HGETALL"]
+    # The commands of the pipeline share one round trip
+    assert collector.round_trips == 2
+    assert [command['trip'] for command in collector.commands] == [1, 2, 2]
+    # Ids are masked in the key patterns
+    assert collector.commands[0]['key'] == "keybase:profiled:*"
+    assert collector.commands[1]['reply'] == len("value")
+    assert collector.summary() == {"SET": 1, "GET": 1, "HGETALL": 1}
+
+
+def test_profiler_headers_only_when_enabled(profiled_pool, monkeypatch):
+    get_db().flushall()
+    with create_app().test_client() as client:
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "X-Redis-Commands" not in response.headers
+    assert "Server-Timing" not in response.headers
+
+    monkeypatch.setattr(src.application, "CFG_PROFILER", 1)
+    with create_app().test_client() as client:
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "HGETALL=1" in response.headers["X-Redis-Commands"]
+    assert "round-trips=" in response.headers["X-Redis-Commands"]
+    assert response.headers["Server-Timing"].startswith("redis;dur=")
+
+
+def test_profiler_samples_capped_stream(profiled_pool, monkeypatch):
+    get_db().flushall()
+    monkeypatch.setattr(src.application, "CFG_PROFILER", 1)
+    monkeypatch.setattr(src.common.profiler, "CFG_PROFILER_SAMPLE", 1)
+    monkeypatch.setattr(src.common.profiler, "CFG_PROFILER_MAXLEN", 5)
+    with create_app().test_client() as client:
+        for _ in range(250):
+            client.get("/metrics")
+
+    entries = get_db().xrevrange("keybase:profiler", count=1)
+    sample = entries[0][1]
+    assert sample['endpoint'] == "main_bp.metrics"
+    assert sample['status'] == "200"
+    assert "HGETALL" in [command['name'] for command in json.loads(sample['detail'])]
+    # Trimmed by whole nodes of the stream, so about the cap
+    assert get_db().xlen("keybase:profiler") < 250
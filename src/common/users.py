@@ -0,0 +1,113 @@
+import itertools
+import threading
+import time
+
+import redis
+
+from src.common.cache import TTLCache
+from src.common.config import CFG_AUTHENTICATOR, CFG_USER_CACHE_SIZE, CFG_USER_CACHE_TTL
+from src.common.utils import get_db, forget_categories, CHANNEL, CATEGORIES
+
+# Users loaded by login_manager.user_loader, for both src/auth and src/okta, cached by the key of their hash
+# (keybase:auth:<id>, keybase:okta:<id>) and read from the database on a miss.
+# A change of the group or of the profile of a user is published on CHANNEL, and every worker drops the user from its
+# cache, so the change applies to the next request, whatever the worker. Entries expire after CFG_USER_CACHE_TTL
+# seconds anyway, which bounds the staleness if a message is lost.
+# Display names of the authors shown in the lists of documents are cached the same way, by the same key, and the
+# categories are dropped when their key is published.
+# A read from the database is only cached if the key was not invalidated meanwhile: every invalidation gives the key a
+# new generation, compared before and after the read, else a user demoted during the read would be cached as before.
+
+_users = TTLCache(maxsize=CFG_USER_CACHE_SIZE, ttl=CFG_USER_CACHE_TTL)
+_names = TTLCache(maxsize=CFG_USER_CACHE_SIZE, ttl=CFG_USER_CACHE_TTL)
+_generations = TTLCache(maxsize=CFG_USER_CACHE_SIZE, ttl=CFG_USER_CACHE_TTL)
+_counter = itertools.count(1)
+# Generation of all the keys, when the messages may have been lost
+_epoch = 0
+_listener = None
+_lock = threading.Lock()
+
+
+def generation(key):
+    return _epoch, _generations.get(key)
+
+
+def forget(key):
+    _generations.set(key, next(_counter))
+    _users.pop(key)
+    _names.pop(key)
+
+
+def listen():
+    global _epoch
+    while True:
+        try:
+            pubsub = get_db().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            # Messages published while not subscribed are lost
+            _epoch = next(_counter)
+            _users.clear()
+            _names.clear()
+            forget_categories()
+            for message in pubsub.listen():
+                if message['data'] == CATEGORIES:
+                    forget_categories()
+                forget(message['data'])
+        except redis.exceptions.ConnectionError:
+            time.sleep(1)
+
+
+def start_listener():
+    # Started by the first request of every worker, and again in a worker forked after it
+    global _listener
+    if _listener is not None and _listener.is_alive():
+        return
+    with _lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=listen, name="users-invalidation", daemon=True)
+            _listener.start()
+
+
+def get_user(key, factory):
+    # factory builds the user from the fields of its hash
+    start_listener()
+    user = _users.get(key)
+    if user is None:
+        before = generation(key)
+        fields = get_db().hgetall(key)
+        if not fields:
+            return None
+        user = factory(fields)
+        if generation(key) == before:
+            _users.set(key, user)
+    return user
+
+
+def get_user_names(user_ids):
+    # {id: display name or None}, the names not cached are read in one round trip
+    start_listener()
+    keys = {user_id: "keybase:{}:{}".format(CFG_AUTHENTICATOR, user_id) for user_id in user_ids}
+    names = {user_id: _names.get(key) for user_id, key in keys.items()}
+    missing = [user_id for user_id, name in names.items() if name is None]
+    if missing:
+        before = {user_id: generation(keys[user_id]) for user_id in missing}
+        pipeline = get_db().pipeline(transaction=False)
+        for user_id in missing:
+            pipeline.hget(keys[user_id], "name")
+        for user_id, name in zip(missing, pipeline.execute()):
+            # Unknown users are read again next time
+            if name is not None and generation(keys[user_id]) == before[user_id]:
+                _names.set(keys[user_id], name)
+            names[user_id] = name
+    return names
+
+
+def cache_user(key, user):
+    _users.set(key, user)
+    return user
+
+
+def invalidate_user(key):
+    # Dropped here at once, in the other workers when they receive the message
+    forget(key)
+    get_db().publish(CHANNEL, key)
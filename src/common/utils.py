@@ -1,7 +1,4 @@
-import time
-import json
 import redis
-from datetime import datetime
 from enum import IntEnum
 from flask import redirect, url_for
 
@@ -11,13 +8,25 @@ from flask_login import current_user
 from functools import wraps
 import urllib.parse
 
-from src.common.config import REDIS_CFG
+from src.common.config import REDIS_CFG, CFG_VSS_PROJECTION, CFG_REQUESTS_MAXLEN, \
+    CFG_ERRORS_MAXLEN, CFG_PROFILER, CFG_DB_POOL_SIZE, CFG_DB_POOL_TIMEOUT, CFG_CATEGORIES_CACHE_TTL
+from src.common.cache import TTLCache
 import re
 
 
-def get_db(decode=True):
-    try:
-        return redis.StrictRedis(host=REDIS_CFG["host"],
+# Changes of the data cached by the workers are published on CHANNEL, see src/common/users.py
+CHANNEL = "keybase:users:invalidate"
+CATEGORIES = "keybase:categories"
+
+# One connection pool per process and decoding mode, shared by all the clients returned by get_db()
+_pools = {}
+_categories = TTLCache(maxsize=1, ttl=CFG_CATEGORIES_CACHE_TTL)
+
+
+def get_pool(decode=True):
+    pool = _pools.get(decode)
+    if pool is None:
+        pool = redis.StrictRedis(host=REDIS_CFG["host"],
                                  port=REDIS_CFG["port"],
                                  password=REDIS_CFG["password"],
                                  db=0,
@@ -26,7 +35,28 @@ def get_db(decode=True):
                                  ssl_certfile=REDIS_CFG["ssl_certfile"],
                                  ssl_ca_certs=REDIS_CFG["ssl_ca_certs"],
                                  ssl_cert_reqs=REDIS_CFG["ssl_cert_reqs"],
-                                     decode_responses=decode)
+                                 decode_responses=decode).connection_pool
+        if CFG_DB_POOL_SIZE:
+            # Bounded: requests wait for a connection rather than opening one each
+            pool = redis.BlockingConnectionPool(max_connections=CFG_DB_POOL_SIZE, timeout=CFG_DB_POOL_TIMEOUT,
+                                                connection_class=pool.connection_class, **pool.connection_kwargs)
+        if CFG_PROFILER:
+            from src.common.profiler import profile_pool
+            profile_pool(pool)
+        pool = _pools.setdefault(decode, pool)
+    return pool
+
+
+def reset_connections():
+    # In a worker forked from a master that used the pools, as with gunicorn --preload. The connections of the
+    # master are forgotten, not closed, as the master may still use them
+    for pool in _pools.values():
+        pool.reset()
+
+
+def get_db(decode=True):
+    try:
+        return redis.StrictRedis(connection_pool=get_pool(decode))
     except redis.exceptions.ConnectionError:
         return redirect(url_for("main_bp.error-page"))
 
@@ -34,14 +64,41 @@ def get_db(decode=True):
 def track_request():
     if current_user.is_authenticated and request.full_path is not None:
         data = {'full_path': request.full_path, 'user': current_user.id}
-        get_db().xadd("keybase:requests", data)
+        # The stream is archived by src/services/archiver.py, the cap only bounds memory if the archiver is not running
+        get_db().xadd("keybase:requests", data, maxlen=CFG_REQUESTS_MAXLEN, approximate=True)
 
 
 def track_errors(e):
     data = {'err': str(e),
             'full_path': request.full_path,
             'agent': request.headers.get('User-Agent')}
-    get_db().xadd("keybase:errors", data)
+    get_db().xadd("keybase:errors", data, maxlen=CFG_ERRORS_MAXLEN, approximate=True)
+
+
+def get_vss_index():
+    # Recommendations are served from the reduced embeddings when a projection is active
+    if CFG_VSS_PROJECTION:
+        return "vss_idx_v{}".format(CFG_VSS_PROJECTION), "content_embedding_v{}".format(CFG_VSS_PROJECTION)
+    return "vss_idx", "content_embedding"
+
+
+def get_categories():
+    # {id: name} of the categories, read by most pages and rarely changed. Do not modify the dictionary returned
+    categories = _categories.get('categories')
+    if categories is None:
+        categories = get_db().hgetall(CATEGORIES)
+        _categories.set('categories', categories)
+    return categories
+
+
+def forget_categories():
+    _categories.clear()
+
+
+def invalidate_categories():
+    # Dropped here at once, in the other workers when they receive the message
+    forget_categories()
+    get_db().publish(CHANNEL, CATEGORIES)
 
 
 def parse_query_string(q):
@@ -62,18 +119,6 @@ def pretty_title(title):
     return re.sub('[^0-9a-zA-Z]+', '-', title).strip("-").lower()
 
 
-def get_analytics(timeseries, bucket, duration):
-    ts = round(time.time() * 1000)
-    ts0 = ts - duration
-    data_ts = get_db().ts().range(timeseries, from_time=ts0, to_time=ts, aggregation_type='sum',
-                                  bucket_size_msec=bucket)
-    data_labels = [datetime.utcfromtimestamp(int(x[0] / 1000)).strftime('%b %d') for x in data_ts]
-    data = [x[1] for x in data_ts]
-    data_graph = {'labels': data_labels, 'value': data}
-    points = json.dumps(data_graph)
-    return points
-
-
 def requires_access_level(access_level):
     def decorator(f):
         @wraps(f)
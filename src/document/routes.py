@@ -12,7 +12,12 @@ from src.common.config import CFG_VSS_WITH_LUA
 from pydantic import ValidationError
 from redis_om import NotFoundError
 
-from src.common.utils import get_db, parse_query_string, get_analytics, pretty_title, track_request, requires_access_level, Role
+from src.common.utils import get_db, parse_query_string, pretty_title, track_request, requires_access_level, Role, \
+    get_vss_index, get_categories
+from src.analytics.timeseries import count_event, get_analytics, document_labels, relabel_series, delete_series
+from src.analytics.views import record_view
+from src.analytics.visitors import visitor_id, get_unique_visitors, delete_visitors
+from src.bookmarks.bookmarks import is_bookmarked
 
 document_bp = Blueprint('document_bp', __name__,
                         template_folder='./templates')
@@ -25,7 +30,7 @@ def before_request():
 
     # Store visits in a time series visited pages
     if current_user.is_authenticated and request.endpoint == "document_bp.doc":
-        get_db().ts().add("keybase:visits", "*", 1, duplicate_policy='first')
+        count_event("keybase:visits", type='visits')
 
 
 @document_bp.route('/autocomplete', methods=['GET'])
@@ -81,7 +86,7 @@ def browse():
                 queryfilter = "@currentversion_name_fts|currentversion_content_fts:'" + queryfilter + "'"
             # If the category is good, can be processed and set in the UI
             if flask.request.args.get('cat'):
-                if get_db().hexists("keybase:categories", flask.request.args.get('cat')):
+                if flask.request.args.get('cat') in get_categories():
                     catfilter = " @category:{"+flask.request.args.get('cat')+"} "
                     category = flask.request.args.get('cat')
 
@@ -115,7 +120,7 @@ def browse():
             keydocument = zip(keys, names, pretty, creations)
 
         # Get the categories
-        categories = get_db().hgetall("keybase:categories")
+        categories = get_categories()
         return render_template('browse.html', title=title, desc=desc, categories=categories, keydocument=keydocument, page=page,
                                per_page=per_page, pagination=pagination, category=category, asc=asc, privacy=prv)
     except RedisError as err:
@@ -274,6 +279,10 @@ def addcategory():
 
     document.category = request.form['cat']
     document.save()
+
+    # Views are aggregated by category
+    relabel_series("keybase:docview:{}".format(document.pk),
+                   document_labels(document.pk, document.category, document.privacy, document.author))
     return jsonify(message="The category has been changed", code="success")
 
 
@@ -296,6 +305,9 @@ def setprivacy():
 
     document.privacy = request.form['privacy']
     document.save()
+
+    relabel_series("keybase:docview:{}".format(document.pk),
+                   document_labels(document.pk, document.category, document.privacy, document.author))
     return jsonify(message="The privacy has been changed", code="success")
 
 
@@ -362,7 +374,7 @@ def edit(pk):
 
     # These are all the categories in the system, for the taxonomy
     # System tags are not returned, now. They can be searched
-    categories = get_db().hgetall("keybase:categories")
+    categories = get_categories()
 
     document.editorversion.name = urllib.parse.quote(document.editorversion.name)
     document.editorversion.content = urllib.parse.quote(document.editorversion.content)
@@ -382,6 +394,8 @@ def delete(pk):
     try:
         Document.delete(pk)
         get_db().delete("keybase:vss:{}".format(pk))
+        delete_series("keybase:docview:{}".format(pk))
+        delete_visitors(pk)
     except NotFoundError:
         return redirect(url_for('document_bp.browse')), 404
 
@@ -405,7 +419,7 @@ def doc(pk, prettyurl):
         return render_template('404.html'), 404
 
     # Check if the document is bookmarked
-    bookmarked = get_db().hexists("keybase:bookmark:{}".format(current_user.id), pk)
+    bookmarked = is_bookmarked(current_user.id, pk)
 
     # If it is a draft, make sure the user is not a viewer
     if document.state == 'draft' and current_user.is_viewer():
@@ -419,22 +433,26 @@ def doc(pk, prettyurl):
     document.currentversion.name = urllib.parse.quote(document.currentversion.name)
     document.currentversion.content = urllib.parse.quote(document.currentversion.content)
 
-    # The document can be rendered, count the visit
-    get_db().ts().add("keybase:docview:{}".format(pk), "*", 1, duplicate_policy='first')
+    # The document can be rendered, count the visit; drafts are not trending
+    record_view(pk, document_labels(pk, document.category, document.privacy, document.author),
+                audience='internal' if document.state != 'draft' else None, visitor=visitor_id())
 
     # Only the admin can see document visits
     analytics = None
+    visitors = None
     if current_user.is_admin():
         analytics = get_analytics("keybase:docview:{}".format(pk), 86400000, 2592000000)
+        visitors = get_unique_visitors(pk)
 
     # Fetch recommendations using LUA and avoid sending vector embeddings back and forth
     # The first element in the returned list is the number of keys returned, start iterator from [1:]
     # Then, iterate the results in pairs, because the key name is alternated with the returned fields
-    if get_db().hexists("keybase:vss:{}".format(pk), "content_embedding"):
+    vss_index, vss_field = get_vss_index()
+    if get_db().hexists("keybase:vss:{}".format(pk), vss_field):
         if CFG_VSS_WITH_LUA:
-            keys_and_args = ["keybase:vss:{}".format(pk)]
+            keys_and_args = ["keybase:vss:{}".format(pk), vss_index, vss_field]
             res = get_db().eval(
-                "local vector = redis.call('HMGET',KEYS[1], 'content_embedding') local searchres = redis.call('FT.SEARCH','vss_idx','(@state:{published|review})=>[KNN 6 @content_embedding $B AS score]','PARAMS','2','B',vector[1], 'SORTBY', 'score', 'ASC', 'LIMIT', 1, 6,'RETURN',2,'score','name','DIALECT',2) return searchres",
+                "local vector = redis.call('HMGET',KEYS[1], ARGV[2]) local searchres = redis.call('FT.SEARCH',ARGV[1],'(@state:{published|review})=>[KNN 6 @'..ARGV[2]..' $B AS score]','PARAMS','2','B',vector[1], 'SORTBY', 'score', 'ASC', 'LIMIT', 1, 6,'RETURN',2,'score','name','DIALECT',2) return searchres",
                 1, *keys_and_args)
             it = iter(res[1:])
             for x in it:
@@ -444,14 +462,14 @@ def doc(pk, prettyurl):
                 pretty.append(pretty_title(docname))
             suggestlist = zip(keys, names, pretty)
         else:
-            embedding = get_db(decode=False).hget("keybase:vss:{}".format(pk), "content_embedding")
-            q = Query("(@state:{published|review})=>[KNN 6 @content_embedding $B AS score]")\
+            embedding = get_db(decode=False).hget("keybase:vss:{}".format(pk), vss_field)
+            q = Query("(@state:{published|review})=>[KNN 6 @" + vss_field + " $B AS score]")\
                 .return_field("score")\
                 .return_field("name")\
                 .sort_by("score", asc=True)\
                 .dialect(2)\
                 .paging(1, 6)
-            res = get_db().ft("vss_idx").search(q, query_params={"B": embedding})
+            res = get_db().ft(vss_index).search(q, query_params={"B": embedding})
             it = iter(res.docs[0:])
             for x in it:
                 keys.append(str(x['id'].split(':')[-1]))
@@ -466,7 +484,8 @@ def doc(pk, prettyurl):
                            bookmarked=bookmarked,
                            document=document,
                            suggestlist=suggestlist,
-                           analytics=analytics)
+                           analytics=analytics,
+                           visitors=visitors)
 
 
 @document_bp.route('/new/<doc>')
@@ -2,6 +2,8 @@ from src.okta.user import OktaUser
 import json
 import flask_login
 from src.common.config import REDIS_CFG
+from src.common.ratelimit import LIMITS
+from src.common.utils import get_db
 
 
 def user2_auth():
@@ -336,3 +338,17 @@ def test_document_metadata_allowed(test_client, create_document):
                                                       'keyword': 'redis,real-time',
                                                       'description': 'Welcome to the Redis Knowledge Base! In this portal, you will find guides, articles, tutorials, and more for all the Redis solutions and clients.'})
     assert response.status_code == 200
+
+
+def test_document_search_rate_limited_rotating_headers(test_client, monkeypatch):
+    for key in get_db().scan_iter("keybase:ratelimit:*"):
+        get_db().delete(key)
+    monkeypatch.setitem(LIMITS, 'public_bp.search', (0.1, 2))
+    statuses = []
+    for i in range(3):
+        response = test_client.get("/search", query_string={"q": "redis"},
+                                   headers={'X-Api-Key': "random{}".format(i),
+                                            'X-Forwarded-For': "10.0.0.{}".format(i)})
+        statuses.append(response.status_code)
+    assert statuses[2] == 429
+    assert len(list(get_db().scan_iter("keybase:ratelimit:*"))) == 1
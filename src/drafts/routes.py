@@ -1,11 +1,14 @@
+import re
 import urllib.parse
 from datetime import datetime
 
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, request
 from flask_login import (current_user, login_required)
+from flask_paginate import Pagination, get_page_args
+from redis.commands.search.query import Query
 
+from src.common.users import get_user_names
 from src.common.utils import get_db, pretty_title, track_request, requires_access_level, Role
-from src.document.document import Document
 
 
 drafts_bp = Blueprint('drafts_bp', __name__,
@@ -18,33 +21,64 @@ def before_request():
     track_request()
 
 
+def author_filter(author):
+    # Author ids are TAG values, punctuation must be escaped
+    return " @author:{" + re.sub(r'(\W)', r'\\\1', author) + "}"
+
+
+def count_drafts():
+    # [(author, drafts)] of all the authors, most drafts first, counted by the index
+    reply = get_db().execute_command("FT.AGGREGATE", "document_idx", "@state:{draft}",
+                                     "GROUPBY", 1, "@author", "REDUCE", "COUNT", 0, "AS", "drafts",
+                                     "SORTBY", 2, "@drafts", "DESC", "MAX", 100)
+    counts = []
+    for row in reply[1:]:
+        fields = dict(zip(row[::2], row[1::2]))
+        counts.append((fields['author'], int(fields['drafts'])))
+    return counts
+
+
 @drafts_bp.route('/drafts')
 @login_required
 @requires_access_level(Role.EDITOR)
 def drafts():
-    keys = []
-    names = []
-    pretty = []
-    owner = []
-    updates = []
     docs = None
+    pagination = None
+    counts = None
 
-    # Search for own drafts if not admin
+    # Own drafts if not admin, and if you are admin, also everybody else's drafts, by author if requested
     if not current_user.is_admin():
-        jrs = Document.find((Document.state == "draft") &
-                            (Document.author == current_user.id)
-                            ).sort_by("-updated").all()
+        query = "@state:{draft}" + author_filter(current_user.id)
     else:
-        # And if you are admin, also everybody else's drafts
-        jrs = Document.find((Document.state == "draft")).sort_by("-updated").all()
-
-    if len(jrs):
-        for jdoc in jrs:
-            keys.append(jdoc.pk)
-            names.append(urllib.parse.unquote(jdoc.editorversion.name))
-            pretty.append(pretty_title(urllib.parse.unquote(jdoc.editorversion.name)))
-            owner.append(get_db().hget("keybase:okta:{}".format(jdoc.author), "name"))
-            updates.append(datetime.utcfromtimestamp(int(jdoc.updated)).strftime('%Y-%m-%d %H:%M:%S'))
-        docs = zip(keys, names, pretty, owner, updates)
-
-    return render_template("draft.html", drafts=docs)
+        query = "@state:{draft}" + (author_filter(request.args['author']) if request.args.get('author') else "")
+
+    # Only the fields shown, for one page
+    page, per_page, offset = get_page_args(page_parameter='page', per_page_parameter='per_page')
+    rs = get_db().ft("document_idx").search(
+        Query(query)
+        .return_field("$.editorversion.name", as_field="name")
+        .return_field("updated")
+        .return_field("author")
+        .sort_by("updated", asc=False)
+        .paging(offset, per_page))
+
+    if current_user.is_admin():
+        counts = count_drafts()
+
+    # Display names of the authors of the page, and of the counts, in one lookup
+    authors = set(doc.author for doc in rs.docs) | set(author for author, _ in counts or [])
+    names = get_user_names(list(authors))
+
+    if len(rs.docs):
+        docs = []
+        for doc in rs.docs:
+            name = urllib.parse.unquote(doc.name)
+            docs.append((doc.id.split(':')[-1], name, pretty_title(name), names.get(doc.author),
+                         datetime.utcfromtimestamp(int(doc.updated)).strftime('%Y-%m-%d %H:%M:%S')))
+        pagination = Pagination(page=page, per_page=per_page, total=rs.total, css_framework='bulma',
+                                bulma_style='small', prev_label='Previous', next_label='Next page')
+
+    if counts is not None:
+        counts = [(author, names.get(author) or author, drafts) for author, drafts in counts]
+    return render_template("draft.html", drafts=docs, pagination=pagination, counts=counts,
+                           author=request.args.get('author'))
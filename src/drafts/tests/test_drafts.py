@@ -7,3 +7,13 @@ def test_drafts_read_mine(test_client, create_document, captured_templates):
     template, context = captured_templates[0]
     assert template.name == "draft.html"
     assert "drafts" in context
+
+
+def test_drafts_page_and_counts(test_client, create_document, user_auth, captured_templates):
+    user_auth.set_group("admin")
+    response = test_client.get("/drafts", query_string={"per_page": 1})
+    assert response.status_code == 200
+    template, context = captured_templates[0]
+    assert [(draft[0], draft[3]) for draft in context['drafts']] == [(create_document, "test_username")]
+    assert context['pagination'].total == 1
+    assert context['counts'] == [(user_auth.id, "test_username", 1)]
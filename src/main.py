@@ -1,8 +1,15 @@
-from flask import Blueprint, render_template
+import hmac
+
+from flask import Blueprint, Response, render_template, request
 from flask_login import (login_required)
 
+from src.common.config import CFG_METRICS_TOKEN
+from src.common.metrics import exposition
+
 main_bp = Blueprint('main_bp', __name__)
 
+LOCAL = {'127.0.0.1', '::1'}
+
 
 @main_bp.route('/about', methods=['GET'])
 @login_required
@@ -20,4 +27,17 @@ def trigger_error():
 
 @main_bp.route('/error-page')
 def custom_error():
-    return render_template('500.html')
\ No newline at end of file
+    return render_template('500.html')
+
+
+@main_bp.route('/metrics')
+def metrics():
+    # Scraped by Prometheus with the bearer token CFG_METRICS_TOKEN. Without it, only from this host, and not
+    # through a proxy which would make every client look local
+    if CFG_METRICS_TOKEN:
+        expected = "Bearer {}".format(CFG_METRICS_TOKEN).encode()
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+            return Response(response="Unauthorized", status=403)
+    elif request.remote_addr not in LOCAL or 'X-Forwarded-For' in request.headers:
+        return Response(response="Unauthorized", status=403)
+    return Response(exposition(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,151 @@
+import base64
+import hmac
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from src.common.config import okta, CFG_OKTA_CONNECT_TIMEOUT, CFG_OKTA_READ_TIMEOUT, CFG_OKTA_JWKS_REFRESH
+
+# OpenID Connect with Okta: one pooled HTTP session with timeouts for all the calls, and the ID tokens validated
+# locally, with the signing keys of Okta (JWKS) cached and refreshed every CFG_OKTA_JWKS_REFRESH seconds by a
+# background thread, or at once when a token is signed by a key not seen yet.
+TIMEOUT = (CFG_OKTA_CONNECT_TIMEOUT, CFG_OKTA_READ_TIMEOUT)
+# Seconds of clock difference accepted with Okta, and between two refreshes forced by unknown keys
+LEEWAY = 120
+MIN_REFRESH = 60
+
+
+class TokenError(ValueError):
+    pass
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+http = create_session()
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def public_key(jwk):
+    numbers = rsa.RSAPublicNumbers(int.from_bytes(b64decode(jwk['e']), 'big'),
+                                   int.from_bytes(b64decode(jwk['n']), 'big'))
+    return numbers.public_key()
+
+
+class KeySet:
+    """Signing keys of Okta, by key id."""
+
+    def __init__(self, uri, refresh):
+        self.uri = uri
+        self.refresh = refresh
+        self.keys = {}
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def fetch(self):
+        # The keys cached so far are kept if the key set cannot be read
+        response = http.get(self.uri, timeout=TIMEOUT)
+        response.raise_for_status()
+        try:
+            keys = {jwk['kid']: public_key(jwk) for jwk in response.json()['keys']
+                    if jwk.get('kty') == 'RSA' and jwk.get('use', 'sig') == 'sig'}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise TokenError("Malformed key set: {!r}".format(e))
+        if not keys:
+            raise TokenError("No signing key in the key set")
+        with self.lock:
+            self.keys = keys
+            self.fetched = time.monotonic()
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh)
+            try:
+                self.fetch()
+            except (requests.RequestException, TokenError):
+                # Kept until the next refresh, or until a token needs a new key
+                pass
+
+    def get(self, kid):
+        # Started on first use, and again in a worker forked after the first login
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="okta-jwks", daemon=True)
+                self.thread.start()
+            key = self.keys.get(kid)
+            stale = time.monotonic() - self.fetched > MIN_REFRESH
+        if key is None and stale:
+            # Keys rotated, or first use
+            self.fetch()
+            key = self.keys.get(kid)
+        return key
+
+
+keyset = KeySet(okta["jwks_uri"], CFG_OKTA_JWKS_REFRESH)
+
+
+def validate_id_token(id_token, nonce):
+    # The claims of the token if it is signed by Okta for this application, and not expired, or TokenError
+    try:
+        header, payload, signature = id_token.split('.')
+        header_data = json.loads(b64decode(header))
+        claims = json.loads(b64decode(payload))
+        signature = b64decode(signature)
+    except ValueError:
+        raise TokenError("Malformed ID token")
+
+    if header_data.get('alg') != 'RS256':
+        raise TokenError("Unsupported algorithm {}".format(header_data.get('alg')))
+    key = keyset.get(header_data.get('kid'))
+    if key is None:
+        raise TokenError("Unknown signing key {}".format(header_data.get('kid')))
+    try:
+        key.verify(signature, "{}.{}".format(header, payload).encode('ascii'), padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise TokenError("Invalid signature")
+
+    now = time.time()
+    if claims.get('iss') != okta["issuer"]:
+        raise TokenError("Invalid issuer")
+    audience = claims.get('aud')
+    if okta["client_id"] not in (audience if isinstance(audience, list) else [audience]):
+        raise TokenError("Invalid audience")
+    if claims.get('exp', 0) < now - LEEWAY:
+        raise TokenError("Expired")
+    if claims.get('iat', 0) > now + LEEWAY:
+        raise TokenError("Issued in the future")
+    # A session that did not start the login has no nonce, and must not accept a token without one
+    if not nonce or not hmac.compare_digest(str(claims.get('nonce', '')).encode(), nonce.encode()):
+        raise TokenError("Invalid nonce")
+    return claims
+
+
+def exchange_code(code, code_verifier):
+    response = http.post(okta["token_uri"],
+                         data={'grant_type': 'authorization_code',
+                               'code': code,
+                               'redirect_uri': okta["redirect_uri"],
+                               'code_verifier': code_verifier},
+                         auth=(okta["client_id"], okta["client_secret"]),
+                         timeout=TIMEOUT)
+    return response.json()
+
+
+def get_userinfo(access_token):
+    return http.get(okta["userinfo_uri"], headers={'Authorization': 'Bearer {}'.format(access_token)},
+                    timeout=TIMEOUT).json()
@@ -12,8 +12,12 @@ from flask_paginate import get_page_args, Pagination
 
 from redis.commands.search.query import Query
 from src.okta.user import OktaUser
+from src.okta.oidc import TokenError, exchange_code, validate_id_token, get_userinfo
+from src.common.users import invalidate_user
+from src.common.session import rotate_session
 from src.common.config import okta
 from src.common.utils import get_db, requires_access_level, Role, parse_query_string
+from src.analytics.timeseries import count_event
 
 auth_bp = Blueprint('auth_bp', __name__,
                     template_folder='./templates')
@@ -108,6 +112,7 @@ def login():
     # store app state and code verifier in session
     session['app_state'] = secrets.token_urlsafe(64)
     session['code_verifier'] = secrets.token_urlsafe(64)
+    session['nonce'] = secrets.token_urlsafe(32)
     session.permanent = True
 
     # calculate code challenge
@@ -120,6 +125,7 @@ def login():
                     'redirect_uri': okta["redirect_uri"],
                     'scope': "openid email profile",
                     'state': session['app_state'],
+                    'nonce': session['nonce'],
                     'code_challenge': code_challenge,
                     'code_challenge_method': 'S256',
                     'response_type': 'code',
@@ -141,7 +147,6 @@ def page_not_found(error):
 
 @auth_bp.route("/authorization-code/callback")
 def callback():
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     code = request.args.get("code")
     app_state = request.args.get("state")
 
@@ -156,49 +161,46 @@ def callback():
         print("KeyError error: app_state missing")
         return redirect(url_for('document_bp.kb-admin'))
 
-    query_params = {'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': okta["redirect_uri"],
-                    'code_verifier': session['code_verifier'],
-                    }
-    query_params = requests.compat.urlencode(query_params)
-    exchange = requests.post(
-        okta["token_uri"],
-        headers=headers,
-        data=query_params,
-        auth=(okta["client_id"], okta["client_secret"]),
-    ).json()
-
-    # Get tokens and validate
-    if not exchange.get("token_type"):
-        current_app.logger.error('Unsupported token type, exchange is ' + json.dumps(exchange))
-        return "Unsupported token type. Should be 'Bearer'.", 403
-    access_token = exchange["access_token"]
-
-    # Authorization flow successful, get userinfo and login user
-    userinfo_response = requests.get(okta["userinfo_uri"],
-                                     headers={'Authorization': f'Bearer {access_token}'}).json()
-
-    unique_id = userinfo_response["sub"]
-    user_email = userinfo_response["email"]
-    user_given_name = userinfo_response["given_name"]
-    user_name = userinfo_response["name"]
-
-    user = None
-    if not OktaUser.exists(unique_id):
-        # default user is a viewer
-        user = OktaUser.create(unique_id, user_given_name, user_name, user_email)
-    else:
-        user = OktaUser.update(unique_id, user_given_name, user_name, user_email)
-
-    # Now create the session
+    try:
+        exchange = exchange_code(code, session['code_verifier'])
+
+        # Get tokens and validate
+        if not exchange.get("token_type") or not exchange.get("id_token"):
+            current_app.logger.error('Unsupported token type, exchange is ' + json.dumps(exchange))
+            return "Unsupported token type. Should be 'Bearer'.", 403
+
+        # Validated here, with the cached keys of Okta
+        claims = validate_id_token(exchange["id_token"], session.get('nonce'))
+
+        # The ID token has the profile when Okta is configured to include it, otherwise ask Okta
+        if not all(claims.get(claim) for claim in ("email", "given_name", "name")):
+            userinfo = get_userinfo(exchange["access_token"])
+            if userinfo.get("sub") != claims["sub"]:
+                raise TokenError("The user info is not of the user of the ID token")
+            claims.update(userinfo)
+    except TokenError as e:
+        current_app.logger.error('Invalid ID token: {}'.format(e))
+        return "Invalid ID token", 403
+    except (requests.RequestException, ValueError) as e:
+        current_app.logger.error('Okta is not available: {}'.format(e))
+        return "The authentication service is not available, please try again later", 502
+
+    # Used once
+    for name in ('app_state', 'code_verifier', 'nonce'):
+        session.pop(name, None)
+
+    # Created as a viewer the first time, and the role read, in one round trip
+    user = OktaUser.upsert(claims["sub"], claims.get("given_name"), claims.get("name"), claims.get("email"))
+
+    # Now create the session, under a new id
+    rotate_session()
     flask_login.login_user(user)
 
     # Log the event
     current_app.logger.info('User logged in successfully: {}'.format(current_user.id))
 
     # Store authentications in a time series
-    get_db().ts().add("keybase:authentications", "*", 1, duplicate_policy='first')
+    count_event("keybase:authentications", type='authentications')
 
     # Check desired url
     wanted = flask.get_flashed_messages(category_filter=["wanted"])
@@ -215,19 +217,6 @@ def logout():
     return redirect(url_for('public_bp.landing'))
 
 
-def getusergroups(unique_id):
-    # Get groups
-    # https://developer.okta.com/docs/guides/create-an-api-token/main/
-    # Tokens are valid for 30 days from creation or last use
-    api_token = okta["api_token"]
-    usergroups_response = requests.get(okta["groups_uri"].format(unique_id),
-                                       headers={'Accept': 'application/json',
-                                                'Content-Type': 'application/json',
-                                                'Authorization': f'SSWS {api_token}'}).json()
-
-    print(usergroups_response)
-
-
 @auth_bp.route('/group', methods=['POST'])
 @login_required
 @requires_access_level(Role.ADMIN)
@@ -235,6 +224,7 @@ def oktagroup():
     # TODO Check the user exists and the role is valid
     print("Setting role of " + request.form['id'] + " to " + request.form['group'])
     get_db().hmset("keybase:okta:{}".format(request.form['id']), {"group": request.form['group']})
+    invalidate_user("keybase:okta:{}".format(request.form['id']))
     return jsonify(message="Role updated")
 
 
@@ -0,0 +1,198 @@
+import sys
+import time
+import uuid
+
+import requests
+
+from src.common.config import okta, CFG_OKTA_GROUP_ROLES, CFG_OKTA_SYNC_INTERVAL
+from src.common.users import CHANNEL
+from src.common.utils import get_db, Role
+from src.okta.oidc import http, TIMEOUT
+
+# Roles of the Okta users given by their Okta groups, CFG_OKTA_GROUP_ROLES: a user gets the highest role of its
+# groups. The job reads the members of the groups from the Okta API, and applies the differences to keybase:okta:*.
+# - Incremental: the list of groups is requested with the ETag of the previous run, and the members of a group are
+#   only read again when its lastMembershipUpdated changed. Members are kept in keybase:oktasync:group:<id>.
+# - The role of every user in a group is kept in keybase:oktasync:roles, read by OktaUser.upsert when a user logs in
+#   for the first time, so no Okta call is made on login.
+# - Only the users whose role changed are written, in pipelined batches of BATCH, and dropped from the user caches.
+#   Users leaving all the groups become viewers. Roles set by hand stay until the groups of the user change.
+BATCH = 500
+PREFIX = "keybase:oktasync:"
+ROLES = PREFIX + "roles"
+STATE = PREFIX + "state"
+LOCK = PREFIX + "lock"
+
+# The lock holds the token of the job, which only deletes it if it still holds it: a job slower than the lock expiry
+# must not release the lock of the next one
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_script = get_db().register_script(RELEASE_LUA)
+
+
+def parse_group_roles(value=CFG_OKTA_GROUP_ROLES):
+    # {group name: keybase group}
+    mapping = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        name, separator, group = item.rpartition('=')
+        name, group = name.strip(), group.strip()
+        if not separator or not name:
+            raise ValueError("Invalid Okta group role {}, expected <group name>=<role>".format(item))
+        if Role.group2role(group) is None:
+            raise ValueError("Unknown role {} for the Okta group {}".format(group, name))
+        mapping[name] = group
+    return mapping
+
+
+def api_get(url, params=None, headers=None):
+    # Waits when rate limited, until the time given by Okta
+    headers = dict({'Accept': 'application/json', 'Authorization': 'SSWS {}'.format(okta["api_token"])},
+                   **(headers or {}))
+    while True:
+        response = http.get(url, params=params, headers=headers, timeout=TIMEOUT)
+        if response.status_code != 429:
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+        reset = float(response.headers.get('X-Rate-Limit-Reset', time.time() + 1))
+        time.sleep(min(max(reset - time.time(), 1), 60))
+
+
+def api_pages(url, params=None):
+    # Items of all the pages, following the Link headers
+    while url:
+        response = api_get(url, params)
+        yield from response.json()
+        url = response.links.get('next', {}).get('url')
+        params = None
+
+
+def fetch_groups(names, etag=None):
+    # ([group], etag), or (None, etag) if unchanged since the ETag
+    search = " or ".join('profile.name eq "{}"'.format(name.replace('"', '\\"')) for name in names)
+    response = api_get(okta["api_uri"] + "/groups", {'search': search, 'limit': 200},
+                       {'If-None-Match': etag} if etag else None)
+    if response.status_code == 304:
+        return None, etag
+    groups = response.json()
+    next_url = response.links.get('next', {}).get('url')
+    if next_url:
+        groups.extend(api_pages(next_url))
+    return [group for group in groups if group['profile']['name'] in names], response.headers.get('ETag')
+
+
+def fetch_members(group_id):
+    return [user['id'] for user in api_pages("{}/groups/{}/users".format(okta["api_uri"], group_id), {'limit': 200})]
+
+
+def refresh_groups(mapping, state):
+    # Reads the members of the groups changed since the previous run, returns {group id: keybase group}
+    groups, etag = fetch_groups(list(mapping), state.get('etag'))
+    if groups is None:
+        return {key[len('group:'):]: value for key, value in state.items() if key.startswith('group:')}, 0
+
+    db = get_db()
+    fetched = 0
+    for group in groups:
+        updated = group.get('lastMembershipUpdated', '')
+        if state.get('updated:' + group['id']) == updated and db.exists(PREFIX + "group:" + group['id']):
+            continue
+        members = fetch_members(group['id'])
+        pipeline = db.pipeline(transaction=True)
+        pipeline.delete(PREFIX + "group:" + group['id'])
+        for start in range(0, len(members), BATCH):
+            pipeline.sadd(PREFIX + "group:" + group['id'], *members[start:start + BATCH])
+        pipeline.hset(STATE, 'updated:' + group['id'], updated)
+        pipeline.execute()
+        fetched += 1
+
+    roles = {group['id']: mapping[group['profile']['name']] for group in groups}
+    # Groups removed from the mapping, or deleted in Okta
+    stale = [key for key in state if key.startswith('group:') and key[len('group:'):] not in roles]
+    pipeline = db.pipeline(transaction=False)
+    if stale:
+        pipeline.hdel(STATE, *stale)
+    if roles:
+        pipeline.hset(STATE, mapping={'group:' + group_id: role for group_id, role in roles.items()})
+    if etag:
+        pipeline.hset(STATE, 'etag', etag)
+    pipeline.execute()
+    return roles, fetched
+
+
+def desired_roles(roles):
+    # {user id: keybase group}, the highest role of the groups of every user
+    desired = {}
+    for group_id, group in roles.items():
+        for user_id in get_db().smembers(PREFIX + "group:" + group_id):
+            if user_id not in desired or Role.group2role(group) > Role.group2role(desired[user_id]):
+                desired[user_id] = group
+    return desired
+
+
+def apply_roles(desired):
+    # Writes the roles that changed since the previous run, returns the number of users updated
+    db = get_db()
+    previous = db.hgetall(ROLES)
+    changes = {user_id: group for user_id, group in desired.items() if previous.get(user_id) != group}
+    changes.update({user_id: 'viewer' for user_id in previous if user_id not in desired})
+
+    updated = 0
+    users = list(changes)
+    for start in range(0, len(users), BATCH):
+        batch = users[start:start + BATCH]
+        pipeline = db.pipeline(transaction=False)
+        for user_id in batch:
+            pipeline.hget("keybase:okta:{}".format(user_id), 'group')
+        current = pipeline.execute()
+
+        pipeline = db.pipeline(transaction=False)
+        for user_id, group in zip(batch, current):
+            # Users who never logged in are created with their role by OktaUser.upsert
+            if group is not None and group != changes[user_id]:
+                pipeline.hset("keybase:okta:{}".format(user_id), 'group', changes[user_id])
+                pipeline.publish(CHANNEL, "keybase:okta:{}".format(user_id))
+                updated += 1
+            if user_id in desired:
+                pipeline.hset(ROLES, user_id, desired[user_id])
+            else:
+                pipeline.hdel(ROLES, user_id)
+        pipeline.execute()
+    return updated
+
+
+def sync(mapping=None):
+    mapping = parse_group_roles() if mapping is None else mapping
+    if not mapping:
+        return None
+    # One job at a time, whatever the number of workers or hosts running it
+    token = uuid.uuid4().hex
+    if not get_db().set(LOCK, token, nx=True, ex=CFG_OKTA_SYNC_INTERVAL):
+        return None
+    try:
+        start = time.perf_counter()
+        roles, fetched = refresh_groups(mapping, get_db().hgetall(STATE))
+        desired = desired_roles(roles)
+        updated = apply_roles(desired)
+        get_db().hset(STATE, mapping={'synced': time.time(), 'users': len(desired)})
+        return {'groups': len(roles), 'fetched': fetched, 'users': len(desired), 'updated': updated,
+                'seconds': round(time.perf_counter() - start, 3)}
+    finally:
+        release_script(keys=[LOCK], args=[token])
+
+
+if __name__ == '__main__':
+    # export PYTHONPATH="/home/<USER>/keybase/"
+    # python3 -m src.okta.sync [--loop]
+    while True:
+        try:
+            print(sync())
+        except (requests.RequestException, ValueError) as e:
+            print("Synchronization failed: {}".format(e))
+        if '--loop' not in sys.argv:
+            break
+        time.sleep(CFG_OKTA_SYNC_INTERVAL)
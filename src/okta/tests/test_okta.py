@@ -0,0 +1,169 @@
+import threading
+import time
+import urllib.parse
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+from src.common.config import okta
+from src.common.utils import get_db
+from src.okta.oidc import keyset, validate_id_token, TokenError
+from src.okta.sync import LOCK, parse_group_roles, sync
+from src.okta.user import OktaUser
+from src.services import mockidp
+
+
+@pytest.fixture
+def mock_idp(monkeypatch):
+    # The identity provider of src/services/mockidp.py on a free port, as the Okta of the application
+    server = make_server("127.0.0.1", 0, mockidp.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = "http://127.0.0.1:{}".format(server.server_port)
+    for name, path in (("auth_uri", "/oauth2/v1/authorize"), ("token_uri", "/oauth2/v1/token"), ("issuer", ""),
+                       ("userinfo_uri", "/oauth2/v1/userinfo"), ("jwks_uri", "/oauth2/v1/keys"),
+                       ("api_uri", "/api/v1")):
+        monkeypatch.setitem(okta, name, base + path)
+    monkeypatch.setitem(okta, "client_id", "keybase")
+    monkeypatch.setitem(okta, "client_secret", "secret")
+    monkeypatch.setitem(okta, "api_token", "token")
+    monkeypatch.setitem(okta, "redirect_uri", "http://localhost/authorization-code/callback")
+    monkeypatch.setattr(keyset, "uri", okta["jwks_uri"])
+    monkeypatch.setattr(keyset, "keys", {})
+    monkeypatch.setattr(keyset, "fetched", 0)
+    yield mockidp
+    server.shutdown()
+
+
+def session_cookie(test_client):
+    return {cookie.name: cookie.value for cookie in test_client.cookie_jar}.get("session")
+
+
+def test_okta_login_rotates_session(test_client, mock_idp):
+    get_db().flushall()
+    response = test_client.get("/login")
+    assert response.status_code == 302
+    before = session_cookie(test_client)
+    assert before is not None
+    assert len(list(get_db().scan_iter("keybase:session:*"))) == 1
+
+    # The IdP sends the browser back to the callback with the code
+    response = requests.get(response.headers["Location"], allow_redirects=False)
+    callback = urllib.parse.urlsplit(response.headers["Location"])
+    response = test_client.get(callback.path, query_string=callback.query)
+    assert response.status_code == 302
+
+    after = session_cookie(test_client)
+    assert after is not None and after != before
+    # Only the session created by the login is left
+    sessions = list(get_db().scan_iter("keybase:session:*"))
+    assert len(sessions) == 1
+    assert '"_user_id"' in get_db().get(sessions[0])
+
+
+def test_okta_parse_group_roles():
+    assert parse_group_roles("Keybase Admins=admin, Keybase Editors = editor") == \
+        {"Keybase Admins": "admin", "Keybase Editors": "editor"}
+    for value in ("admin", "=admin", "Keybase Admins=owner"):
+        with pytest.raises(ValueError):
+            parse_group_roles(value)
+
+
+def test_okta_sync_promotes_and_demotes(mock_idp, monkeypatch):
+    get_db().flushall()
+    mapping = {"Keybase Admins": "admin", "Keybase Editors": "editor"}
+
+    def members(users):
+        # Keybase Admins has the first 1% of the users, Keybase Editors the first 10%, changed at a new time
+        monkeypatch.setitem(mock_idp.app.config, 'USERS', users)
+        monkeypatch.setitem(mock_idp.app.config, 'STARTED', mock_idp.app.config['STARTED'] + 1)
+
+    def group(user_id):
+        return get_db().hget("keybase:okta:{}".format(user_id), 'group')
+
+    for user_id in ("mock00001", "mock00005", "mock00150"):
+        OktaUser.create(user_id, user_id, user_id, user_id)
+
+    members(200)
+    assert sync(mapping)['updated'] == 2
+    assert (group("mock00001"), group("mock00005"), group("mock00150")) == ("admin", "editor", "viewer")
+    # Unchanged groups are not read again
+    assert sync(mapping)['fetched'] == 0
+
+    members(100)
+    assert sync(mapping)['updated'] == 1
+    assert (group("mock00001"), group("mock00005")) == ("editor", "editor")
+
+    # Users leaving all the groups become viewers
+    members(40)
+    sync(mapping)
+    assert (group("mock00001"), group("mock00005"), group("mock00150")) == ("editor", "viewer", "viewer")
+    assert get_db().hget("keybase:oktasync:roles", "mock00005") is None
+
+
+def test_okta_sync_keeps_lock_of_other_job(mock_idp):
+    get_db().flushall()
+    mapping = {"Keybase Admins": "admin"}
+    get_db().set(LOCK, "other", ex=60)
+    assert sync(mapping) is None
+    assert get_db().get(LOCK) == "other"
+
+    # The lock of a job is released when it ends
+    get_db().delete(LOCK)
+    assert sync(mapping) is not None
+    assert not get_db().exists(LOCK)
+
+
+def id_token_claims(**claims):
+    now = int(time.time())
+    return dict({'sub': "mock00001", 'iss': okta["issuer"], 'aud': okta["client_id"], 'iat': now, 'exp': now + 3600,
+                 'nonce': "nonce"}, **claims)
+
+
+def test_okta_id_token_valid(mock_idp):
+    assert validate_id_token(mock_idp.sign(id_token_claims()), "nonce")['sub'] == "mock00001"
+
+
+def test_okta_id_token_bad_signature(mock_idp):
+    header, payload, signature = mock_idp.sign(id_token_claims()).split('.')
+    forged = mock_idp.b64encode(b'{"sub": "mock00002"}')
+    with pytest.raises(TokenError, match="signature"):
+        validate_id_token("{}.{}.{}".format(header, forged, signature), "nonce")
+
+
+def test_okta_id_token_wrong_audience(mock_idp):
+    with pytest.raises(TokenError, match="audience"):
+        validate_id_token(mock_idp.sign(id_token_claims(aud="other")), "nonce")
+
+
+def test_okta_id_token_wrong_nonce(mock_idp):
+    with pytest.raises(TokenError, match="nonce"):
+        validate_id_token(mock_idp.sign(id_token_claims()), "other")
+    # A session that did not start a login has no nonce, whatever the token
+    for claims in (id_token_claims(), id_token_claims(nonce=None)):
+        with pytest.raises(TokenError, match="nonce"):
+            validate_id_token(mock_idp.sign(claims), None)
+
+
+def test_okta_malformed_key_set(test_client, mock_idp, monkeypatch):
+    # A body without keys, as an error page of the IdP would be
+    monkeypatch.setattr(keyset, "uri", okta["userinfo_uri"])
+    with pytest.raises(TokenError, match="key set"):
+        validate_id_token(mock_idp.sign(id_token_claims()), "nonce")
+
+    # The callback refuses the login instead of failing
+    get_db().flushall()
+    response = requests.get(test_client.get("/login").headers["Location"], allow_redirects=False)
+    callback = urllib.parse.urlsplit(response.headers["Location"])
+    assert test_client.get(callback.path, query_string=callback.query).status_code == 403
+
+
+def test_okta_key_set_kept_when_refresh_fails(mock_idp, monkeypatch):
+    keyset.fetch()
+    known = dict(keyset.keys)
+    monkeypatch.setattr(keyset, "uri", okta["userinfo_uri"])
+    with pytest.raises(TokenError):
+        keyset.fetch()
+    assert keyset.keys == known
+    assert validate_id_token(mock_idp.sign(id_token_claims()), "nonce")['sub'] == "mock00001"
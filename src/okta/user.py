@@ -1,9 +1,26 @@
 from flask_login import UserMixin
 import time
 from src.common.utils import Role, get_db
-
-# Simulate user database
-USERS_DB = {}
+from src.common.users import get_user, cache_user, invalidate_user, CHANNEL
+
+# Login of a user, in one round trip: created the first time, as a viewer or with the role of its Okta groups (see
+# src/okta/sync.py), profile updated the following times, the group returned, and the other workers told to forget
+# the user they cached
+# KEYS[1] is the user, KEYS[2] the roles of the Okta groups, ARGV the name, given name, email, the time, the
+# invalidation channel and the id of the user
+UPSERT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local group = redis.call('HGET', KEYS[2], ARGV[6])
+    if not group then
+        group = 'viewer'
+    end
+    redis.call('HSET', KEYS[1], 'group', group, 'signup', ARGV[4])
+end
+redis.call('HSET', KEYS[1], 'name', ARGV[1], 'given_name', ARGV[2], 'email', ARGV[3], 'login', ARGV[4])
+redis.call('PUBLISH', ARGV[5], KEYS[1])
+return redis.call('HGET', KEYS[1], 'group')
+"""
+upsert_script = get_db().register_script(UPSERT_LUA)
 
 
 class OktaUser(UserMixin):
@@ -21,7 +38,9 @@ class OktaUser(UserMixin):
 
     @staticmethod
     def get(user_id):
-        return USERS_DB.get(user_id)
+        return get_user("keybase:okta:{}".format(user_id),
+                        lambda user: OktaUser(user_id, user.get('given_name'), user.get('name'), user.get('email'),
+                                              Role.group2role(user.get('group'))))
 
     @staticmethod
     def exists(user_id):
@@ -37,8 +56,8 @@ class OktaUser(UserMixin):
             'signup': time.time(),
             'login': time.time()})
 
-        USERS_DB[user_id] = OktaUser(user_id, given_name, name, email, Role.VIEWER)
-        return USERS_DB[user_id]
+        invalidate_user("keybase:okta:{}".format(user_id))
+        return cache_user("keybase:okta:{}".format(user_id), OktaUser(user_id, given_name, name, email, Role.VIEWER))
 
     @staticmethod
     def update(user_id, given_name, name, email):
@@ -50,8 +69,15 @@ class OktaUser(UserMixin):
             'login': time.time()})
 
         access_level = Role.group2role(get_db().hmget("keybase:okta:{}".format(user_id), ['group'])[0])
-        USERS_DB[user_id] = OktaUser(user_id, given_name, name, email, access_level)
-        return USERS_DB[user_id]
+        invalidate_user("keybase:okta:{}".format(user_id))
+        return cache_user("keybase:okta:{}".format(user_id), OktaUser(user_id, given_name, name, email, access_level))
+
+    @staticmethod
+    def upsert(user_id, given_name, name, email):
+        key = "keybase:okta:{}".format(user_id)
+        args = [name, given_name, email, time.time(), CHANNEL, user_id]
+        group = upsert_script(keys=[key, "keybase:oktasync:roles"], args=args)
+        return cache_user(key, OktaUser(user_id, given_name, name, email, Role.group2role(group)))
 
     def set_role(self, access_level):
         self.access_level = access_level
@@ -59,6 +85,7 @@ class OktaUser(UserMixin):
     def set_group(self, group):
         self.access_level = Role.group2role(group)
         get_db().hset("keybase:okta:{}".format(self.id), mapping={"group": group})
+        invalidate_user("keybase:okta:{}".format(self.id))
 
     def get_role(self):
         return self.access_level
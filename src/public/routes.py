@@ -8,7 +8,10 @@ from redis.commands.search.query import Query
 from markdown import markdown
 
 from src.common.config import CFG_THEME, CFG_VSS_WITH_LUA
-from src.common.utils import get_db, pretty_title, parse_query_string
+from src.common.utils import get_db, pretty_title, parse_query_string, get_vss_index, get_categories
+from src.analytics.timeseries import document_labels
+from src.analytics.views import record_view
+from src.analytics.visitors import visitor_id
 from flask_breadcrumbs import register_breadcrumb, default_breadcrumb_root
 
 public_bp = Blueprint('public_bp', __name__,
@@ -25,7 +28,7 @@ def get_bread_path(*args, **kwargs):
         cat = get_db().json().get('keybase:json:{}'.format(pathlist[1]), '$.category')
         # make sure the document has a category
         if cat[0] is not None:
-            catname = get_db().hget('keybase:categories', cat[0])
+            catname = get_categories().get(cat[0])
             return [{'text': 'Home', 'url': url_for("public_bp.landing")},
                     {'text': catname, 'url': url_for("public_bp.public", cat=cat[0])}]
 
@@ -35,7 +38,7 @@ def get_bread_path(*args, **kwargs):
                 {'text': 'search: "' + urllib.parse.unquote(flask.request.args.get('q')) + '"', 'url': ''}]
 
     if flask.request.args.get('cat'):
-        catname = get_db().hget("keybase:categories", flask.request.args.get('cat'))
+        catname = get_categories().get(flask.request.args.get('cat'))
         catnamelabel = catname if catname is not None else 'all categories'
         return [{'text': 'Home', 'url': url_for("public_bp.landing")},
                 {'text': catnamelabel}]
@@ -49,7 +52,7 @@ def get_bread_path(*args, **kwargs):
 
 @public_bp.route('/', methods=['GET'])
 def landing():
-    categories = get_db().hgetall("keybase:categories")
+    categories = get_categories()
     return render_template('landing.html', categories=categories)
 
 
@@ -107,7 +110,7 @@ def public():
                 queryfilter = "@currentversion_name_fts|currentversion_content_fts:'" + queryfilter + "'"
             # If the category is good, can be processed and set in the UI
             if flask.request.args.get('cat'):
-                if get_db().hexists("keybase:categories", flask.request.args.get('cat')):
+                if flask.request.args.get('cat') in get_categories():
                     catfilter = " @category:{" + flask.request.args.get('cat') + "} "
                     category = flask.request.args.get('cat')
 
@@ -137,7 +140,7 @@ def public():
             keydocument = zip(keys, names, pretty, updated)
 
             # Get the categories
-            categories = get_db().hgetall("keybase:categories")
+            categories = get_categories()
             return render_template('public.html',
                                    title=title,
                                    desc=desc,
@@ -150,7 +153,7 @@ def public():
                                    asc=asc)
         else:
             # Get the categories
-            categories = get_db().hgetall("keybase:categories")
+            categories = get_categories()
             return render_template('noresults.html', title="No result found", desc="No result found",
                                    categories=categories, noresultmsg=noresultmsg)
 
@@ -169,7 +172,7 @@ def kb(pk, prettyurl):
     suggestlist = None
 
     documents = get_db().json().get('keybase:json:{}'.format(pk), '$.currentversion', '$.keyword', '$.description',
-                                    '$.privacy', '$.state', '$.tags', '$.updated', '$.category')
+                                    '$.privacy', '$.state', '$.tags', '$.updated', '$.category', '$.author')
     if documents is None:
         return render_template('404.html'), 404
 
@@ -178,7 +181,7 @@ def kb(pk, prettyurl):
         return redirect(url_for('public_bp.landing')), 403
 
     # All fine, read categories
-    categories = get_db().hgetall("keybase:categories")
+    categories = get_categories()
 
     document = documents['$.currentversion'][0]
     title = document['name']
@@ -198,13 +201,15 @@ def kb(pk, prettyurl):
     document['updated'] = datetime.utcfromtimestamp(int(documents['$.updated'][0])).strftime('%d, %b %Y')
 
     # The document can be rendered, count the visit
-    get_db().ts().add("keybase:docview:{}".format(pk), "*", 1, duplicate_policy='first')
+    record_view(pk, document_labels(pk, documents['$.category'][0], documents['$.privacy'][0], documents['$.author'][0]),
+                audience='public', visitor=visitor_id())
 
-    if get_db().hexists("keybase:vss:{}".format(pk), "content_embedding"):
+    vss_index, vss_field = get_vss_index()
+    if get_db().hexists("keybase:vss:{}".format(pk), vss_field):
         if CFG_VSS_WITH_LUA:
-            keys_and_args = ["keybase:vss:{}".format(pk)]
+            keys_and_args = ["keybase:vss:{}".format(pk), vss_index, vss_field]
             res = get_db().eval(
-                "local vector = redis.call('HMGET',KEYS[1], 'content_embedding') local searchres = redis.call('FT.SEARCH','vss_idx','(@state:{published|review} @privacy:{public})=>[KNN 6 @content_embedding $B AS score]','PARAMS','2','B',vector[1], 'SORTBY', 'score', 'ASC', 'LIMIT', 1, 6,'RETURN',2,'score','name','DIALECT',2) return searchres",
+                "local vector = redis.call('HMGET',KEYS[1], ARGV[2]) local searchres = redis.call('FT.SEARCH',ARGV[1],'(@state:{published|review} @privacy:{public})=>[KNN 6 @'..ARGV[2]..' $B AS score]','PARAMS','2','B',vector[1], 'SORTBY', 'score', 'ASC', 'LIMIT', 1, 6,'RETURN',2,'score','name','DIALECT',2) return searchres",
                 1, *keys_and_args)
             it = iter(res[1:])
             for x in it:
@@ -214,14 +219,14 @@ def kb(pk, prettyurl):
                 pretty.append(pretty_title(docname))
             suggestlist = zip(keys, names, pretty)
         else:
-            embedding = get_db(decode=False).hget("keybase:vss:{}".format(pk), "content_embedding")
-            q = Query("(@state:{published|review} @privacy:{public})=>[KNN 6 @content_embedding $B AS score]")\
+            embedding = get_db(decode=False).hget("keybase:vss:{}".format(pk), vss_field)
+            q = Query("(@state:{published|review} @privacy:{public})=>[KNN 6 @" + vss_field + " $B AS score]")\
                 .return_field("score")\
                 .return_field("name")\
                 .sort_by("score", asc=True)\
                 .dialect(2)\
                 .paging(1, 6)
-            res = get_db().ft("vss_idx").search(q, query_params={"B": embedding})
+            res = get_db().ft(vss_index).search(q, query_params={"B": embedding})
             it = iter(res.docs[0:])
             for x in it:
                 keys.append(str(x['id'].split(':')[-1]))
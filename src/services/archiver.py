@@ -0,0 +1,15 @@
+import sys
+
+# In production uncomment this line and set the keybase folder path
+# sys.path.append('/home/<USER>/keybase/')
+from src.common.archive import archive_stream
+
+# Or set the PYTHONPATH environment variables
+# export PYTHONPATH="/home/<USER>/keybase/"
+# python3 /home/<USER>/keybase/src/services/archiver.py
+
+STREAMS = ("keybase:requests", "keybase:errors")
+
+if __name__ == '__main__':
+    for stream in sys.argv[1:] or STREAMS:
+        print("Archived {} entries of {}".format(archive_stream(stream), stream))
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from src.common.config import CFG_EMBEDDER_MODEL, CFG_EMBEDDER_ADDRESS, CFG_EMBEDDER_MAX_BATCH, \
+    CFG_EMBEDDER_MAX_WAIT_MS
+from src.common.embedding import parse_address, send_frame, recv_frame
+from src.common.histogram import Histogram
+
+# Long-lived embedding server: the model is loaded once and shared by every client over a local socket.
+# Concurrent encode requests are coalesced into micro-batches, bounded by CFG_EMBEDDER_MAX_BATCH texts
+# and CFG_EMBEDDER_MAX_WAIT_MS milliseconds of waiting for the batch to fill.
+#
+# export PYTHONPATH="/home/<USER>/keybase/"
+# export CFG_EMBEDDER_ADDRESS="/tmp/keybase-embedder.sock"
+# python3 /home/<USER>/keybase/src/services/embedder.py
+
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+class EncodeJob:
+    def __init__(self, texts):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    def __init__(self, model, max_batch, max_wait_ms):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.jobs = queue.Queue()
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+        self.encode_time = Histogram(LATENCY_BUCKETS_MS)
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+
+    def submit(self, texts):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        start = time.perf_counter()
+        job = EncodeJob(texts)
+        self.jobs.put(job)
+        job.done.wait()
+        self.latency.observe((time.perf_counter() - start) * 1000)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def next_batch(self):
+        # Block for the first job, then keep collecting until the batch is full or the wait time is over
+        batch = [self.jobs.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(job)
+            size += len(job.texts)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            texts = [text for job in batch for text in job.texts]
+            self.batch_size.observe(len(texts))
+
+            start = time.perf_counter()
+            try:
+                vectors = self.model.encode(texts, batch_size=self.max_batch).astype(np.float32)
+            except Exception as e:
+                for job in batch:
+                    job.error = e
+                    job.done.set()
+                continue
+            self.encode_time.observe((time.perf_counter() - start) * 1000)
+
+            offset = 0
+            for job in batch:
+                job.result = vectors[offset:offset + len(job.texts)]
+                offset += len(job.texts)
+                job.done.set()
+
+    def stats(self):
+        return {'latency_ms': self.latency.snapshot(),
+                'encode_ms': self.encode_time.snapshot(),
+                'batch_size': self.batch_size.snapshot(),
+                'queued': self.jobs.qsize()}
+
+
+class EmbeddingHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection is kept open by the client and serves many requests
+        while True:
+            try:
+                message = json.loads(recv_frame(self.request))
+            except (ConnectionError, OSError, ValueError):
+                return
+
+            try:
+                if message.get("op") == "encode":
+                    vectors = self.server.batcher.submit(message["texts"])
+                    count, dim = vectors.shape
+                    send_frame(self.request, json.dumps({"count": count, "dim": dim}).encode())
+                    send_frame(self.request, vectors.tobytes())
+                elif message.get("op") == "stats":
+                    send_frame(self.request, json.dumps(self.server.batcher.stats()).encode())
+                else:
+                    send_frame(self.request, json.dumps({"error": "Unknown operation"}).encode())
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                send_frame(self.request, json.dumps({"error": str(e)}).encode())
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(address, model, max_batch=CFG_EMBEDDER_MAX_BATCH, max_wait_ms=CFG_EMBEDDER_MAX_WAIT_MS):
+    family, bind = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind):
+            os.unlink(bind)
+        server = ThreadingUnixServer(bind, EmbeddingHandler)
+    else:
+        server = ThreadingTCPServer(bind, EmbeddingHandler)
+
+    server.batcher = MicroBatcher(model, max_batch, max_wait_ms)
+    threading.Thread(target=server.batcher.run, daemon=True).start()
+    logging.info("Embedding server listening on %s (max batch %d, max wait %d ms)", address, max_batch, max_wait_ms)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(CFG_EMBEDDER_MODEL)
+    logging.info("Model %s loaded in %.1f s", CFG_EMBEDDER_MODEL, time.perf_counter() - start)
+
+    serve(CFG_EMBEDDER_ADDRESS or "/tmp/keybase-embedder.sock", model)
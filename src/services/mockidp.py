@@ -0,0 +1,155 @@
+import base64
+import hashlib
+import json
+import random
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from flask import Flask, jsonify, redirect, request
+
+from src.common.config import okta
+
+# Local identity provider answering like Okta to the login flow of src/okta, to test logins and measure their
+# throughput without an Okta tenant. Users are mock00000 to mock<USERS - 1>, any of them logs in at once, and the
+# groups "Keybase Admins" and "Keybase Editors" can be synchronized by src/okta/sync.py.
+#
+# export OKTA_BASE=localhost:8081 OKTA_SCHEME=http OKTA_CLIENT_ID=keybase OKTA_CLIENT_SECRET=secret
+# export OKTA_CALLBACK_URL=http://localhost:5000/authorization-code/callback
+# export CFG_OKTA_GROUP_ROLES="Keybase Admins=admin,Keybase Editors=editor"
+# python3 -m src.services.mockidp [<port> [<users>]]
+# python3 -m src.services.mockidp bench http://localhost:5000 [<logins> [<concurrency>]]
+KID = "mockidp"
+USERS = 1000
+
+app = Flask(__name__)
+app.config['USERS'] = USERS
+app.config['STARTED'] = time.time()
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+# Authorization codes not exchanged yet
+codes = {}
+lock = threading.Lock()
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def number(value):
+    return b64encode(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+def sign(claims):
+    header = b64encode(json.dumps({'alg': 'RS256', 'kid': KID, 'typ': 'JWT'}).encode())
+    payload = b64encode(json.dumps(claims).encode())
+    signature = private_key.sign("{}.{}".format(header, payload).encode('ascii'), padding.PKCS1v15(), hashes.SHA256())
+    return "{}.{}.{}".format(header, payload, b64encode(signature))
+
+
+def profile(sub):
+    return {'sub': sub,
+            'email': "{}@example.com".format(sub),
+            'given_name': "Mock",
+            'name': "Mock {}".format(sub[4:])}
+
+
+@app.route("/oauth2/v1/keys")
+def keys():
+    numbers = private_key.public_key().public_numbers()
+    return jsonify(keys=[{'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': KID,
+                          'n': number(numbers.n), 'e': number(numbers.e)}])
+
+
+@app.route("/oauth2/v1/authorize")
+def authorize():
+    code = secrets.token_urlsafe(16)
+    with lock:
+        codes[code] = {'client_id': request.args['client_id'],
+                       'nonce': request.args.get('nonce'),
+                       'challenge': request.args['code_challenge'],
+                       'sub': "mock{:05d}".format(random.randrange(app.config['USERS']))}
+    return redirect("{}?{}".format(request.args['redirect_uri'],
+                                   requests.compat.urlencode({'code': code, 'state': request.args['state']})))
+
+
+@app.route("/oauth2/v1/token", methods=['POST'])
+def token():
+    with lock:
+        grant = codes.pop(request.form.get('code'), None)
+    if grant is None or request.authorization is None or request.authorization.username != grant['client_id']:
+        return jsonify(error="invalid_grant"), 400
+    verifier = request.form.get('code_verifier', '')
+    if b64encode(hashlib.sha256(verifier.encode('ascii')).digest()) != grant['challenge']:
+        return jsonify(error="invalid_grant", error_description="PKCE verification failed"), 400
+
+    now = int(time.time())
+    claims = dict(profile(grant['sub']), iss=okta["issuer"], aud=grant['client_id'], iat=now, exp=now + 3600,
+                  nonce=grant['nonce'])
+    return jsonify(token_type="Bearer", expires_in=3600, scope="openid email profile",
+                   access_token=grant['sub'], id_token=sign(claims))
+
+
+@app.route("/oauth2/v1/userinfo")
+def userinfo():
+    # The access token is the user
+    return jsonify(profile(request.headers.get('Authorization', '')[len("Bearer "):]))
+
+
+@app.route("/api/v1/groups")
+def groups():
+    # Keybase Admins has the first 1% of the users, Keybase Editors the first 10%
+    started = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(app.config['STARTED']))
+    result = [{'id': "00g{}".format(name.split()[1].lower()), 'lastMembershipUpdated': started,
+               'profile': {'name': name}} for name in ("Keybase Admins", "Keybase Editors")]
+    etag = '"{}"'.format(hashlib.sha1(json.dumps(result).encode()).hexdigest())
+    if request.headers.get('If-None-Match') == etag:
+        return "", 304
+    response = jsonify(result)
+    response.headers['ETag'] = etag
+    return response
+
+
+@app.route("/api/v1/groups/<group_id>/users")
+def group_users(group_id):
+    # Pages of at most limit users, the next page linked in the Link header
+    size = app.config['USERS'] // (100 if group_id == "00gadmins" else 10)
+    limit = int(request.args.get('limit', 200))
+    after = int(request.args.get('after', 0))
+    response = jsonify([{'id': "mock{:05d}".format(user)} for user in range(after, min(after + limit, size))])
+    if after + limit < size:
+        response.headers['Link'] = '<{}?{}>; rel="next"'.format(
+            request.base_url, requests.compat.urlencode({'limit': limit, 'after': after + limit}))
+    return response
+
+
+def login(url):
+    # One complete login, following the redirects: application, IdP, callback, landing page
+    start = time.perf_counter()
+    with requests.Session() as session:
+        response = session.get("{}/login".format(url.rstrip('/')), timeout=30)
+    return response.ok and any("callback" in step.url for step in response.history), time.perf_counter() - start
+
+
+def bench(url, logins=200, concurrency=10):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: login(url), range(logins)))
+    elapsed = time.perf_counter() - start
+    durations = sorted(duration for _, duration in results)
+    print("{} logins, {} failed, in {:.1f} s: {:.1f} logins per second, p50 {:.0f} ms, p95 {:.0f} ms".format(
+        logins, sum(1 for ok, _ in results if not ok), elapsed, logins / elapsed,
+        durations[len(durations) // 2] * 1000, durations[int(len(durations) * 0.95)] * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'bench':
+        bench(sys.argv[2], *[int(arg) for arg in sys.argv[3:5]])
+    else:
+        if len(sys.argv) > 2:
+            app.config['USERS'] = int(sys.argv[2])
+        app.run(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081, threaded=True)
@@ -0,0 +1,179 @@
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+from redis.commands.search.field import TagField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition
+
+from src.common.config import CFG_VSS_PROJECTION_DIR
+from src.common.utils import get_db
+
+# Dimensionality reduction for the recommendation embeddings.
+# The projection is fitted with NumPy on the existing 768-d embeddings and saved as a versioned artifact,
+# projection-v<N>.npz in CFG_VSS_PROJECTION_DIR. The reduced embeddings are stored next to the full ones,
+# in the field content_embedding_v<N>, and indexed by vss_idx_v<N>.
+# Once satisfied with the reported recall, set CFG_VSS_PROJECTION=<N> so that transformer.py projects the new
+# embeddings and the recommendations are served from vss_idx_v<N>.
+#
+# export PYTHONPATH="/home/<USER>/keybase/"
+# python3 /home/<USER>/keybase/src/services/projection.py pca 128
+
+BATCH = 500
+RECALL_K = 6
+RECALL_QUERIES = 1000
+
+
+class Projection:
+    def __init__(self, version, mean, components, method):
+        self.version = version
+        self.mean = mean
+        self.components = components
+        self.method = method
+
+    @property
+    def dim(self):
+        return self.components.shape[1]
+
+    @property
+    def field(self):
+        return "content_embedding_v{}".format(self.version)
+
+    @property
+    def index(self):
+        return "vss_idx_v{}".format(self.version)
+
+    def apply(self, vectors):
+        return ((vectors - self.mean) @ self.components).astype(np.float32)
+
+
+def fit_pca(vectors, dim):
+    mean = vectors.mean(axis=0)
+    # The principal components are the right singular vectors of the centered data
+    _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[:dim].T.astype(np.float32)
+
+
+def fit_random(vectors, dim, seed=0):
+    # Gaussian random projection, scaled to preserve distances on average (Johnson-Lindenstrauss)
+    rng = np.random.default_rng(seed)
+    components = rng.normal(0, 1 / np.sqrt(dim), size=(vectors.shape[1], dim))
+    return np.zeros(vectors.shape[1], dtype=np.float32), components.astype(np.float32)
+
+
+def artifact_path(version):
+    return os.path.join(CFG_VSS_PROJECTION_DIR, "projection-v{}.npz".format(version))
+
+
+def save_projection(mean, components, method):
+    os.makedirs(CFG_VSS_PROJECTION_DIR, exist_ok=True)
+    versions = [int(os.path.basename(x)[len("projection-v"):-len(".npz")])
+                for x in glob.glob(os.path.join(CFG_VSS_PROJECTION_DIR, "projection-v*.npz"))]
+    version = max(versions, default=0) + 1
+    np.savez(artifact_path(version), mean=mean, components=components, method=method, created=int(time.time()))
+    return Projection(version, mean, components, method)
+
+
+def load_projection(version):
+    artifact = np.load(artifact_path(version))
+    return Projection(int(version), artifact["mean"], artifact["components"], str(artifact["method"]))
+
+
+def load_embeddings():
+    keys, vectors = [], []
+    cursor = 0
+    while True:
+        cursor, batch = get_db(decode=False).scan(cursor, match="keybase:vss:*", count=BATCH)
+        pipeline = get_db(decode=False).pipeline(transaction=False)
+        for key in batch:
+            pipeline.hget(key, "content_embedding")
+        for key, embedding in zip(batch, pipeline.execute()):
+            if embedding is not None:
+                keys.append(key)
+                vectors.append(np.frombuffer(embedding, dtype=np.float32))
+        if cursor == 0:
+            break
+
+    return keys, np.vstack(vectors) if len(vectors) else np.zeros((0, 768), dtype=np.float32)
+
+
+def nearest(vectors, queries, k):
+    # Exact L2 neighbours of the query rows, excluding the query itself
+    norms = (vectors ** 2).sum(axis=1)
+    result = []
+    for start in range(0, len(queries), 100):
+        rows = queries[start:start + 100]
+        distances = norms[None, :] - 2 * vectors[rows] @ vectors.T
+        distances[np.arange(len(rows)), rows] = np.inf
+        result.append(np.argsort(distances, axis=1)[:, :k])
+    return np.vstack(result)
+
+
+def recall_at_k(full, reduced, k=RECALL_K):
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(full), size=min(RECALL_QUERIES, len(full)), replace=False)
+    expected = nearest(full, queries, k)
+    found = nearest(reduced, queries, k)
+    return np.mean([len(set(e) & set(f)) / k for e, f in zip(expected, found)])
+
+
+def embedding_fields(embedding, projection=None):
+    # Fields of keybase:vss:<pk> holding the embedding, and its reduction when a projection is active
+    fields = {"content_embedding": embedding.tobytes()}
+    if projection is not None:
+        fields[projection.field] = projection.apply(embedding).tobytes()
+    return fields
+
+
+def create_index(projection):
+    if projection.index in get_db().execute_command("FT._LIST"):
+        return
+    index_def = IndexDefinition(prefix=["keybase:vss"])
+    schema = (TagField("state"),
+              TagField("privacy"),
+              VectorField(projection.field, "HNSW", {"TYPE": "FLOAT32", "DIM": projection.dim, "DISTANCE_METRIC": "L2"}))
+    get_db().ft(projection.index).create_index(schema, definition=index_def)
+
+
+def apply_projection(projection, keys, vectors):
+    reduced = projection.apply(vectors)
+    for start in range(0, len(keys), BATCH):
+        pipeline = get_db(decode=False).pipeline(transaction=False)
+        for key, embedding in zip(keys[start:start + BATCH], reduced[start:start + BATCH]):
+            pipeline.hset(key, projection.field, embedding.tobytes())
+        pipeline.execute()
+    return reduced
+
+
+if __name__ == '__main__':
+    method = sys.argv[1] if len(sys.argv) > 1 else "pca"
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+
+    keys, vectors = load_embeddings()
+    if len(keys) <= RECALL_K:
+        print("Not enough vector embeddings to fit a projection!")
+        sys.exit()
+
+    if method == "pca":
+        if dim > min(vectors.shape):
+            print("Cannot fit {} components on {} embeddings".format(dim, len(keys)))
+            sys.exit()
+        mean, components = fit_pca(vectors, dim)
+    elif method == "random":
+        mean, components = fit_random(vectors, dim)
+    else:
+        print("Unknown method {}, use pca or random".format(method))
+        sys.exit()
+
+    projection = save_projection(mean, components, method)
+    print("Saved {} projection {} -> {} as {}".format(method, vectors.shape[1], dim, artifact_path(projection.version)))
+
+    create_index(projection)
+    reduced = apply_projection(projection, keys, vectors)
+    print("Projected {} embeddings into {}, indexed by {}".format(len(keys), projection.field, projection.index))
+
+    recall = recall_at_k(vectors, reduced)
+    print("recall@{}: {:.3f} (delta {:+.3f} against the full vectors)".format(RECALL_K, recall, recall - 1))
+    print("Vector size: {} -> {} bytes".format(vectors.shape[1] * 4, dim * 4))
+    print("Set CFG_VSS_PROJECTION={} to serve recommendations from {}".format(projection.version, projection.index))
@@ -0,0 +1,55 @@
+import numpy as np
+
+import src.services.projection
+from src.services.projection import fit_pca, fit_random, save_projection, load_projection, artifact_path, \
+    embedding_fields, recall_at_k, nearest
+
+
+def clustered(count=300, dim=64, clusters=10, seed=1):
+    # Embeddings close to a few centers, in a subspace of low dimension, as sentence embeddings are
+    rng = np.random.default_rng(seed)
+    basis = rng.normal(size=(8, dim))
+    centers = rng.normal(size=(clusters, 8)) * 10
+    points = centers[rng.integers(clusters, size=count)] + rng.normal(size=(count, 8))
+    return (points @ basis + rng.normal(scale=0.01, size=(count, dim))).astype(np.float32)
+
+
+def test_projection_artifact_versioned(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.services.projection, "CFG_VSS_PROJECTION_DIR", str(tmp_path))
+    vectors = clustered()
+    first = save_projection(*fit_pca(vectors, 16), "pca")
+    second = save_projection(*fit_random(vectors, 32), "random")
+    assert (first.version, second.version) == (1, 2)
+    assert artifact_path(2) == str(tmp_path / "projection-v2.npz")
+
+    loaded = load_projection(1)
+    assert (loaded.method, loaded.dim, loaded.field, loaded.index) == ("pca", 16, "content_embedding_v1", "vss_idx_v1")
+    assert np.array_equal(loaded.apply(vectors), first.apply(vectors))
+    assert load_projection(2).dim == 32
+
+
+def test_projection_embedding_fields(tmp_path, monkeypatch):
+    # As stored by transformer.py
+    monkeypatch.setattr(src.services.projection, "CFG_VSS_PROJECTION_DIR", str(tmp_path))
+    vectors = clustered()
+    projection = save_projection(*fit_pca(vectors, 16), "pca")
+    assert list(embedding_fields(vectors[0])) == ["content_embedding"]
+    fields = embedding_fields(vectors[0], load_projection(projection.version))
+    assert np.frombuffer(fields["content_embedding"], dtype=np.float32).tolist() == vectors[0].tolist()
+    reduced = np.frombuffer(fields["content_embedding_v1"], dtype=np.float32)
+    assert reduced.shape == (16,)
+    assert np.allclose(reduced, projection.apply(vectors[:1])[0])
+
+
+def test_projection_recall_at_6():
+    vectors = clustered()
+    # The neighbours of a point never include itself
+    assert not (nearest(vectors, np.arange(10), 6) == np.arange(10)[:, None]).any()
+    assert recall_at_k(vectors, vectors) == 1
+
+    # The data lies in 8 dimensions: PCA keeps the neighbours, a projection to 2 dimensions loses many
+    mean, components = fit_pca(vectors, 8)
+    reduced = ((vectors - mean) @ components).astype(np.float32)
+    assert recall_at_k(vectors, reduced) > 0.9
+    mean, components = fit_random(vectors, 2)
+    assert recall_at_k(vectors, ((vectors - mean) @ components).astype(np.float32)) < recall_at_k(vectors, reduced)
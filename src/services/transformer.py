@@ -1,4 +1,3 @@
-from sentence_transformers import SentenceTransformer
 from redis.commands.search.query import Query
 from src.document.document import Document
 
@@ -9,6 +8,9 @@ from flask import Flask
 # In production uncomment this line and set the keybase folder path
 # sys.path.append('/Users/mortensi/PycharmProjects/keybase/')
 from src.common.utils import get_db
+from src.common.config import CFG_EMBEDDER_ADDRESS, CFG_EMBEDDER_MODEL, CFG_VSS_PROJECTION
+from src.common.embedding import get_embedder
+from src.services.projection import load_projection, embedding_fields
 
 # Or set the PYTHONPATH environment variables
 # export PYTHONPATH="/Users/mortensi/PycharmProjects/keybase/"
@@ -25,17 +27,29 @@ with app.app_context():
         print("No vector embedding to be processed!")
         sys.exit()
 
-    model = SentenceTransformer('sentence-transformers/all-distilroberta-v1')
-    for doc in rs.docs:
-        pk = doc.id.split(':')[-1]
-        document = Document.get(pk)
-        print("This document has no embedding: " + pk)
-        embedding = model.encode(document.currentversion.content).astype(np.float32).tobytes()
-        doc = {"content_embedding": embedding,
-               "name": document.currentversion.name,
-               "state": document.state,
-               "privacy": document.privacy}
-        get_db().hset("keybase:vss:{}".format(pk), mapping=doc)
+    # Share the model loaded by the embedding server, if there is one, rather than loading it here
+    if CFG_EMBEDDER_ADDRESS:
+        model = get_embedder()
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(CFG_EMBEDDER_MODEL)
+
+    documents = [Document.get(doc.id.split(':')[-1]) for doc in rs.docs]
+    for document in documents:
+        print("This document has no embedding: " + document.pk)
+
+    # Encode all the pending documents in one batch
+    embeddings = model.encode([document.currentversion.content for document in documents]).astype(np.float32)
+
+    # Reduced embeddings for the recommendations, see projection.py
+    projection = load_projection(CFG_VSS_PROJECTION) if CFG_VSS_PROJECTION else None
+
+    for document, embedding in zip(documents, embeddings):
+        doc = dict(embedding_fields(embedding, projection),
+                   name=document.currentversion.name,
+                   state=document.state,
+                   privacy=document.privacy)
+        get_db().hset("keybase:vss:{}".format(document.pk), mapping=doc)
         document.processable = 0
         document.save()
-        print("....done vector embedding for " + pk)
+        print("....done vector embedding for " + document.pk)